@@ -0,0 +1,184 @@
+import asyncio
+from collections import OrderedDict, deque
+
+class Batch:
+    """1回の生成でまとめて答えるメンションの束"""
+    __slots__ = ('guild_key', 'channel_id', 'messages', 'handler')
+
+    def __init__(self, guild_key, channel_id:int, message, handler):
+        self.guild_key = guild_key
+        self.channel_id = channel_id
+        self.messages = [message]
+        self.handler = handler
+
+class LLMSlots(asyncio.Semaphore):
+    """使用中の数を数えるセマフォ (メトリクス用)"""
+    def __init__(self, size:int):
+        super().__init__(size)
+        self.size = size
+        self.in_use = 0
+
+    async def acquire(self) -> bool:
+        await super().acquire()
+        self.in_use += 1
+        return True
+
+    def release(self) -> None:
+        self.in_use -= 1
+        super().release()
+
+class AdmissionScheduler:
+    """
+    メンションへの応答の実行数を制限する。
+    - チャンネル毎、ギルド毎、全体の同時実行数に上限を設ける
+    - 待ちのあるギルドを順番に回して、忙しいギルドが他のギルドを待たせないようにする
+    - 空いているチャンネルのメンションはすぐに開始し、実行中や実行待ちのあるチャンネルで
+      開始を待つ間に届いたメンションは1回の生成にまとめる
+    LLMの呼び出しそのものはllm()のセマフォで全体の同時実行数を制限する。
+    """
+    def __init__(
+            self,
+            max_per_channel:int=1,
+            max_per_guild:int=2,
+            max_running:int=8, # 全体で同時に処理するメンションの束の数
+            max_llm:int=4, # 全体で同時にLLMへ送るリクエストの数
+            coalesce_window:float=0.0, # 空いているチャンネルでもこの秒数だけ続きのメンションを待つ (応答がその分遅れる)
+            max_batch:int=5, # 1回の生成でまとめるメンションの最大数
+        ):
+        self.max_per_channel = max_per_channel
+        self.max_per_guild = max_per_guild
+        self.max_running = max_running
+        self.coalesce_window = coalesce_window
+        self.max_batch = max_batch
+        self._llm = LLMSlots(max_llm)
+        # guild_key -> 実行待ちの束。先頭のギルドから順に見る
+        self._queues: OrderedDict[object, deque[Batch]] = OrderedDict()
+        # channel_id -> まだメンションを追加できる束
+        self._open: dict[int, Batch] = {}
+        self._channel_running: dict[int, int] = {}
+        self._guild_running: dict[object, int] = {}
+        self._running = 0
+        self._waiting = 0 # キューにある束の数
+        self._tasks: set[asyncio.Task] = set()
+        self._timers: dict[Batch, asyncio.TimerHandle] = {}
+        self.stats = {'submitted': 0, 'coalesced': 0, 'started': 0, 'errors': 0}
+
+    def llm(self) -> asyncio.Semaphore:
+        """Usage: async with scheduler.llm(): await llm.ainvoke(...)"""
+        return self._llm
+
+    def pending(self) -> int:
+        """実行待ちの束の数"""
+        return self._waiting
+
+    @property
+    def running(self) -> int:
+        """実行中の束の数"""
+        return self._running
+
+    def llm_free(self) -> int:
+        """空いているLLMの枠の数"""
+        return self._llm.size - self._llm.in_use
+
+    def submit(self, guild_id:int|None, channel_id:int, message, handler, coalesce:bool=True) -> None:
+        """
+        handler: 束のメッセージ (古い順) を受け取るコルーチン関数
+        coalesce: Falseならまとめずに単独で実行する (コマンドなど)
+        """
+        self.stats['submitted'] += 1
+        if coalesce:
+            batch = self._open.get(channel_id)
+            if batch is not None and batch.handler == handler:
+                batch.messages.append(message)
+                self.stats['coalesced'] += 1
+                if len(batch.messages) >= self.max_batch:
+                    del self._open[channel_id]
+                return
+        # DMはチャンネル毎に別のギルドとして扱う
+        guild_key = guild_id if guild_id is not None else ('dm', channel_id)
+        batch = Batch(guild_key, channel_id, message, handler)
+        if not coalesce:
+            self._enqueue(batch)
+            return
+        self._open[channel_id] = batch
+        if self.coalesce_window > 0:
+            self._timers[batch] = asyncio.get_running_loop().call_later(
+                self.coalesce_window, self._on_window, batch)
+            return
+        # 空いていればすぐに開始する。開始できずに待っている間は、続きのメンションをこの束にまとめる
+        self._enqueue(batch)
+
+    def _on_window(self, batch:Batch) -> None:
+        del self._timers[batch]
+        self._enqueue(batch)
+
+    def _enqueue(self, batch:Batch) -> None:
+        self._queues.setdefault(batch.guild_key, deque()).append(batch)
+        self._waiting += 1
+        self._pump()
+
+    def _admissible(self, batch:Batch) -> bool:
+        return self._channel_running.get(batch.channel_id, 0) < self.max_per_channel
+
+    def _pump(self) -> None:
+        """上限に空きがある限り、ギルドを順番に回して束を開始する"""
+        while self._running < self.max_running:
+            for guild_key, queue in self._queues.items():
+                if self._guild_running.get(guild_key, 0) >= self.max_per_guild:
+                    continue
+                batch = next((batch for batch in queue if self._admissible(batch)), None)
+                if batch is None:
+                    continue
+                queue.remove(batch)
+                self._waiting -= 1
+                if queue:
+                    # 開始したギルドは最後に回す
+                    self._queues.move_to_end(guild_key)
+                else:
+                    del self._queues[guild_key]
+                self._start(batch)
+                break
+            else:
+                return
+
+    def _start(self, batch:Batch) -> None:
+        if self._open.get(batch.channel_id) is batch:
+            # 開始後に届いたメンションは次の束にする
+            del self._open[batch.channel_id]
+        self._running += 1
+        self._channel_running[batch.channel_id] = self._channel_running.get(batch.channel_id, 0) + 1
+        self._guild_running[batch.guild_key] = self._guild_running.get(batch.guild_key, 0) + 1
+        self.stats['started'] += 1
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch:Batch) -> None:
+        try:
+            await batch.handler(batch.messages)
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f'request failed: {e}')
+        finally:
+            self._running -= 1
+            self._release(self._channel_running, batch.channel_id)
+            self._release(self._guild_running, batch.guild_key)
+            self._pump()
+
+    @staticmethod
+    def _release(counts:dict, key) -> None:
+        counts[key] -= 1
+        if counts[key] <= 0:
+            del counts[key]
+
+    async def close(self) -> None:
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._queues.clear()
+        self._waiting = 0
+        self._open.clear()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
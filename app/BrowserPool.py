@@ -0,0 +1,190 @@
+import asyncio
+from contextlib import asynccontextmanager
+from collections.abc import AsyncIterator
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from playwright.async_api import Browser, BrowserContext, Page #type:ignore
+
+# playwrightとlangchain_communityは読み込みに時間がかかるので、初めて使うときにimportする
+
+UNWANTED_TAGS = ['script', 'style', 'header', 'footer', 'nav', 'aside', 'form', 'input', 'button', 'select', 'textarea', 'iframe', 'img', 'video', 'audio', 'canvas', 'svg', 'map', 'object', 'embed', 'applet', 'frame', 'frameset', 'noframes', 'base', 'link', 'meta']
+TAGS_TO_EXTRACT = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'li', 'div', 'a', 'span']
+
+def extract_text(html:str, url:str='') -> str:
+    """HTMLから本文らしきテキストを抜き出す (page_loader.pyと同じ変換)"""
+    from langchain_core.documents import Document #type:ignore
+    from langchain_community.document_transformers import BeautifulSoupTransformer #type:ignore
+    bs_transformer = BeautifulSoupTransformer()
+    page_content = bs_transformer.transform_documents(
+        [Document(page_content=html, metadata={'source': url})],
+        unwanted_tags=UNWANTED_TAGS,
+        tags_to_extract=TAGS_TO_EXTRACT,
+    )
+    return page_content[0].page_content
+
+class _BrowserSlot:
+    """起動中のChromium 1つ分の状態"""
+    __slots__ = ('browser', 'contexts', 'pages', 'inflight', 'alive', 'retired')
+
+    def __init__(self, browser:'Browser'):
+        self.browser = browser
+        self.contexts: list['BrowserContext'] = [] # 空いているcontext
+        self.pages = 0 # これまでに開いたページ数
+        self.inflight = 0 # 使用中のページ数
+        self.alive = True
+        self.retired = False
+
+class BrowserPool:
+    """
+    プロセス内で使い回すヘッドレスChromiumのプール。
+    size個のcontextを温めておき、1回の読み込みごとにページを開いて閉じる。
+    Cookieやストレージを別のユーザーの読み込みに持ち越さないように、contextは1回使ったら閉じて
+    代わりの新しいcontextをバックグラウンドで用意する。
+    max_pages_per_browserページを開いたら、またはブラウザが落ちたら新しいブラウザに入れ替える。
+    Usage:
+        pool = BrowserPool(size=2)
+        await pool.warm() # 省略すると最初の読み込み時に起動する
+        html = await pool.load_html('https://example.com')
+        await pool.close()
+    """
+    def __init__(
+            self,
+            size:int=2, # 同時に開けるページ数
+            max_pages_per_browser:int=200, # この数だけページを開いたらブラウザを作り直す
+            page_timeout:float=30.0, # ページ読み込みのタイムアウト(秒)
+            wait_until:str='domcontentloaded',
+            headless:bool=True,
+        ):
+        self.size = size
+        self.max_pages_per_browser = max_pages_per_browser
+        self.page_timeout = page_timeout
+        self.wait_until = wait_until
+        self.headless = headless
+        self._playwright = None
+        self._slot: _BrowserSlot|None = None
+        self._lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(size)
+        self._refills: set[asyncio.Task] = set()
+        self.stats = {'pages': 0, 'launches': 0, 'crashes': 0}
+
+    async def _launch(self) -> _BrowserSlot:
+        if self._playwright is None:
+            from playwright.async_api import async_playwright #type:ignore
+            self._playwright = await async_playwright().start()
+        browser = await self._playwright.chromium.launch(headless=self.headless)
+        slot = _BrowserSlot(browser)
+
+        def on_disconnected(_):
+            if slot.alive:
+                slot.alive = False
+                if not slot.retired:
+                    self.stats['crashes'] += 1
+        browser.on('disconnected', on_disconnected)
+        self.stats['launches'] += 1
+        # 最初の読み込みを待たせないように、contextを先に作っておく
+        for _ in range(self.size):
+            slot.contexts.append(await browser.new_context())
+        return slot
+
+    async def warm(self) -> None:
+        """ブラウザを起動してcontextを用意しておく (起動後にバックグラウンドで呼ぶ)"""
+        await self._current_slot()
+
+    async def _current_slot(self) -> _BrowserSlot:
+        async with self._lock:
+            slot = self._slot
+            if slot is None or not slot.alive or slot.pages >= self.max_pages_per_browser:
+                if slot is not None:
+                    await self._retire(slot)
+                slot = await self._launch()
+                self._slot = slot
+            return slot
+
+    async def _retire(self, slot:_BrowserSlot) -> None:
+        """使用中のページがなくなったらブラウザを閉じる"""
+        slot.retired = True
+        if slot.inflight == 0:
+            await self._close_slot(slot)
+
+    def _refill(self, slot:_BrowserSlot) -> None:
+        """使い終わったcontextの代わりを作っておく"""
+        async def refill():
+            try:
+                context = await slot.browser.new_context()
+            except Exception:
+                return
+            if slot.alive and not slot.retired:
+                slot.contexts.append(context)
+            else:
+                try:
+                    await context.close()
+                except Exception:
+                    pass
+        task = asyncio.create_task(refill())
+        self._refills.add(task)
+        task.add_done_callback(self._refills.discard)
+
+    async def _close_slot(self, slot:_BrowserSlot) -> None:
+        slot.alive = False
+        try:
+            await slot.browser.close()
+        except Exception:
+            pass
+
+    @asynccontextmanager
+    async def page(self) -> AsyncIterator['Page']:
+        """温めておいたcontextで新しいページを借りる (contextは返却時に閉じる)"""
+        async with self._semaphore:
+            slot = await self._current_slot()
+            context = slot.contexts.pop() if slot.contexts else await slot.browser.new_context()
+            page = None
+            try:
+                slot.inflight += 1
+                slot.pages += 1
+                self.stats['pages'] += 1
+                page = await context.new_page()
+                yield page
+            finally:
+                slot.inflight -= 1
+                try:
+                    # Cookieやストレージが残っているので、contextごと閉じる
+                    await context.close()
+                except Exception:
+                    # 閉じられない場合はブラウザごと入れ替える
+                    slot.alive = False
+                if slot.alive and not slot.retired:
+                    self._refill(slot)
+                if slot.retired or not slot.alive:
+                    if slot.inflight == 0:
+                        await self._close_slot(slot)
+
+    async def load_html(self, url:str) -> str:
+        """URLを開いてレンダリング後のHTMLを返す。ブラウザが落ちた場合は1回だけやり直す"""
+        for attempt in range(2):
+            crashes = self.stats['crashes']
+            try:
+                async with self.page() as page:
+                    await page.goto(
+                        url, wait_until=self.wait_until, timeout=self.page_timeout * 1000)
+                    return await page.content()
+            except Exception:
+                if attempt > 0 or self.stats['crashes'] == crashes:
+                    raise
+
+    async def load_text(self, url:str) -> str:
+        html = await self.load_html(url)
+        # BeautifulSoupでのパースは別スレッドで行う
+        return await asyncio.to_thread(extract_text, html, url)
+
+    async def close(self) -> None:
+        for task in list(self._refills):
+            task.cancel()
+        await asyncio.gather(*self._refills, return_exceptions=True)
+        async with self._lock:
+            if self._slot is not None:
+                self._slot.retired = True
+                await self._close_slot(self._slot)
+                self._slot = None
+            if self._playwright is not None:
+                await self._playwright.stop()
+                self._playwright = None
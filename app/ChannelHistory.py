@@ -0,0 +1,131 @@
+from collections import OrderedDict, deque
+from collections.abc import Callable
+from langchain_core.messages import AIMessage, HumanMessage, BaseMessage #type:ignore
+import LangTools
+
+def convert_message(msg) -> BaseMessage:
+    """discord.MessageをHumanMessageかAIMessageに変換する"""
+    content = LangTools.sanitize_mention(msg)
+    if msg.author.bot:
+        return AIMessage(content=content)
+    name = LangTools.get_name(msg.author)
+    return HumanMessage(content=f'{name}: {content}')
+
+class HistoryEntry:
+    __slots__ = ('message_id', 'edited_at', 'converted')
+
+    def __init__(self, message_id:int, edited_at, converted:BaseMessage):
+        self.message_id = message_id
+        self.edited_at = edited_at
+        self.converted = converted
+
+class ChannelBuffer:
+    """1チャンネル分のリングバッファ (古いものから順に並ぶ)"""
+    __slots__ = ('entries', 'warm')
+
+    def __init__(self, maxlen:int):
+        self.entries: deque[HistoryEntry] = deque(maxlen=maxlen)
+        # history()で過去分を取り込み済みか
+        self.warm = False
+
+class ChannelHistory:
+    """
+    on_message / on_message_edit / on_message_delete のイベントから
+    チャンネル毎の直近のメッセージを変換済みの状態で保持する。
+    バッファが温まっていないチャンネルだけchannel.history()で取得する。
+    on_evictを渡すと、バッファの上限で押し出された古いエントリを (channel_id, entry) で渡す (要約への畳み込み用)。
+    """
+    def __init__(
+            self,
+            maxlen:int=50,
+            max_channels:int=1000,
+            on_evict:Callable[[int, HistoryEntry], None]|None=None,
+        ):
+        self.maxlen = maxlen
+        self.max_channels = max_channels
+        self.on_evict = on_evict
+        self._channels: OrderedDict[int, ChannelBuffer] = OrderedDict()
+        self.stats = {'hit': 0, 'cold': 0}
+
+    def _buffer(self, channel_id:int) -> ChannelBuffer:
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            buffer = ChannelBuffer(self.maxlen)
+            self._channels[channel_id] = buffer
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        else:
+            self._channels.move_to_end(channel_id)
+        return buffer
+
+    def _entry(self, msg) -> HistoryEntry:
+        return HistoryEntry(msg.id, msg.edited_at, convert_message(msg))
+
+    def append(self, msg) -> None:
+        buffer = self._buffer(msg.channel.id)
+        if buffer.entries and buffer.entries[-1].message_id == msg.id:
+            return
+        if len(buffer.entries) == self.maxlen and self.on_evict is not None:
+            self.on_evict(msg.channel.id, buffer.entries[0])
+        buffer.entries.append(self._entry(msg))
+
+    def edit(self, msg) -> None:
+        buffer = self._channels.get(msg.channel.id)
+        if buffer is None:
+            return
+        for i, entry in enumerate(buffer.entries):
+            if entry.message_id == msg.id:
+                if entry.edited_at != msg.edited_at:
+                    buffer.entries[i] = self._entry(msg)
+                return
+
+    def delete(self, channel_id:int, message_id:int) -> None:
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        for entry in buffer.entries:
+            if entry.message_id == message_id:
+                buffer.entries.remove(entry)
+                return
+
+    async def recent_entries(self, channel, limit:int|None=None) -> list[HistoryEntry]:
+        """
+        直近limit件 (省略時はバッファ全体) のエントリを新しい順に返す
+        """
+        limit = self.maxlen if limit is None else limit
+        buffer = self._buffer(channel.id)
+        if not buffer.warm and len(buffer.entries) < limit:
+            self.stats['cold'] += 1
+            await self._fill(channel, buffer)
+        else:
+            self.stats['hit'] += 1
+        entries = list(buffer.entries)[-limit:]
+        entries.reverse()
+        return entries
+
+    async def _fill(self, channel, buffer:ChannelBuffer) -> None:
+        """channel.history()で過去分を取り込む。変換済みのものは使い回す"""
+        known = {
+            (entry.message_id, entry.edited_at): entry for entry in buffer.entries}
+        fetched = []
+        async for msg in channel.history(limit=self.maxlen):
+            entry = known.get((msg.id, msg.edited_at))
+            if entry is None:
+                entry = self._entry(msg)
+            fetched.append(entry)
+        fetched.reverse()
+        fetched_ids = {entry.message_id for entry in fetched}
+        # 取得中に届いたイベント分を後ろに残す
+        newer = [entry for entry in buffer.entries if entry.message_id not in fetched_ids
+                 and (not fetched or entry.message_id > fetched[-1].message_id)]
+        entries = fetched + newer
+        if self.on_evict is not None and fetched:
+            # 取得した範囲より古いものと、上限を超えて入りきらないものはバッファから外れる
+            for entry in buffer.entries:
+                if entry.message_id < fetched[0].message_id:
+                    self.on_evict(channel.id, entry)
+            for entry in entries[:max(len(entries) - self.maxlen, 0)]:
+                self.on_evict(channel.id, entry)
+        buffer.entries.clear()
+        buffer.entries.extend(entries)
+        buffer.warm = True
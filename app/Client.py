@@ -1,22 +1,42 @@
 import discord #type:ignore
 import LangTools
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, BaseMessage #type:ignore
+import ReplyStreamer
+import IntentRouter
+import LLMRouter
+import ChannelHistory
+import Scheduler
+import Precompute
+import LeakFilter
+import PromptAssets
+import ContextPacker
+import RollingSummary
+import AdmissionScheduler
+import SemanticCache
+import Metrics
+import Tokenizer
+from langchain_core.messages import AIMessage, BaseMessage #type:ignore
 from langchain_core.language_models import BaseChatModel #type:ignore
-from discord.ext import tasks #type:ignore
-from langchain.prompts import PromptTemplate #type:ignore
-from langchain.chains import ConversationChain, LLMChain #type:ignore
-import base64
-import io
+from langchain_core.prompts import PromptTemplate #type:ignore
 import asyncio
-import aiohttp #type:ignore
-import requests #type:ignore
-from bs4 import BeautifulSoup #type:ignore
 import re
-from typing import List
+from contextlib import aclosing
+from typing import List, Callable, Awaitable
 from datetime import datetime,timedelta
-from langchain.memory import ConversationBufferMemory #type:ignore
-import os
-from langchain_community.utilities import DuckDuckGoSearchAPIWrapper #type:ignore
+
+# 検索 (langchain_community) やHTMLのパース (bs4) は読み込みに時間がかかるので、初めて使うときにimportする
+# 検索・Webページ取得・ブラウザプール・要約のキャッシュとLangModelも、起動を待たせないように初めて使うときにimportして作る
+
+def duckduckgo_search():
+    """DuckDuckGoの検索バックエンド。SearchServiceが初回の検索時にスレッドプールで作る"""
+    from langchain_community.utilities import DuckDuckGoSearchAPIWrapper #type:ignore
+    return DuckDuckGoSearchAPIWrapper(
+        backend="api", #'api': APIモード（通常使用するモード）。'html': HTMLモード（HTMLパーシングによる検索）。'lite': 軽量モード（低リソースモード）。
+        max_results=5, #取得する検索結果の最大件数。
+        region="jp-jp", #地域コード 'wt-wt'（全世界）
+        safesearch="off", #セーフサーチモード
+        source="text", #'text': テキスト検索。'news': ニュース検索。
+        time="w" #'d': 過去1日。'w': 過去1週間。'm': 過去1か月。'y': 過去1年。
+    )
 
 
 class LangchainBot(discord.Client):
@@ -29,22 +49,41 @@ class LangchainBot(discord.Client):
         if 'system_prompt_getter' in kwargs:
             self.system_prompt_getter = kwargs['system_prompt_getter']
             print(self.system_prompt_getter())
+        # プロンプト関係のファイル (PromptAssets) があれば、ギルド毎のシステムプロンプトを使う
+        self.prompt_assets = kwargs.get('prompt_assets', None)
+        # システムプロンプトの漏洩検出
+        self.leak_filter = LeakFilter.LeakFilter(ratio=kwargs.get('leak_ratio', 0.2))
         
         self.system_prompt = None
         if 'system_prompt' in kwargs:
-            self.system_prompt = {
-                "role": "system",
-                "content": kwargs['system_prompt'],
-            }
-        # 検索機能の初期化
-        self.search = DuckDuckGoSearchAPIWrapper(
-            backend="api", #'api': APIモード（通常使用するモード）。'html': HTMLモード（HTMLパーシングによる検索）。'lite': 軽量モード（低リソースモード）。
-            max_results=5, #取得する検索結果の最大件数。
-            region="jp-jp", #地域コード 'wt-wt'（全世界）
-            safesearch="off", #セーフサーチモード
-            source="text", #'text': テキスト検索。'news': ニュース検索。
-            time="w" #'d': 過去1日。'w': 過去1週間。'm': 過去1か月。'y': 過去1年。
-        )
+            self.system_prompt = kwargs['system_prompt']
+        # 複数のワーカープロセスで共有するキャッシュ (SharedStore) 検索結果とページの要約を共有する
+        self.shared_store = kwargs.get('shared_store', None)
+        # 検索はスレッドプールで実行し、同じ検索はまとめてキャッシュする
+        # バックエンドは初回の検索時に作る
+        self.search_options = {
+            'backend_factory': kwargs.get('search_backend_factory', duckduckgo_search),
+            'ttl': kwargs.get('search_cache_ttl', 600.0),
+            'shared': self.shared_store,
+        }
+        self._search_service = None
+        # Webページ取得 (共有セッションとディスクキャッシュ)
+        self.fetcher_options = {
+            'cache_dir': kwargs.get('web_cache_dir', None),
+            'cache_ttl': kwargs.get('web_cache_ttl', 3600.0),
+        }
+        self._fetcher = None
+        # JavaScriptで描画されるページ用のブラウザプール
+        self.browser_pool_size = kwargs.get('browser_pool_size', 2)
+        self._browser_pool = None
+        # 起動後にバックグラウンドでブラウザを起動しておくか (Falseなら初回利用時に起動する)
+        self.browser_prewarm = kwargs.get('browser_prewarm', True)
+        # 静的に取得した本文がこの文字数未満ならブラウザで描画し直す
+        self.render_min_chars = kwargs.get('render_min_chars', 200)
+        # 長いページを切り捨てずに要約するか
+        self.summarize_pages = kwargs.get('summarize_pages', False)
+        # ページ要約のキャッシュ (同じ記事が何度も貼られるため)
+        self._summary_cache = None
         # 分析用プロンプトの設定
         self.query_prompt = PromptTemplate(
             template="""
@@ -62,75 +101,432 @@ class LangchainBot(discord.Client):
             """,
             input_variables=["question"]
         )
-        self.query_chain = self.query_prompt | self.llm
+        # 意図の分析は短い応答で十分なので、生成するトークン数を制限できる
+        analysis_llm = self.llm
+        if kwargs.get('analysis_max_tokens') is not None:
+            analysis_llm = self.llm.bind(max_tokens=kwargs['analysis_max_tokens'])
+        self.query_chain = self.query_prompt | analysis_llm
+        # 意図の判定 (確信度が低い場合だけquery_chainを呼ぶ)
+        self.router = IntentRouter.IntentRouter(
+            fallback=self.analyze_query,
+            threshold=kwargs.get('router_threshold', 0.7),
+        )
+        
+        # チャンネル毎の会話履歴 (イベントから更新する)
+        self.history = ChannelHistory.ChannelHistory(
+            maxlen=kwargs.get('history_buffer_size', 50))
+        
+        # 会話履歴をトークン数の予算に収める
+        self.context_packer = ContextPacker.ContextPacker.for_model(
+            self.llm, 
+            max_prompt_tokens=kwargs.get('max_prompt_tokens', 6000))
+        
+        # メンションへの応答の同時実行数の制限と、連続したメンションのまとめ
+        self.admission = AdmissionScheduler.AdmissionScheduler(
+            max_per_channel=kwargs.get('max_per_channel', 1),
+            max_per_guild=kwargs.get('max_per_guild', 2),
+            max_running=kwargs.get('max_running', 8),
+            max_llm=kwargs.get('max_llm_requests', 4),
+            # 0なら空いているチャンネルのメンションはすぐに開始し、待っている間に届いた分だけをまとめる
+            coalesce_window=kwargs.get('coalesce_window', 0.0),
+        )
+        
+        # 直近の履歴からはみ出した会話のチャンネル毎の要約
+        self.rolling_summary = None
+        if kwargs.get('rolling_summary', True):
+            self.rolling_summary = RollingSummary.RollingSummary(
+                self.llm,
+                RollingSummary.SummaryStore(kwargs.get('memory_db_path', 'data/memory.sqlite3')),
+                limiter=self.admission.llm(),
+            )
+            # バッファから押し出された会話も要約に畳み込む
+            self.history.on_evict = self.rolling_summary.evicted
+        
+        # 返信で生成する最大トークン数 (Noneならモデルの既定値)
+        self.llm_kwargs = {}
+        if kwargs.get('max_reply_tokens') is not None:
+            self.llm_kwargs['max_tokens'] = kwargs['max_reply_tokens']
         
-        # スケジュールされたメッセージのリスト
-        self.scheduled_messages = []
-        # スケジューラの設定
-        # self.scheduler = AsyncIOScheduler()
-        # self.scheduler.start()
+        # 起動時に読み込んでおき、定期的にアンロードされないようにするOllamaのモデル (LangModel)
+        self.warm_models = kwargs.get('warm_models', [])
+        # keep-warmの間隔(秒) Noneなら起動時の読み込みだけ
+        self.keep_warm_interval = kwargs.get('keep_warm_interval', 240.0)
+        # keep-warmを行う時間帯 (開始時, 終了時) Noneなら常に
+        self.keep_warm_hours = kwargs.get('keep_warm_hours', None)
+        self.background_tasks: list[asyncio.Task] = []
+        # プロセスの起動時刻 (time.monotonic()) 指定するとon_readyまでの時間を記録する
+        self.started_at = kwargs.get('started_at', None)
+        
+        # 返信をストリーミングで逐次編集するか
+        self.stream_reply = kwargs.get('stream_reply', False)
+        # ストリーミング時のメッセージ編集間隔(秒)
+        self.stream_edit_interval = kwargs.get('stream_edit_interval', 1.0)
+        
+        # 繰り返される質問への返答のキャッシュ (埋め込みモデルは起動時にバックグラウンドで読み込む)
+        self.answer_cache = None
+        if kwargs.get('answer_cache', True):
+            self.answer_cache = SemanticCache.SemanticCache(
+                threshold=kwargs.get('answer_cache_threshold', None),
+                chat_ttl=kwargs.get('answer_cache_chat_ttl', 6 * 60 * 60),
+                search_ttl=kwargs.get('answer_cache_search_ttl', 30 * 60),
+            )
+        # 'channel'ならチャンネル毎、'guild'ならギルド全体でキャッシュを共有する
+        self.answer_cache_scope = kwargs.get('answer_cache_scope', 'channel')
+        # 通常の会話の返答は、発言者・要約・直前のこの件数のメッセージが同じ場合だけキャッシュを使う
+        self.answer_cache_context_turns = kwargs.get('answer_cache_context_turns', 4)
+        
+        # Prometheus形式のメトリクスを公開するポート (Noneなら公開しない)
+        self.metrics_port = kwargs.get('metrics_port', None)
+        self.metrics_runner = None
+        # メトリクスのラベルに使うLLMの名前
+        self.llm_name = Tokenizer.model_name_of(self.llm) or type(self.llm).__name__
+        # LLMRouterはバックエンド毎にエラーを数えるので、ここでは数えない
+        self.count_llm_errors = not isinstance(self.llm, LLMRouter.LLMRouter)
+        
+        # スケジュールされたメッセージ (SQLiteに保存して再起動後も復元する)
+        self.scheduler = Scheduler.Scheduler(
+            Scheduler.JobStore(kwargs.get('schedule_db_path', 'data/schedule.sqlite3')),
+            handler=self.run_scheduled_job,
+            preparer=self.prepare_scheduled_job,
+            # 予定時刻の何秒前から検索と返信の生成を始めるか (0なら事前生成しない)
+            lead_time=kwargs.get('schedule_lead_time', 300.0),
+            on_cancel=self.discard_scheduled_job,
+        )
+        # 定期投稿の事前生成
+        self.precomputer = Precompute.Precomputer(
+            refresh=kwargs.get('schedule_refresh', True))
+        self.register_metrics()
+
+    @property
+    def search_service(self):
+        if self._search_service is None:
+            import SearchService
+            self._search_service = SearchService.SearchService(**self.search_options)
+        return self._search_service
+
+    @property
+    def fetcher(self):
+        if self._fetcher is None:
+            import WebFetcher
+            self._fetcher = WebFetcher.WebFetcher(**self.fetcher_options)
+        return self._fetcher
+
+    @property
+    def browser_pool(self):
+        if self._browser_pool is None:
+            import BrowserPool
+            self._browser_pool = BrowserPool.BrowserPool(size=self.browser_pool_size)
+        return self._browser_pool
+
+    @property
+    def summary_cache(self):
+        if self._summary_cache is None:
+            import SummaryCache
+            self._summary_cache = SummaryCache.SummaryCache(shared=self.shared_store)
+        return self._summary_cache
+
+    @staticmethod
+    def llm_session(key):
+        """LangModelのHTTPセッションを会話毎に分ける (LangModel.session)"""
+        import LangModel
+        return LangModel.session(key)
+
+    def register_metrics(self):
+        """各部品のstatsとキューの長さをメトリクスとして読み出せるようにする"""
+        components = {
+            'router': self.router,
+            'history': self.history,
+            'leak_filter': self.leak_filter,
+            'admission': self.admission,
+            'precompute': self.precomputer,
+            'answer_cache': self.answer_cache,
+            'rolling_summary': self.rolling_summary,
+            'context_packer': self.context_packer,
+        }
+        for name, component in components.items():
+            if component is not None:
+                Metrics.COMPONENT_EVENTS.register(name, lambda component=component: component.stats)
+        # 初めて使うときに作る部品は、作るまで空のstatsを返す
+        lazy_components = {
+            'fetcher': '_fetcher',
+            'browser_pool': '_browser_pool',
+            'summary_cache': '_summary_cache',
+            'search': '_search_service',
+        }
+        for name, attribute in lazy_components.items():
+            Metrics.COMPONENT_EVENTS.register(
+                name, lambda attribute=attribute: getattr(getattr(self, attribute), 'stats', {}))
+        for lang_model in self.warm_models:
+            # プロンプトキャッシュで省けたトークン数と時間
+            Metrics.COMPONENT_EVENTS.register(
+                f'ollama_{lang_model.model_name}', lambda lang_model=lang_model: lang_model.stats)
+        Metrics.QUEUE_DEPTH.set_function(self.admission.pending, queue='admission_waiting')
+        Metrics.QUEUE_DEPTH.set_function(lambda: self.admission.running, queue='admission_running')
+        Metrics.QUEUE_DEPTH.set_function(self.admission.llm_free, queue='llm_free_slots')
+        Metrics.QUEUE_DEPTH.set_function(self.scheduler.count, queue='scheduled')
         
     def extract_urls(self, text: str) -> List[str]:
         """URLを検出する関数"""
         url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
         return re.findall(url_pattern, text)
 
-    async def get_webpage_content(self, url: str) -> str:
-        """Webページの内容を取得する関数"""
+    async def get_webpage_content(self, url: str, fresh: bool=False) -> str:
+        """Webページの内容を取得する関数 (freshがTrueならキャッシュを使わずにサーバーに確認する)"""
         try:
-            response = requests.get(url)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            for script in soup(["script", "style"]):
-                script.decompose()
-            text = soup.get_text()
-            lines = (line.strip() for line in text.splitlines())
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            text = ' '.join(chunk for chunk in chunks if chunk)
+            with Metrics.span('fetch'):
+                result = await self.fetcher.fetch(url, fresh=fresh)
+                # HTMLのパースはイベントループを止めないように別スレッドで行う
+                text = await asyncio.to_thread(self.html_to_text, result.text)
+            if len(text) < self.render_min_chars and result.content_type != 'text/plain':
+                with Metrics.span('render'):
+                    text = await self.browser_pool.load_text(url)
+            if self.summarize_pages and len(text) > 5000:
+                # 取得済みの本文を要約する (描画が必要な場合は共有のブラウザプールを使う)
+                with Metrics.span('summarize'):
+                    text, _ = await LangTools.asummarize(
+                        url,
+                        self.llm,
+                        browser_pool=self.browser_pool,
+                        summarize_token_budget=3000,
+                        cache=self.summary_cache,
+                        page_content=text,
+                        limiter=self.admission.llm(),
+                    )
             return text[:5000]
         except Exception as e:
             return f"Error fetching webpage: {str(e)}"
 
+    @staticmethod
+    def html_to_text(html: str) -> str:
+        from bs4 import BeautifulSoup #type:ignore
+        soup = BeautifulSoup(html, 'html.parser')
+        for script in soup(["script", "style"]):
+            script.decompose()
+        text = soup.get_text()
+        lines = (line.strip() for line in text.splitlines())
+        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+        return ' '.join(chunk for chunk in chunks if chunk)
+
+    async def analyze_query(self, prompt: str) -> IntentRouter.Route:
+        """分析用プロンプトでLLMに意図を判定させる"""
+        with Metrics.span('analyze'):
+            async with self.admission.llm():
+                analysis = await self.query_chain.ainvoke(prompt)
+        # AIMessageからcontentを取得
+        content = analysis.content if hasattr(analysis, 'content') else str(analysis)
+        return IntentRouter.parse_analysis(content, prompt)
+
+    async def close(self):
+        for task in self.background_tasks:
+            task.cancel()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await self.admission.close()
+        if self._fetcher is not None:
+            await self._fetcher.close()
+        if self._browser_pool is not None:
+            await self._browser_pool.close()
+        if self._search_service is not None:
+            self._search_service.close()
+        # 検索結果と要約の共有キャッシュ (SQLiteかRedisの接続)
+        if self.shared_store is not None:
+            self.shared_store.close()
+        await self.scheduler.stop()
+        self.scheduler.store.close()
+        if self.rolling_summary is not None:
+            await self.rolling_summary.close()
+        # Ollamaへの共有セッション
+        import LangModel
+        await LangModel.close_sessions()
+        await super().close()
+
+    async def setup_hook(self):
+        # スケジュールタスクの開始 (on_readyは再接続のたびに呼ばれるのでここで行う)
+        count = self.scheduler.load(owns=self.owns_job)
+        print(f'{count} scheduled messages restored')
+        self.background_tasks.append(asyncio.create_task(self.start_scheduler()))
+        if self.prompt_assets is not None:
+            # プロンプトの変更をバックグラウンドで監視する
+            self.background_tasks.append(asyncio.create_task(self.prompt_assets.watch()))
+        for lang_model in self.warm_models:
+            self.background_tasks.append(asyncio.create_task(self.warm_model(lang_model)))
+        if self.browser_prewarm:
+            self.background_tasks.append(asyncio.create_task(self.warm_browser()))
+        if self.answer_cache is not None:
+            # 埋め込みモデルのダウンロードを最初の質問で待たせない
+            self.background_tasks.append(asyncio.create_task(self.answer_cache.load()))
+        if self.metrics_port is not None:
+            self.metrics_runner = await Metrics.serve(port=self.metrics_port)
+            print(f'metrics on http://127.0.0.1:{self.metrics_port}/metrics')
+
+    async def warm_model(self, lang_model):
+        """モデルを読み込ませてから、keep_warm_interval毎にアンロードされないようにする"""
+        try:
+            elapsed = await lang_model.warm_up()
+            print(f'{lang_model.model_name} loaded in {elapsed:.1f}s')
+        except Exception as e:
+            print(f'warm up failed: {e}')
+        if self.keep_warm_interval is not None:
+            await asyncio.sleep(self.keep_warm_interval)
+            await lang_model.keep_warm(self.keep_warm_interval, self.keep_warm_hours)
+
+    async def warm_browser(self):
+        """最初のページの描画を待たせないように、ブラウザとcontextを用意しておく"""
+        try:
+            await self.browser_pool.warm()
+        except Exception as e:
+            print(f'browser warm up failed: {e}')
+
+    async def start_scheduler(self):
+        await self.wait_until_ready()  # Botが起動して準備完了するまで待機
+        self.scheduler.start()
+
     async def on_ready(self):
         print(f'Logged on as {self.user}!')
-        # スケジュールタスクの開始
-        self.check_scheduled_messages.start()
+        if self.started_at is not None:
+            # 再接続のたびに呼ばれるので最初の1回だけ
+            elapsed = Metrics.mark_startup('ready', self.started_at)
+            self.started_at = None
+            print(f'ready in {elapsed:.2f}s')
     
-    async def generate_chat_prompt(self, message, history_limit:int=10) -> list[BaseMessage]:
-        messages: list[BaseMessage] = []
-        messages_generator = message.channel.history(limit=history_limit)
+    async def generate_chat_prompt(
+            self, 
+            message, 
+            history_limit:int|None=None, 
+            extra:str|None=None) -> list[BaseMessage]:
+        """
+        会話履歴をトークン数の予算に収まるだけ新しい順に詰める。
+        history_limitで件数の上限を指定する。extra (検索結果など) は予算に収まるように切り詰めて最後に追加する。
+        """
         # メッセージを取得 (最新のメッセージから取得)
-        # messageを取得するたびに、HumanMessageかAIMessageに変換してmessagesに追加
-        async for msg in messages_generator:
-            content = LangTools.sanitize_mention(msg)
-            if msg.author.bot:
-                messages.append(AIMessage(content=content))
-            else:
-                name = LangTools.get_name(msg.author)
-                name = name+': '
-                messages.append(HumanMessage(content=f'{name}{content}'))
+        # 変換済みのHumanMessageかAIMessageがリングバッファから返る
+        with Metrics.span('history'):
+            entries = await self.history.recent_entries(message.channel, history_limit)
         
         # システムプロンプトを追加
-        if self.system_prompt_getter is not None:
+        if self.prompt_assets is not None:
+            guild_id = message.guild.id if message.guild is not None else None
+            self.system_prompt = self.prompt_assets.system_prompt(guild_id)
+        elif self.system_prompt_getter is not None:
             self.system_prompt = self.system_prompt_getter()
-        if self.system_prompt is not None:
-            messages.append(SystemMessage(content=self.system_prompt))
-        messages.reverse()
-        
+        system_prompt = self.system_prompt
+        summary = None
+        if self.rolling_summary is not None:
+            summary = self.rolling_summary.get(message.channel.id)
+        if summary is not None:
+            # 古い会話は要約として先頭に入れる
+            system_prompt = f'{system_prompt or ""}\n\n# これまでの会話の要約\n{summary}'
+        # チャンネル毎に先頭を固定して、LLMサーバーのプロンプトキャッシュが効くようにする
+        messages, dropped = self.context_packer.pack_with_dropped(
+            entries, system_prompt, extra=extra, session=message.channel.id)
+        if self.rolling_summary is not None:
+            # はみ出した分は返信とは別に要約へ畳み込む
+            self.rolling_summary.schedule_fold(message.channel.id, dropped, before=message.id)
         return messages
     
-    async def generate_reply(self, message, history_limit:int=10) -> str:
+    async def generate_reply(
+            self, 
+            message, 
+            history_limit:int|None=None, 
+            prefix:str='', 
+            on_complete:Callable[[str], Awaitable[None]]|None=None) -> str|None:
+        """
+        会話履歴から返信を生成する。
+        ストリーミングモードでは返信を送信済みにしてNoneを返す。
+        on_completeには (prefixを除いた) 生成した全文が渡される。
+        """
+        if self.stream_reply:
+            messages = await self.generate_chat_prompt(message, history_limit)
+            response = await self.stream_to_reply(message, messages, prefix)
+            if on_complete is not None:
+                await on_complete(response)
+            return None
         async with message.channel.typing():
             messages: list[BaseMessage] = await self.generate_chat_prompt(
                 message, history_limit)
-            response: AIMessage = await self.llm.ainvoke(messages)
-            # print(str(response))
-            response = response.content
+            with self.llm_session(message.channel.id):
+                response = await self.invoke_llm(messages)
             print(str(response))
             response = LangTools.sanitize_breakrow(response)
+        if on_complete is not None:
+            await on_complete(response)
+
+        return f'{prefix}{response}'
 
+    async def stream_to_reply(self, message, messages:list[BaseMessage], prefix:str='') -> str:
+        """llm.astreamの出力でプレースホルダーの返信を逐次編集する"""
+        streamer = ReplyStreamer.ReplyStreamer(
+            message, 
+            prefix=prefix, 
+            edit_interval=self.stream_edit_interval,
+            scanner=self.leak_filter.scanner(self.leak_keywords(message)))
+        await streamer.start()
+        with Metrics.span('generate', stream=True), self.llm_session(message.channel.id):
+            async with self.admission.llm():
+                # チャンクのメタデータ (使ったバックエンドとトークン数) をまとめる
+                merged = None
+                try:
+                    # 打ち切ったらすぐにストリームを閉じて、サーバーに生成を止めさせる
+                    async with aclosing(self.llm.astream(messages, **self.llm_kwargs)) as stream:
+                        async for chunk in stream:
+                            merged = chunk if merged is None else merged + chunk
+                            if not await streamer.feed(chunk.content):
+                                # 漏洩を検出したので生成を打ち切る
+                                break
+                except Exception:
+                    if self.count_llm_errors:
+                        Metrics.LLM_ERRORS.inc(backend=self.llm_name)
+                    # プレースホルダーの「…」を残さない
+                    await streamer.fail()
+                    raise
+        response = await streamer.finish()
+        self.record_usage(messages, streamer.text, merged)
+        print(response)
         return response
+
+    async def invoke_llm(self, messages:list[BaseMessage]) -> str:
+        """全体の同時実行数の枠を取ってからLLMを呼び、処理時間とトークン数を記録する"""
+        with Metrics.span('generate'):
+            async with self.admission.llm():
+                try:
+                    response: AIMessage = await self.llm.ainvoke(messages, **self.llm_kwargs)
+                except Exception:
+                    if self.count_llm_errors:
+                        Metrics.LLM_ERRORS.inc(backend=self.llm_name)
+                    raise
+        self.record_usage(messages, response.content, response)
+        return response.content
+
+    def record_usage(self, messages:list[BaseMessage], text:str, response=None):
+        """usage_metadataがあればそれを、なければトークナイザでの概算をトークン数として記録する"""
+        usage = getattr(response, 'usage_metadata', None)
+        metadata = getattr(response, 'response_metadata', None) or {}
+        backend = metadata.get('backend') or metadata.get('model_name') or self.llm_name
+        if usage:
+            Metrics.record_usage(backend, usage.get('input_tokens', 0), usage.get('output_tokens', 0))
+            return
+        tokenizer = self.context_packer.tokenizer
+        prompt_tokens = sum(
+            tokenizer.count(message.content) + tokenizer.message_overhead for message in messages)
+        Metrics.record_usage(backend, prompt_tokens, tokenizer.count(text))
     
-    async def schedule_message(self, time: str, message_content: str, message):
+    def leak_keywords(self, message) -> list[str]:
+        guild_id = message.guild.id if message.guild is not None else None
+        assets = self.prompt_assets if self.prompt_assets is not None else PromptAssets.default()
+        return assets.keywords(guild_id)
+
+    async def send_reply(self, message, reply: str):
+        """全ての返信はここを通して、システムプロンプトの漏洩を検閲する"""
+        reply = self.leak_filter.censor(reply, self.leak_keywords(message))
+        with Metrics.span('send'):
+            return await message.reply(reply)
+
+    async def schedule_message(
+            self, 
+            time: str, 
+            message_content: str, 
+            message, 
+            recurrence: float|None=None) -> Scheduler.ScheduledJob|None:
         """指定の時間にメッセージを送信するためにスケジュールする"""
         try:
             scheduled_time = datetime.strptime(time, "%H:%M")
@@ -139,47 +535,82 @@ class LangchainBot(discord.Client):
             if scheduled_time < now:
                 scheduled_time += timedelta(days=1)
 
-            # スケジュールリストにメッセージと送信時間を追加
-            self.scheduled_messages.append({
-                "time": scheduled_time,
-                "content": message_content,
-                "message": message
-            })
-            #await message.channel.send(f"{time} にメッセージをスケジュールしました")        
+            # ジョブにはメッセージ自体ではなくIDを保存する
+            return await self.scheduler.add(Scheduler.ScheduledJob(
+                job_id=None,
+                channel_id=message.channel.id,
+                message_id=message.id,
+                content=message_content,
+                due=scheduled_time.timestamp(),
+                recurrence=recurrence,
+                guild_id=message.guild.id if message.guild is not None else None,
+            ))
         except ValueError:
             await message.channel.send("時間の形式が正しくありません。'HH:MM'形式で指定してください。")
+            return None
 
-    @tasks.loop(minutes=1)
-    async def check_scheduled_messages(self):
-        """1分ごとにスケジュールされたメッセージをチェックして送信"""
-        now = datetime.now()
-        to_send = [msg for msg in self.scheduled_messages if msg["time"] <= now]
+    def owns_job(self, job: Scheduler.ScheduledJob) -> bool:
+        """
+        このプロセスのシャードのジョブか。
+        シャードを分けて複数のプロセスで動かす場合に、同じジョブを2回送らないようにする
+        """
+        shard_ids = getattr(self, 'shard_ids', None)
+        if shard_ids is None or not self.shard_count:
+            return True
+        # DMと、guild_idを保存する前のジョブはシャード0が受け持つ
+        if job.guild_id is None:
+            return 0 in shard_ids
+        return (job.guild_id >> 22) % self.shard_count in shard_ids
 
-        for msg in to_send:
-            await self.send_scheduled_message(msg["content"], msg["message"])
-            self.scheduled_messages.remove(msg)
-    
-    @check_scheduled_messages.before_loop
-    async def before_check_scheduled_messages(self):
-        await self.wait_until_ready()  # Botが起動して準備完了するまで待機
+    async def fetch_job_message(self, job: Scheduler.ScheduledJob):
+        """保存されたIDからメッセージを取得し直す"""
+        channel = self.get_channel(job.channel_id)
+        if channel is None:
+            channel = await self.fetch_channel(job.channel_id)
+        return await channel.fetch_message(job.message_id)
 
-    async def send_scheduled_message(self,message_content: str,message):
-        analysis = await self.query_chain.ainvoke(message_content)
-        # AIMessageからcontentを取得
-        content = analysis.content if hasattr(analysis, 'content') else str(analysis)
+    async def prepare_scheduled_job(self, job: Scheduler.ScheduledJob):
+        """予定時刻より前に検索と返信の生成を始めておく"""
+        async def generate(research):
+            message = await self.fetch_job_message(job)
+            return await self.compose_scheduled_reply(message, research)
+        # 予定時刻の処理がtake()するより前に登録されるように、awaitせずに登録する
+        self.precomputer.prepare(
+            self.precomputer.key(job.channel_id, job.content),
+            job.due,
+            research=lambda fresh: self.research_scheduled(job.content, fresh=fresh),
+            generate=generate,
+        )
+
+    def discard_scheduled_job(self, job: Scheduler.ScheduledJob):
+        """キャンセルされたジョブの事前生成を止める"""
+        self.precomputer.discard(self.precomputer.key(job.channel_id, job.content), job.due)
+
+    async def run_scheduled_job(self, job: Scheduler.ScheduledJob):
+        Metrics.new_request()
+        with Metrics.span('scheduled', job_id=job.job_id):
+            message = await self.fetch_job_message(job)
+            await self.send_scheduled_message(job.content, message, due=job.due)
+
+    async def research_scheduled(self, message_content: str, fresh: bool=False) -> tuple[str, str]|None:
+        """
+        定期投稿に使う (プロンプト, 見出し) を検索やWebページから用意する。
+        freshがTrueなら検索とWebページのキャッシュを使わない (事前生成の更新用)
+        """
+        route = await self.router.aroute(message_content)
         # urlを含むか確認
-        has_url = "HAS_URL: true" in content
-        if has_url:
-            urls = self.extract_urls(message_content)
+        if route.kind == IntentRouter.URL:
+            urls = route.urls
             if urls:
-                    webpage_content = await self.get_webpage_content(urls[0])
+                    webpage_content = await self.get_webpage_content(urls[0], fresh=fresh)
                     prompt_with_content = f"以下のWebページの内容に基づいて今話題のものや動画にできそうな事をもとに動画の台本とタイトルを生成してください。広告や関連記事などに気を取られないでください。\n\nWebページ内容: {webpage_content}\n\n質問: {message_content}"
-                    reply1 = await self.generate_web(message,prompt_with_content)
-                    reply = f"**URLを要約中...**\n\n{reply1}"
+                    return (prompt_with_content, "**URLを要約中...**\n\n")
         else :
-            search_query = re.search(r'SEARCH_QUERY: (.*)', content)
+            # 定期投稿は常に検索結果をもとにする
+            search_query = route.search_query or IntentRouter.to_search_query(message_content)
             if search_query:
-                search_results = self.search.run(search_query.group(1))
+                with Metrics.span('search'):
+                    search_results = await self.search_service.run(search_query, fresh=fresh)
                 prompt_with_search = f"""以下の検索結果の内容に基づいて適切な返答を考えてください。広告や関連記事などに気を取られないでください。
                 できるだけ最新の情報を含めて回答してください。今話題のものや動画にできそうな事をもとに動画の台本とタイトルを生成してください。
 
@@ -187,20 +618,72 @@ class LangchainBot(discord.Client):
 
                 質問: {message_content}
                 """
-                reply1 = await self.generate_web(message,prompt_with_search)
-                reply = f"**Webを検索中...**\n\n{reply1}"
-        await message.reply(reply)
+                return (prompt_with_search, "**Webを検索中...**\n\n")
+        return None
+
+    async def compose_scheduled_reply(self, message, research: tuple[str, str]|None) -> str|None:
+        """事前生成用。ストリーミングせずに返信の全文を返す"""
+        if research is None:
+            return None
+        prompt, prefix = research
+        return await self.generate_web(message, prompt, prefix=prefix, stream=False)
+
+    async def send_scheduled_message(self, message_content: str, message, due: float|None=None):
+        reply = None
+        prepared = None
+        if due is not None:
+            prepared = await self.precomputer.take(
+                self.precomputer.key(message.channel.id, message_content), due)
+        if prepared is not None and prepared.text is not None:
+            reply = prepared.text
+        else:
+            research = await self.research_scheduled(message_content)
+            if research is not None:
+                prompt, prefix = research
+                reply = await self.generate_web(message, prompt, prefix=prefix)
+        if reply is not None:
+            await self.send_reply(message, reply)
 
     
-    async def generate_web(self, message, prompt, history_limit=10) -> str:
-        messages = await self.generate_chat_prompt(message, history_limit)
-        messages.append(HumanMessage(content=prompt))
-        response = await self.llm.ainvoke(messages)
-        print(response.content)
-        response = LangTools.sanitize_breakrow(response.content)
-        return response
+    async def generate_web(
+            self, 
+            message, 
+            prompt, 
+            history_limit=None, 
+            prefix:str='', 
+            stream:bool|None=None,
+            on_complete:Callable[[str], Awaitable[None]]|None=None) -> str|None:
+        """
+        検索結果やWebページの内容を含むpromptで返信を生成する。
+        ストリーミングモードでは返信を送信済みにしてNoneを返す。
+        on_completeには (prefixを除いた) 生成した全文が渡される。
+        """
+        if stream is None:
+            stream = self.stream_reply
+        # promptは予算に収まるように切り詰められて最後に入る
+        messages = await self.generate_chat_prompt(message, history_limit, extra=prompt)
+        if stream:
+            response = await self.stream_to_reply(message, messages, prefix)
+        else:
+            with self.llm_session(message.channel.id):
+                response = await self.invoke_llm(messages)
+            print(response)
+            response = LangTools.sanitize_breakrow(response)
+        if on_complete is not None:
+            await on_complete(response)
+        if stream:
+            return None
+        return f'{prefix}{response}'
+
+    async def on_message_edit(self, before, after):
+        self.history.edit(after)
+
+    async def on_message_delete(self, message):
+        self.history.delete(message.channel.id, message.id)
 
     async def on_message(self, message):
+        # 自分やbotの発言も会話履歴には残す
+        self.history.append(message)
         if message.author.bot or message.author == self.user:
             return
         # メンションされているユーザーのリストを取得
@@ -208,40 +691,118 @@ class LangchainBot(discord.Client):
         # 特定のユーザーがメンションされているか確認
         if self.user not in mentioned_users:
             return
-        # メンションを除去してプロンプトを取得
+        command_content = message.content.replace(f'<@{self.user.id}>', '').strip()
+        # 同じチャンネルで続けて届いたメンションは1回の返信にまとめる (コマンドはまとめない)
+        guild_id = message.guild.id if message.guild is not None else None
+        self.admission.submit(
+            guild_id,
+            message.channel.id,
+            message,
+            self.respond,
+            coalesce=not command_content.startswith('!'),
+        )
+
+    @staticmethod
+    def strip_mentions(message) -> str:
+        """メンションを除去してプロンプトを取得"""
         prompt = message.content
         for mention in message.mentions:
             prompt = prompt.replace(f'<@{mention.id}>', '').replace(f'<@!{mention.id}>', '')
-        prompt = prompt.strip()
-        # 質問の分析
-        analysis = await self.query_chain.ainvoke(prompt)
-        # AIMessageからcontentを取得
-        content = analysis.content if hasattr(analysis, 'content') else str(analysis)
-        needs_search = "NEEDS_SEARCH: true" in content
-        # urlを含むか確認
-        has_url = "HAS_URL: true" in content
+        return prompt.strip()
+
+    def answer_scope(self, message):
+        if self.answer_cache_scope == 'guild' and message.guild is not None:
+            return ('guild', message.guild.id)
+        return ('channel', message.channel.id)
+
+    async def answer_context(self, messages: list) -> str:
+        """
+        通常の会話の返答は会話の流れに依存するので (「明日は？」「今何て言った？」など)、
+        発言者、チャンネルの要約、直前の会話をキャッシュの文脈にする
+        """
+        first = messages[0]
+        entries = await self.history.recent_entries(
+            first.channel, self.answer_cache_context_turns + len(messages))
+        before = [
+            entry.converted.content for entry in entries 
+            if entry.message_id < first.id][:self.answer_cache_context_turns]
+        summary = None
+        if self.rolling_summary is not None:
+            summary = self.rolling_summary.get(first.channel.id)
+        return SemanticCache.context_key(str(messages[-1].author.id), summary or '', *before)
+
+    async def cached_answer(self, message, question: str, kind: str, context: str='') -> str|None:
+        if self.answer_cache is None:
+            return None
+        return await self.answer_cache.lookup(self.answer_scope(message), question, kind, context)
+
+    def answer_recorder(
+            self, 
+            message, 
+            question: str, 
+            kind: str, 
+            context: str='') -> Callable[[str], Awaitable[None]]|None:
+        """生成した返答をキャッシュに保存するon_completeを返す"""
+        if self.answer_cache is None:
+            return None
+        async def record(text: str) -> None:
+            # 検閲した返答や漏洩を含む返答は保存しない
+            if not text or text == LeakFilter.CENSORED:
+                return
+            if self.leak_filter.is_leaked(text, self.leak_keywords(message)):
+                return
+            await self.answer_cache.store(self.answer_scope(message), question, kind, text, context)
+        return record
+
+    async def respond(self, messages: list):
+        """
+        まとめられたメンション (古い順) にまとめて返信する。
+        返信は最後のメッセージに対して行い、プロンプトは全てのメンションをつなげたものにする。
+        """
+        # 以降のスパンは同じリクエストIDでトレースされる
+        Metrics.new_request()
+        with Metrics.span('request', channel=messages[-1].channel.id, batch=len(messages)):
+            await self.answer(messages)
+
+    async def answer(self, messages: list):
+        message = messages[-1]
+        prompt = '\n'.join(self.strip_mentions(msg) for msg in messages)
+        reply = None
         command_content = message.content.replace(f'<@{self.user.id}>', '').strip()
-        if command_content.startswith("!schedule"):
+        # 質問の分析 (ローカルで判定できない場合だけLLMで分析する)
+        with Metrics.span('route'):
+            route = await self.router.aroute(prompt, command_content)
+        Metrics.REQUESTS.inc(route=route.kind)
+        if route.kind == IntentRouter.SCHEDULE:
                 new_content = command_content[len('!schedule '):].strip()
-                match = re.match(r"(\d{2}:\d{2}) (.+)", new_content)
+                match = re.match(r"(?:(毎日|daily) )?(\d{2}:\d{2}) (.+)", new_content)
                 if match:
-                    time = match.group(1)
-                    message_content = match.group(2)
-                    await self.schedule_message(time, message_content,message)
-                    reply = f"{time} にメッセージをスケジュールしました"
+                    recurrence = 24 * 60 * 60 if match.group(1) else None
+                    time = match.group(2)
+                    message_content = match.group(3)
+                    job = await self.schedule_message(
+                        time, message_content, message, recurrence=recurrence)
+                    if job is not None:
+                        every = "毎日 " if recurrence else ""
+                        reply = f"{every}{time} にメッセージをスケジュールしました"
                 else:
-                    reply = "形式が正しくありません。`!schedule 時間 メッセージ` の形式で入力してください。"
-        elif has_url:
-            urls = self.extract_urls(prompt)
+                    reply = "形式が正しくありません。`!schedule [毎日] 時間 メッセージ` の形式で入力してください。"
+        elif route.kind == IntentRouter.URL:
+            urls = route.urls
             if urls:
                     webpage_content = await self.get_webpage_content(urls[0])
                     prompt_with_content = f"以下のWebページの内容に基づいて動画の台本とタイトルを生成してください。広告や関連記事などに気を取られないでください。\n\nWebページ内容: {webpage_content}\n\n質問: {prompt}"
-                    reply1 = await self.generate_web(message,prompt_with_content)
-                    reply = f"**URLを要約中...**\n\n{reply1}"
-        elif needs_search:
-            search_query = re.search(r'SEARCH_QUERY: (.*)', content)
-            if search_query:
-                search_results = self.search.run(search_query.group(1))
+                    reply = await self.generate_web(
+                        message, prompt_with_content, prefix="**URLを要約中...**\n\n")
+        elif route.kind == IntentRouter.SEARCH:
+            search_query = route.search_query
+            # 同じ質問への最近の返答があれば検索もしない
+            cached = await self.cached_answer(message, prompt, SemanticCache.SEARCH)
+            if cached is not None:
+                reply = f"**Webを検索中...**\n\n{cached}"
+            elif search_query:
+                with Metrics.span('search'):
+                    search_results = await self.search_service.run(search_query)
                 prompt_with_search = f"""以下の検索結果の内容に基づいて適切な返答を考えてください。広告や関連記事などに気を取られないでください。
                 できるだけ最新の情報を含めて回答してください。今話題のものや動画にできそうな事をもとに動画の台本とタイトルを生成してください。
 
@@ -249,9 +810,25 @@ class LangchainBot(discord.Client):
 
                 質問: {prompt}
                 """
-                reply1 = await self.generate_web(message,prompt_with_search)
-                reply = f"**Webを検索中...**\n\n{reply1}"
+                reply = await self.generate_web(
+                    message, 
+                    prompt_with_search, 
+                    prefix="**Webを検索中...**\n\n",
+                    on_complete=self.answer_recorder(message, prompt, SemanticCache.SEARCH))
         else:
-            sentence = await self.generate_reply(message, history_limit=10)
-            reply = f"{sentence}"
-        await message.reply(reply)
\ No newline at end of file
+            context = ''
+            if self.answer_cache is not None:
+                context = await self.answer_context(messages)
+            reply = await self.cached_answer(message, prompt, SemanticCache.CHAT, context)
+            if reply is None:
+                reply = await self.generate_reply(
+                    message, 
+                    on_complete=self.answer_recorder(message, prompt, SemanticCache.CHAT, context))
+        if reply is not None:
+            await self.send_reply(message, reply)
+
+class ShardedLangchainBot(LangchainBot, discord.AutoShardedClient):
+    """
+    AutoShardedClientで動くLangchainBot。
+    shard_idsとshard_countを指定すると、そのシャードだけを受け持つ (supervisor.pyで複数のプロセスに分ける場合)
+    """
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage #type:ignore
+import Tokenizer
+
+class ContextPacker:
+    """
+    会話履歴を新しい順にトークン数の予算まで詰める。
+    予算からはシステムプロンプト、検索結果などの追加の内容、返答用の分を先に差し引き、
+    max_message_tokensを超える1件のメッセージは切り詰める。
+    追加の内容は最新のメッセージの分を残して切り詰め、最新のメッセージは常に含める。
+    メッセージ毎のトークン数は (message_id, edited_at) でキャッシュする。
+    sessionを指定すると、そのチャンネルで含める最も古いメッセージを固定する。
+    予算に収まる間は先頭が変わらず、LLMサーバーのプロンプトキャッシュ (KVキャッシュ) が効き続ける。
+    収まらなくなったら予算のrefill分まで一度に詰め直して、次に固定する位置を決める。
+    """
+    def __init__(
+            self,
+            tokenizer:Tokenizer.Tokenizer,
+            budget:int=6000, # プロンプト全体のトークン数の上限
+            reserve_output:int=1024, # 返答のために空けておくトークン数
+            max_message_tokens:int=800, # 1メッセージあたりのトークン数の上限
+            cache_size:int=10000,
+            refill:float=0.6, # 詰め直すときに使う予算の割合
+            max_sessions:int=1000,
+        ):
+        self.tokenizer = tokenizer
+        self.budget = budget
+        self.reserve_output = reserve_output
+        self.max_message_tokens = max_message_tokens
+        self.cache_size = cache_size
+        self._counts: OrderedDict[tuple, int] = OrderedDict()
+        self.refill = refill
+        self.max_sessions = max_sessions
+        # session -> 含める最も古いメッセージのID
+        self._anchors: OrderedDict[object, int] = OrderedDict()
+        self.stats = {'pinned': 0, 'repacked': 0}
+
+    @classmethod
+    def for_model(cls, llm, max_prompt_tokens:int=6000, **kwargs) -> 'ContextPacker':
+        """モデルに合わせたトークナイザと、コンテキスト長を超えない予算で作る"""
+        budget = min(Tokenizer.context_window(llm), max_prompt_tokens)
+        return cls(Tokenizer.for_model(llm), budget=budget, **kwargs)
+
+    def count_message(self, message_id:int|None, edited_at, message:BaseMessage) -> int:
+        if message_id is None:
+            return self.tokenizer.count(message.content) + self.tokenizer.message_overhead
+        key = (message_id, edited_at)
+        count = self._counts.get(key)
+        if count is None:
+            count = self.tokenizer.count(message.content) + self.tokenizer.message_overhead
+            self._counts[key] = count
+            while len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        else:
+            self._counts.move_to_end(key)
+        return count
+
+    def truncate(self, message:BaseMessage, max_tokens:int) -> BaseMessage:
+        content = self.tokenizer.truncate(message.content, max(max_tokens - 1, 0)) + '…'
+        return type(message)(content=content)
+
+    def pack(
+            self,
+            entries:list,
+            system_prompt:str|None=None,
+            extra:str|None=None,
+            session=None,
+        ) -> list[BaseMessage]:
+        """
+        entries: ChannelHistory.HistoryEntryのリスト (新しい順)
+        extra: 最後に追加する検索結果やWebページの内容
+        session: 先頭を固定する単位 (チャンネルIDなど)
+        Returns: システムプロンプトを先頭にした古い順のメッセージ。extraは最後のHumanMessageになる
+        """
+        return self.pack_with_dropped(entries, system_prompt, extra, session)[0]
+
+    def pack_with_dropped(
+            self,
+            entries:list,
+            system_prompt:str|None=None,
+            extra:str|None=None,
+            session=None,
+        ) -> tuple[list[BaseMessage], list]:
+        """
+        packと同じだが、予算に入らなかったエントリ (新しい順) も返す。
+        extraが予算に収まらない場合は、最新のメッセージ (答える質問) の分を残して切り詰める。
+        最新のメッセージは予算を超えても必ず入れる。
+        """
+        remaining = self.budget - self.reserve_output
+        if system_prompt is not None:
+            remaining -= self.tokenizer.count(system_prompt) + self.tokenizer.message_overhead
+        if extra is not None:
+            newest = 0
+            if entries:
+                newest = min(
+                    self.count_message(entries[0].message_id, entries[0].edited_at, entries[0].converted),
+                    self.max_message_tokens)
+            extra, tokens = self.fit(extra, remaining - newest)
+            remaining -= tokens
+
+        packed: list[BaseMessage] = []
+        counts: list[int] = []
+        for entry in entries:
+            message = entry.converted
+            tokens = self.count_message(entry.message_id, entry.edited_at, message)
+            limit = min(self.max_message_tokens, remaining)
+            if not packed:
+                # 答えるメッセージは予算が足りなくても入れる
+                limit = max(limit, min(tokens, self.max_message_tokens))
+            if tokens > limit:
+                # 最新のメッセージと長すぎる1件は切り詰めて入れる
+                if packed and tokens <= self.max_message_tokens:
+                    break
+                if packed and limit <= self.tokenizer.message_overhead:
+                    break
+                message = self.truncate(message, limit - self.tokenizer.message_overhead)
+                tokens = limit
+            packed.append(message)
+            counts.append(tokens)
+            remaining -= tokens
+            if remaining <= 0:
+                break
+        if session is not None and packed:
+            packed = packed[:self._pinned(session, entries, counts)]
+        used = len(packed)
+
+        if system_prompt is not None:
+            packed.append(SystemMessage(content=system_prompt))
+        packed.reverse()
+        if extra:
+            packed.append(HumanMessage(content=extra))
+        return packed, entries[used:]
+
+    def fit(self, text:str, max_tokens:int) -> tuple[str, int]:
+        """
+        textをmax_tokens (メッセージのオーバーヘッドを含む) に収まるように切り詰める。
+        Returns: (切り詰めたtext, 使うトークン数) 全く入らない場合は ('', 0)
+        """
+        tokens = self.tokenizer.count(text) + self.tokenizer.message_overhead
+        if tokens <= max_tokens:
+            return text, tokens
+        if max_tokens <= self.tokenizer.message_overhead + 1:
+            return '', 0
+        text = self.tokenizer.truncate(text, max_tokens - self.tokenizer.message_overhead - 1) + '…'
+        return text, max_tokens
+
+    def _pinned(self, session, entries:list, counts:list[int]) -> int:
+        """
+        counts: 予算に収まった新しい順のエントリのトークン数
+        Returns: 含めるエントリの数
+        """
+        ids = [entry.message_id for entry in entries[:len(counts)]]
+        anchor = self._anchors.get(session)
+        if anchor is not None and anchor in ids:
+            self._anchors.move_to_end(session)
+            self.stats['pinned'] += 1
+            return ids.index(anchor) + 1
+        if anchor is None and len(counts) == len(entries):
+            # 履歴が全部収まるうちはそのまま
+            keep = len(counts)
+        else:
+            # 固定していたメッセージが予算から外れたので、refill分まで詰め直す
+            self.stats['repacked'] += 1
+            target = sum(counts) * self.refill
+            keep, total = 0, 0
+            for tokens in counts:
+                if keep and total + tokens > target:
+                    break
+                total += tokens
+                keep += 1
+        self._anchors[session] = ids[keep - 1]
+        self._anchors.move_to_end(session)
+        while len(self._anchors) > self.max_sessions:
+            self._anchors.popitem(last=False)
+        return keep
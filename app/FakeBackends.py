@@ -0,0 +1,315 @@
+"""
+ベンチマークやリプレイ用の、外部サービスのローカルな代役。
+- FakeOllamaServer: Ollamaの /api/chat と /api/generate を真似るHTTPサーバー
+- FakeSearchBackend: DuckDuckGoSearchAPIWrapperの代わりの検索バックエンド
+- StaticWebServer: URL付きの質問で読み込ませるページを返すHTTPサーバー
+- FakeUser / FakeGuild / FakeChannel / FakeMessage: LangchainBotが使う範囲のdiscord.pyのオブジェクト
+"""
+import os
+import json
+import time
+import socket
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from aiohttp import web #type:ignore
+
+async def start_app(app:web.Application, host:str='127.0.0.1', port:int=0) -> tuple[web.AppRunner, int]:
+    """appを起動して (runner, 実際のポート) を返す。port=0なら空いているポートを使う"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.SockSite(runner, sock).start()
+    return runner, sock.getsockname()[1]
+
+class FakeOllamaServer:
+    """
+    Ollama APIの代役。first_token_latency秒待ってから、token_interval秒毎に1トークンずつ返す。
+    stream=falseなら全部生成し終わるまで待ってからまとめて返す。
+    意図の分析用のプロンプトには、通常の会話と判断する形式の応答を返す。
+    プロンプトはslots個のKVキャッシュのうち先頭の一致が最も長いものを再利用したとして、
+    残りの文字数 x prompt_eval_rate秒だけ評価に時間がかかる。/api/generateのcontextにも対応する。
+    """
+    def __init__(
+            self,
+            first_token_latency:float=0.3,
+            token_interval:float=0.02,
+            reply_tokens:int=60,
+            token:str='テスト',
+            replies:list[str]|None=None, # 指定すると順番に返す (記録した応答の再生用)
+            prompt_eval_rate:float=0.0, # プロンプト1文字の評価にかかる秒数
+            slots:int=4, # KVキャッシュの数 (OLLAMA_NUM_PARALLEL) 0なら毎回プロンプト全体を評価する
+        ):
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+        self.reply_tokens = reply_tokens
+        self.token = token
+        self.replies = replies
+        self._reply_index = itertools.count()
+        self.prompt_eval_rate = prompt_eval_rate
+        self.slots = slots
+        # 各スロットが最後に処理したテキスト (古い順)
+        self._cache: list[str] = []
+        self.stats = {
+            'chat': 0, 'generate': 0, 'analysis': 0, 'prompt_chars': 0, 'cached_chars': 0, 'completion_tokens': 0}
+        self.runner: web.AppRunner|None = None
+        self.url = ''
+
+    async def start(self, host:str='127.0.0.1', port:int=0) -> str:
+        app = web.Application()
+        app.router.add_post('/api/chat', self.chat)
+        app.router.add_post('/api/generate', self.generate)
+        self.runner, port = await start_app(app, host, port)
+        self.url = f'http://{host}:{port}/api'
+        return self.url
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def _tokens(self, prompt:str) -> list[str]:
+        if 'NEEDS_SEARCH' in prompt:
+            self.stats['analysis'] += 1
+            return ['NEEDS_SEARCH: false\n', 'HAS_URL: false\n', 'SEARCH_QUERY: \n']
+        if self.replies:
+            reply = self.replies[next(self._reply_index) % len(self.replies)]
+            return [reply[i:i + 2] for i in range(0, len(reply), 2)] or ['']
+        return [self.token] * self.reply_tokens
+
+    def _evaluate(self, prompt:str, reply:str) -> int:
+        """先頭の一致が最も長いスロットを使い、評価する文字数を返す"""
+        if self.slots <= 0:
+            return len(prompt)
+        best, cached = None, 0
+        for i, text in enumerate(self._cache):
+            length = len(os.path.commonprefix([text, prompt]))
+            if length > cached:
+                best, cached = i, length
+        if best is not None:
+            self._cache.pop(best)
+        elif len(self._cache) >= self.slots:
+            self._cache.pop(0)
+        self._cache.append(prompt + reply)
+        self.stats['cached_chars'] += cached
+        return len(prompt) - cached
+
+    async def _respond(
+            self, 
+            request:web.Request, 
+            data:dict, 
+            prompt:str, 
+            wrap, 
+            context:list[int]|None=None) -> web.StreamResponse:
+        self.stats['prompt_chars'] += len(prompt)
+        tokens = self._tokens(prompt)
+        self.stats['completion_tokens'] += len(tokens)
+        evaluated = self._evaluate(prompt, ''.join(tokens))
+        done = {
+            'done': True,
+            'prompt_eval_count': evaluated,
+            'prompt_eval_duration': int(evaluated * self.prompt_eval_rate * 1e9),
+            'eval_count': len(tokens),
+        }
+        if context is not None:
+            done['context'] = [ord(c) for c in prompt + ''.join(tokens)]
+        await asyncio.sleep(self.first_token_latency + evaluated * self.prompt_eval_rate)
+        if not data.get('stream', True):
+            await asyncio.sleep(self.token_interval * max(len(tokens) - 1, 0))
+            return web.json_response({**wrap(''.join(tokens)), **done})
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(self.token_interval)
+            await response.write((json.dumps({**wrap(token), 'done': False}) + '\n').encode('utf-8'))
+        await response.write((json.dumps({**wrap(''), **done}) + '\n').encode('utf-8'))
+        await response.write_eof()
+        return response
+
+    async def chat(self, request:web.Request) -> web.StreamResponse:
+        self.stats['chat'] += 1
+        data = await request.json()
+        prompt = '\n'.join(message.get('content', '') for message in data.get('messages', []))
+        return await self._respond(
+            request, data, prompt, lambda text: {'message': {'role': 'assistant', 'content': text}})
+
+    async def generate(self, request:web.Request) -> web.StreamResponse:
+        self.stats['generate'] += 1
+        data = await request.json()
+        # contextは前回のプロンプトと返答の文字コードの列
+        context = data.get('context') or []
+        prompt = ''.join(chr(c) for c in context) + data.get('prompt', '')
+        return await self._respond(request, data, prompt, lambda text: {'response': text}, context)
+
+class FakeSearchBackend:
+    """
+    DuckDuckGoSearchAPIWrapperの代役。SearchServiceのスレッドプールで呼ばれるのでtime.sleepで待つ。
+    """
+    def __init__(
+            self,
+            latency:float=0.2,
+            max_results:int=5,
+            region:str='jp-jp',
+            time:str='w',
+            recorded:dict[str, list[dict]]|None=None, # クエリ -> 記録した検索結果
+        ):
+        self.latency = latency
+        self.max_results = max_results
+        self.region = region
+        self.time = time
+        self.recorded = recorded or {}
+        self.calls = 0
+
+    def copy(self, update:dict|None=None) -> 'FakeSearchBackend':
+        backend = FakeSearchBackend(self.latency, self.max_results, self.region, self.time, self.recorded)
+        for key, value in (update or {}).items():
+            setattr(backend, key, value)
+        return backend
+
+    def results(self, query:str, max_results:int) -> list[dict]:
+        self.calls += 1
+        time.sleep(self.latency)
+        if query in self.recorded:
+            return self.recorded[query][:max_results]
+        return [
+            {
+                'title': f'{query} {i + 1}',
+                'snippet': f'{query}についての検索結果の要約です。' * 3,
+                'link': f'https://example.com/{i + 1}',
+            }
+            for i in range(max_results)
+        ]
+
+class StaticWebServer:
+    """/page/<n> で本文がbody_chars文字程度のHTMLを返す"""
+    def __init__(self, latency:float=0.05, body_chars:int=3000):
+        self.latency = latency
+        self.body_chars = body_chars
+        self.requests = 0
+        self.runner: web.AppRunner|None = None
+        self.url = ''
+
+    async def start(self, host:str='127.0.0.1', port:int=0) -> str:
+        app = web.Application()
+        app.router.add_get('/page/{n}', self.page)
+        self.runner, port = await start_app(app, host, port)
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def page(self, request:web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        n = request.match_info['n']
+        paragraph = f'<p>これはページ{n}の本文です。ベンチマーク用の記事で、特に意味のある内容はありません。</p>\n'
+        body = paragraph * max(self.body_chars // len(paragraph), 1)
+        html = f'<html><head><title>page {n}</title><script>var x = 1;</script></head><body><h1>page {n}</h1>{body}</body></html>'
+        return web.Response(text=html, content_type='text/html')
+
+# Discordのsnowflakeの代わりの単調増加するID
+_ids = itertools.count(1_300_000_000_000_000_000)
+
+def next_id() -> int:
+    return next(_ids)
+
+class FakeUser:
+    def __init__(self, name:str, bot:bool=False, user_id:int|None=None):
+        self.id = user_id if user_id is not None else next_id()
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+
+    @property
+    def mention(self) -> str:
+        return f'<@{self.id}>'
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+class FakeGuild:
+    def __init__(self, guild_id:int|None=None):
+        self.id = guild_id if guild_id is not None else next_id()
+
+class FakeMessage:
+    def __init__(self, content:str, author:FakeUser, channel:'FakeChannel', mentions:list[FakeUser]|None=None):
+        self.id = next_id()
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.mentions = mentions or []
+        self.edited_at = None
+        self.created_at = datetime.now(timezone.utc)
+        # ベンチマーク用: 最初の返信が送られた時刻、返信、応答の完了
+        self.first_reply_at: float|None = None
+        self.replies: list['FakeMessage'] = []
+        self.done_at: float|None = None
+        self.error: str|None = None
+        self.done = asyncio.Event()
+
+    async def reply(self, content:str) -> 'FakeMessage':
+        sent = await self.channel.send(content)
+        if self.first_reply_at is None:
+            self.first_reply_at = time.perf_counter()
+        self.replies.append(sent)
+        return sent
+
+    async def edit(self, content:str) -> 'FakeMessage':
+        self.content = content
+        self.edited_at = datetime.now(timezone.utc)
+        return self
+
+    async def delete(self) -> None:
+        if self in self.channel.messages:
+            self.channel.messages.remove(self)
+
+class FakeChannel:
+    """
+    送信したメッセージを保持するチャンネル。
+    listenerを設定すると、送信したメッセージをDiscordと同じようにon_messageに流す。
+    """
+    def __init__(self, guild:FakeGuild|None, sender:FakeUser, channel_id:int|None=None, send_latency:float=0.0):
+        self.id = channel_id if channel_id is not None else next_id()
+        self.guild = guild
+        self.sender = sender
+        self.send_latency = send_latency
+        self.messages: list[FakeMessage] = []
+        self.listener = None
+
+    async def send(self, content:str) -> FakeMessage:
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        message = FakeMessage(content, self.sender, self)
+        self.messages.append(message)
+        if self.listener is not None:
+            await self.listener(message)
+        return message
+
+    def post(self, content:str, author:FakeUser, mentions:list[FakeUser]|None=None) -> FakeMessage:
+        """ユーザーの発言を追加する (on_messageには呼び出し側が渡す)"""
+        message = FakeMessage(content, author, self, mentions)
+        self.messages.append(message)
+        return message
+
+    @asynccontextmanager
+    async def typing(self):
+        yield
+
+    async def history(self, limit:int=100):
+        for message in reversed(self.messages[-limit:]):
+            yield message
+
+    async def fetch_message(self, message_id:int) -> FakeMessage:
+        for message in self.messages:
+            if message.id == message_id:
+                return message
+        raise LookupError(message_id)
@@ -0,0 +1,147 @@
+import re
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+
+SCHEDULE = 'schedule'
+URL = 'url'
+SEARCH = 'search'
+CHAT = 'chat'
+
+URL_PATTERN = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+# 最新の情報が必要そうな語とその重み
+SEARCH_KEYWORDS: dict[str, float] = {
+    '最新': 2, 'ニュース': 2, '速報': 2, '話題': 2, 'トレンド': 2,
+    '今日': 1, '昨日': 1, '明日': 1, '今週': 1, '先週': 1, '来週': 1,
+    '今月': 1, '先月': 1, '来月': 1, '今年': 1, '去年': 1, '来年': 1, '最近': 1, '現在': 1,
+    '天気': 2, '株価': 2, '為替': 2, '結果': 1, '試合': 1,
+    '発売': 2, '新作': 2, '新商品': 2, '新メニュー': 2, '限定': 1, 'リリース': 1,
+    '値段': 1, '価格': 1, 'いつ': 1, '予定': 1, 'イベント': 1, 'キャンペーン': 1,
+    '調べて': 2, '検索': 2, 'ググって': 2,
+    'latest': 2, 'news': 2, 'today': 1, 'release': 1, 'price': 1,
+}
+# 日付らしき表現 (2024年, 10月18日, 10/18)
+DATE_PATTERN = re.compile(r'\d{4}年|\d{1,2}月\d{1,2}日|\b\d{1,2}/\d{1,2}\b')
+# 検索クエリから取り除く依頼表現
+QUERY_NOISE_PATTERN = re.compile(r'(について)?(を)?(調べて|検索して|ググって|教えて)(ください|下さい|ほしい|欲しい)?[。.!！?？]*$')
+
+class Route:
+    """ルーティングの判断結果"""
+    __slots__ = ('kind', 'confidence', 'search_query', 'urls', 'source')
+
+    def __init__(
+            self,
+            kind:str,
+            confidence:float,
+            search_query:str|None=None,
+            urls:list[str]|None=None,
+            source:str='local',
+        ):
+        self.kind = kind
+        self.confidence = confidence
+        self.search_query = search_query
+        self.urls = urls if urls is not None else []
+        self.source = source # 'local' / 'llm' / 'cache'
+
+    def __repr__(self) -> str:
+        return f'Route({self.kind!r}, confidence={self.confidence}, search_query={self.search_query!r}, source={self.source!r})'
+
+def search_score(text:str) -> float:
+    """最新情報が必要そうな度合いをキーワードと日付表現から計算する"""
+    lowered = text.lower()
+    score = sum(weight for keyword, weight in SEARCH_KEYWORDS.items() if keyword in lowered)
+    if DATE_PATTERN.search(text):
+        score += 1
+    return score
+
+def to_search_query(text:str) -> str:
+    query = URL_PATTERN.sub('', text).strip()
+    query = QUERY_NOISE_PATTERN.sub('', query).strip()
+    return query if query else text.strip()
+
+def parse_analysis(content:str, prompt:str) -> Route:
+    """
+    query_promptに対するLLMの応答をRouteに変換する
+    """
+    urls = URL_PATTERN.findall(prompt)
+    if "HAS_URL: true" in content and urls:
+        return Route(URL, 1.0, urls=urls, source='llm')
+    search_query = re.search(r'SEARCH_QUERY: (.*)', content)
+    search_query = search_query.group(1).strip() if search_query else None
+    if "NEEDS_SEARCH: true" in content and search_query:
+        return Route(SEARCH, 1.0, search_query=search_query, source='llm')
+    return Route(CHAT, 1.0, search_query=search_query, source='llm')
+
+class IntentRouter:
+    """
+    メンションの意図 (schedule / url / search / chat) をローカルで判定する。
+    確信度がthreshold未満の場合だけfallback (分析用LLM呼び出し) を使い、
+    直近の判断はTTL付きのLRUキャッシュに保持する。
+    """
+    def __init__(
+            self,
+            fallback:Callable[[str], Awaitable[Route]]|None=None,
+            threshold:float=0.7,
+            cache_size:int=512,
+            cache_ttl:float=600.0, # 秒
+            search_threshold:float=2, # この値以上のsearch_scoreなら検索と判断する
+        ):
+        self.fallback = fallback
+        self.threshold = threshold
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.search_threshold = search_threshold
+        self._cache: OrderedDict[str, tuple[float, Route]] = OrderedDict()
+        self.stats = {'local': 0, 'llm': 0, 'cache': 0}
+
+    def classify(self, prompt:str, command_content:str='') -> Route:
+        """ローカルのヒューリスティックだけで判定する"""
+        if command_content.startswith('!schedule'):
+            return Route(SCHEDULE, 1.0)
+        urls = URL_PATTERN.findall(prompt)
+        if urls:
+            return Route(URL, 1.0, urls=urls)
+        score = search_score(prompt)
+        if score >= self.search_threshold:
+            return Route(SEARCH, 0.9, search_query=to_search_query(prompt))
+        if score == 0:
+            return Route(CHAT, 0.8)
+        # 判断が難しいので確信度を低くする
+        return Route(SEARCH, 0.5, search_query=to_search_query(prompt))
+
+    async def aroute(self, prompt:str, command_content:str='') -> Route:
+        route = self.classify(prompt, command_content)
+        if route.confidence >= self.threshold or self.fallback is None:
+            self.stats['local'] += 1
+            return route
+        key = self._key(prompt)
+        cached = self._cache_get(key)
+        if cached is not None:
+            self.stats['cache'] += 1
+            return Route(
+                cached.kind, cached.confidence, cached.search_query, cached.urls, source='cache')
+        route = await self.fallback(prompt)
+        self.stats['llm'] += 1
+        self._cache_set(key, route)
+        return route
+
+    def _key(self, prompt:str) -> str:
+        return ' '.join(prompt.lower().split())
+
+    def _cache_get(self, key:str) -> Route|None:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        stored_at, route = entry
+        if time.monotonic() - stored_at > self.cache_ttl:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return route
+
+    def _cache_set(self, key:str, route:Route) -> None:
+        self._cache[key] = (time.monotonic(), route)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
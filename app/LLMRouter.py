@@ -0,0 +1,357 @@
+from typing import Any, Dict, List, Optional, Iterator, AsyncIterator
+from collections import deque
+from langchain_core.callbacks.manager import ( #type:ignore
+    CallbackManagerForLLMRun,
+    AsyncCallbackManagerForLLMRun)
+from langchain_core.language_models import BaseChatModel #type:ignore
+from langchain_core.messages import AIMessage, BaseMessage, AIMessageChunk #type:ignore
+from langchain_core.outputs import ( #type:ignore
+    ChatGeneration,
+    ChatGenerationChunk,
+    ChatResult)
+import Tokenizer
+import Metrics
+import asyncio
+import time
+
+class Backend:
+    """
+    One chat model behind the router, with its rolling health statistics.
+    Latency is measured to the first token, since that is what a user waits for.
+    """
+    def __init__(
+            self,
+            name: str,
+            model: BaseChatModel,
+            first_token_timeout: float = 30.0, # seconds until the first token before failing over
+            window: int = 50, # number of recent requests kept for the statistics
+            max_failures: int = 3, # consecutive failures before the backend is put on cooldown
+            cooldown: float = 30.0, # first cooldown in seconds, doubled on every further failure
+            max_cooldown: float = 600.0,
+        ):
+        self.name = name
+        self.model = model
+        self.first_token_timeout = first_token_timeout
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.results: deque[bool] = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record_success(self, latency: float) -> None:
+        Metrics.LLM_FIRST_TOKEN_SECONDS.observe(latency, backend=self.name)
+        self.latencies.append(latency)
+        self.results.append(True)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record_failure(self) -> None:
+        Metrics.LLM_ERRORS.inc(backend=self.name)
+        self.results.append(False)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.max_failures:
+            excess = self.consecutive_failures - self.max_failures
+            self.cooldown_until = time.monotonic() + min(
+                self.cooldown * 2 ** excess, self.max_cooldown)
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def percentile(self, q: float) -> float|None:
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+
+    def score(self) -> float:
+        """Expected wait for the first token; lower is better. Unmeasured backends are tried first."""
+        median = self.percentile(0.5)
+        if median is None:
+            return 0.0
+        # a failed request costs a timeout before the next backend is tried
+        return median + self.error_rate() * self.first_token_timeout
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'healthy': self.healthy(),
+            'error_rate': round(self.error_rate(), 3),
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'requests': len(self.results),
+        }
+
+class LLMRouter(BaseChatModel):
+    """
+    LLMRouter is a chat model that routes each request to the fastest healthy backend.
+    Attributes:
+        backends (List[Backend]): The backends, in order of preference when nothing has been measured yet.
+        hedge (bool): Fire a second backend when the first has not produced a token by its p95 latency.
+        hedge_min_samples (int): Number of latency samples needed before a backend is hedged.
+        max_attempts (int): Number of backends tried by a non-streaming request that fails mid-response.
+    Methods:
+        _generate / _agenerate:
+            Returns the complete response of the first backend that succeeds,
+            with its usage metadata and response_metadata['backend'] set to the backend name.
+        _stream / _astream:
+            Streams the response of the backend that produced the first token.
+            Once a token has been yielded the response cannot move to another backend.
+        health() -> Dict[str, Dict[str, Any]]:
+            Returns the rolling statistics of every backend.
+    """
+
+    backends: List[Any]
+    """Backend objects"""
+    hedge: bool = False
+    """enable hedged requests"""
+    hedge_min_samples: int = 20
+    """latency samples needed before hedging"""
+    max_attempts: int = 2
+    """backends tried by a non-streaming request"""
+
+    @property
+    def model_name(self) -> str:
+        """Name of the backend with the smallest context window, so that prompts fit every backend"""
+        backend = min(self.backends, key=lambda backend: Tokenizer.context_window(backend.model))
+        return Tokenizer.model_name_of(backend.model)
+
+    def health(self) -> Dict[str, Dict[str, Any]]:
+        return {backend.name: backend.status() for backend in self.backends}
+
+    def _ranked(self, exclude: set) -> List[Backend]:
+        """Healthy backends from the fastest; backends on cooldown come last, the soonest to recover first"""
+        candidates = [backend for backend in self.backends if backend.name not in exclude]
+        healthy = sorted(
+            (backend for backend in candidates if backend.healthy()), key=lambda backend: backend.score())
+        cooling = sorted(
+            (backend for backend in candidates if not backend.healthy()), key=lambda backend: backend.cooldown_until)
+        return healthy + cooling
+
+    def _hedge_delay(self, backend: Backend) -> float|None:
+        if not self.hedge or len(backend.latencies) < self.hedge_min_samples:
+            return None
+        return backend.percentile(0.95)
+
+    async def _open(self, backend: Backend, messages: List[BaseMessage], kwargs: Dict[str, Any]):
+        """Starts a stream on backend and waits for its first chunk"""
+        start = time.monotonic()
+        stream = backend.model.astream(messages, **kwargs)
+        try:
+            first = await asyncio.wait_for(stream.__anext__(), backend.first_token_timeout)
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await stream.aclose()
+            raise
+        return stream, first, time.monotonic() - start
+
+    @staticmethod
+    async def _discard(task: asyncio.Task) -> None:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        elif not task.cancelled() and task.exception() is None:
+            stream, _, _ = task.result()
+            await stream.aclose()
+
+    async def _race(self, messages: List[BaseMessage], kwargs: Dict[str, Any], exclude: set):
+        """
+        Returns (backend, stream, first chunk) of the first backend that produces a token.
+        A backend that fails before its first token is replaced by the next one, and a slow one
+        is hedged by the next one if hedging is enabled; the losing stream is cancelled.
+        """
+        candidates = iter(self._ranked(exclude))
+        pending: Dict[asyncio.Task, Backend] = {}
+        errors: List[BaseException] = []
+
+        def launch() -> bool:
+            backend = next(candidates, None)
+            if backend is None:
+                return False
+            pending[asyncio.create_task(self._open(backend, messages, kwargs))] = backend
+            return True
+
+        launch()
+        try:
+            while pending:
+                delay = None
+                if len(pending) == 1:
+                    delay = self._hedge_delay(next(iter(pending.values())))
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # the first token is later than usual; ask the next backend as well
+                    if not launch():
+                        # nothing to hedge with, so just keep waiting
+                        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    backend = pending.pop(task)
+                    if task.exception() is not None:
+                        backend.record_failure()
+                        errors.append(task.exception())
+                        continue
+                    stream, first, latency = task.result()
+                    backend.record_success(latency)
+                    for other in [other for other in done if other is not task]:
+                        pending.pop(other, None)
+                        await self._discard(other)
+                    return backend, stream, first
+                if not pending:
+                    # failover
+                    launch()
+        finally:
+            # the losers, or every attempt if the caller was cancelled while waiting
+            for task in list(pending):
+                pending.pop(task)
+                await self._discard(task)
+        if errors:
+            raise errors[-1]
+        raise RuntimeError("no backend available")
+
+    @staticmethod
+    def _chunk(message: BaseMessage, backend: Optional[Backend] = None) -> ChatGenerationChunk:
+        """
+        Copies a backend chunk with its usage and response metadata.
+        The backend name is added only when given (the first chunk), because string metadata is concatenated when chunks are merged.
+        """
+        response_metadata = dict(message.response_metadata or {})
+        if backend is not None:
+            response_metadata['backend'] = backend.name
+        return ChatGenerationChunk(message=AIMessageChunk(
+            content=message.content,
+            usage_metadata=getattr(message, 'usage_metadata', None),
+            response_metadata=response_metadata))
+
+    async def _emit(
+        self,
+        message: BaseMessage,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun],
+        backend: Optional[Backend] = None,
+    ) -> ChatGenerationChunk:
+        chunk = self._chunk(message, backend)
+        if run_manager is not None:
+            await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+        return chunk
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        """
+        Streams from the backend that produced the first token.
+        """
+        async for chunk in self._astream_excluding(messages, stop, run_manager, set(), **kwargs):
+            yield chunk
+
+    async def _astream_excluding(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]],
+        run_manager: Optional[AsyncCallbackManagerForLLMRun],
+        exclude: set,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if stop is not None:
+            kwargs['stop'] = stop
+        backend, stream, first = await self._race(messages, kwargs, exclude)
+        # tell the caller which backend answered, so that a retry can skip it
+        exclude.add(backend.name)
+        label: Optional[Backend] = backend
+        try:
+            if first is not None:
+                yield await self._emit(first, run_manager, label)
+                label = None
+            async for message in stream:
+                yield await self._emit(message, run_manager, label)
+                label = None
+        except Exception:
+            backend.record_failure()
+            raise
+        finally:
+            await stream.aclose()
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """
+        Collects the whole response. A backend failing mid-response is retried on another one,
+        because nothing has been shown to the caller yet.
+        """
+        exclude: set = set()
+        for attempt in range(self.max_attempts):
+            merged: Optional[AIMessageChunk] = None
+            try:
+                async for chunk in self._astream_excluding(messages, stop, None, exclude, **kwargs):
+                    merged = chunk.message if merged is None else merged + chunk.message
+            except Exception:
+                if attempt + 1 >= self.max_attempts or len(exclude) >= len(self.backends):
+                    raise
+                continue
+            if merged is None:
+                merged = AIMessageChunk(content='')
+            generation = ChatGeneration(message=AIMessage(
+                content=merged.content,
+                usage_metadata=merged.usage_metadata,
+                response_metadata=merged.response_metadata))
+            return ChatResult(generations=[generation])
+        raise RuntimeError("no backend available")
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """
+        Synchronous fallback without hedging: tries the backends in order of their score.
+        """
+        error: Exception|None = None
+        for backend in self._ranked(set()):
+            start = time.monotonic()
+            try:
+                message = backend.model.invoke(messages, stop=stop, **kwargs)
+            except Exception as e:
+                backend.record_failure()
+                error = e
+                continue
+            backend.record_success(time.monotonic() - start)
+            generation = ChatGeneration(message=AIMessage(
+                content=message.content,
+                usage_metadata=getattr(message, 'usage_metadata', None),
+                response_metadata={**message.response_metadata, 'backend': backend.name}))
+            return ChatResult(generations=[generation])
+        raise error if error is not None else RuntimeError("no backend available")
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        result = self._generate(messages, stop, run_manager, **kwargs)
+        chunk = self._chunk(result.generations[0].message)
+        if run_manager is not None:
+            run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+        yield chunk
+
+    @property
+    def _llm_type(self) -> str:
+        return "llm_router"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"backends": [backend.name for backend in self.backends],}
@@ -1,10 +1,76 @@
 import os
-import requests #type:ignore
+import aiohttp #type:ignore
+import asyncio
+import random
 import json
-from collections.abc import Generator
+import time
+import contextvars
+from datetime import datetime
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import Generator, AsyncGenerator
+import Tokenizer
+
+# リトライ対象のHTTPステータス (レート制限・一時的なサーバーエラー)
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# 接続先と接続設定毎に共有するaiohttpセッション (keep-aliveのコネクションプール)
+# キー: (api_url, pool_size, connect_timeout, read_timeout)
+_sessions: dict[tuple, tuple[asyncio.AbstractEventLoop, aiohttp.ClientSession]] = {}
+
+async def close_sessions() -> None:
+    """共有セッションを全て閉じる (終了時に呼ぶ)"""
+    entries = list(_sessions.values())
+    _sessions.clear()
+    for _, session in entries:
+        if not session.closed:
+            await session.close()
+
+# 処理中の会話の単位 (チャンネルIDなど)。プロンプトキャッシュの計測とcontextの再利用に使う
+prompt_session: contextvars.ContextVar[object|None] = contextvars.ContextVar('prompt_session', default=None)
+
+@contextmanager
+def session(key):
+    """
+    Usage:
+        with LangModel.session(message.channel.id):
+            response = await llm.ainvoke(messages)
+    """
+    token = prompt_session.set(key)
+    try:
+        yield
+    finally:
+        prompt_session.reset(token)
+
+def render_messages(messages:list[dict[str, str]]) -> str:
+    """前回のプロンプトとの共通部分を比べるためのchatのメッセージの文字列表現"""
+    return ''.join(f"<{message['role']}>\n{message['content']}\n" for message in messages)
+
+class PromptSession:
+    """1つの会話で最後にサーバーに処理させたテキスト (プロンプトと返答) と、/api/generateのcontext"""
+    __slots__ = ('text', 'context')
+
+    def __init__(self):
+        self.text = ''
+        self.context: list[int]|None = None
 
 class LangModel:
-    def __init__(self, api_key:str, api_url:str, model_name:str):
+    def __init__(
+            self, 
+            api_key:str, 
+            api_url:str, 
+            model_name:str,
+            pool_size:int=8, # 共有セッションの最大同時接続数
+            connect_timeout:float=10.0, # 接続タイムアウト(秒)
+            read_timeout:float=120.0, # 受信間隔のタイムアウト(秒)
+            max_retries:int=3, # 失敗時のリトライ回数
+            retry_backoff:float=0.5, # リトライ間隔の初期値(秒) 以降倍々に増える
+            options:dict|None=None, # Ollamaのオプション (num_ctx, temperatureなど)
+            keep_alive:str|int|None='30m', # 最後のリクエストからモデルをメモリに残す時間 (Noneならサーバーの既定値)
+            max_tokens:int|None=None, # 生成する最大トークン数の既定値 (num_predict)
+            reuse_context:bool=False, # 同じ会話の/api/generateで前回のcontextを送り、続きのプロンプトだけを処理させる
+            max_sessions:int=256, # 覚えておく会話の数
+        ):
         self.api_key = api_key
         self.api_url = api_url
         self.model_name = model_name
@@ -12,20 +78,128 @@ class LangModel:
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json",
         }
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.options = dict(options or {})
+        self.keep_alive = keep_alive
+        self.max_tokens = max_tokens
+        self.reuse_context = reuse_context
+        self.max_sessions = max_sessions
+        self.sessions: OrderedDict[object, PromptSession] = OrderedDict()
+        # 評価したプロンプト1トークンあたりの秒数 (指数移動平均)
+        self._eval_rate: float|None = None
+        # estimated_で始まるものは文字数からの概算で、実際のトークン数とはずれる。
+        # キャッシュの効果を測る場合は、キャッシュなしで動かしたときのprompt_eval_secondsと比べる
+        self.stats = {
+            'requests': 0,
+            'prompt_eval_tokens': 0, # サーバーが実際に評価した分 (prompt_eval_count)
+            'prompt_eval_seconds': 0.0, # prompt_eval_durationの合計
+            'estimated_prompt_tokens': 0, # プロンプト全体
+            'estimated_prefix_tokens': 0, # 同じ会話の前回のプロンプトと共通の先頭部分
+            'estimated_skipped_tokens': 0, # キャッシュにより評価されなかった分
+            'estimated_saved_seconds': 0.0, # estimated_skipped_tokensを評価した場合にかかったはずの秒数
+            'context_reused': 0,
+        }
+
+    def _payload(
+            self, 
+            data:dict, 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> dict:
+        """
+        リクエストにモデル名、keep_alive、オプションを加える。
+        オプションはモデル毎の設定にリクエスト毎の設定を上書きし、max_tokensはnum_predictになる。
+        """
+        payload = {"model": self.model_name, **data}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        merged = {**self.options, **(options or {})}
+        max_tokens = max_tokens if max_tokens is not None else self.max_tokens
+        if max_tokens is not None:
+            merged["num_predict"] = max_tokens
+        if merged:
+            payload["options"] = merged
+        return payload
 
-    def _generate(self, prompt:str, stream:bool) -> str:
-        data = {
-            "model": self.model_name,
+    def _session(self, key) -> PromptSession:
+        session = self.sessions.get(key)
+        if session is None:
+            session = PromptSession()
+            self.sessions[key] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        else:
+            self.sessions.move_to_end(key)
+        return session
+
+    def _continue(self, data:dict, key) -> dict:
+        """
+        reuse_contextが有効で、プロンプトが同じ会話の前回のプロンプトと返答の続きなら、
+        前回のcontextを付けて続きの部分だけを送る
+        """
+        if not self.reuse_context or key is None:
+            return data
+        session = self.sessions.get(key)
+        if session is None or not session.context or not session.text:
+            return data
+        if not data["prompt"].startswith(session.text):
+            return data
+        self.stats['context_reused'] += 1
+        return {**data, "prompt": data["prompt"][len(session.text):], "context": session.context}
+
+    def _record(self, key, prompt_text:str, continuation:str, response_data:dict) -> None:
+        """
+        最後の応答のprompt_eval_count / prompt_eval_durationを集計する。
+        プロンプト全体のトークン数はサーバーから返らないので文字数から概算し、
+        そこから実際に評価されたトークン数を引いたものをキャッシュで省けた分の見積もりとする。
+        概算がずれるので、見積もりは傾向を見るためのもので、計測値ではない。
+        """
+        eval_count = response_data.get('prompt_eval_count', 0)
+        eval_seconds = response_data.get('prompt_eval_duration', 0) / 1e9
+        prompt_tokens = Tokenizer.estimate_tokens(prompt_text)
+        self.stats['requests'] += 1
+        self.stats['estimated_prompt_tokens'] += prompt_tokens
+        self.stats['prompt_eval_tokens'] += eval_count
+        self.stats['prompt_eval_seconds'] += eval_seconds
+        if eval_count > 0 and eval_seconds > 0:
+            rate = eval_seconds / eval_count
+            self._eval_rate = rate if self._eval_rate is None else self._eval_rate * 0.8 + rate * 0.2
+        skipped = max(prompt_tokens - eval_count, 0)
+        self.stats['estimated_skipped_tokens'] += skipped
+        if self._eval_rate is not None:
+            self.stats['estimated_saved_seconds'] += skipped * self._eval_rate
+        if key is not None:
+            session = self._session(key)
+            prefix = os.path.commonprefix([session.text, prompt_text])
+            self.stats['estimated_prefix_tokens'] += Tokenizer.estimate_tokens(prefix)
+            session.text = prompt_text + continuation
+            session.context = response_data.get('context')
+
+    def _generate(
+            self, 
+            prompt:str, 
+            stream:bool, 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> str:
+        data = self._payload({
             "prompt": prompt,
             "stream": stream,
-        }
+        }, max_tokens, options)
+        import requests #type:ignore # 同期版を使う場合だけ読み込む
         response = requests.post(
             f"{self.api_url}/generate", headers=self.headers, json=data)
         return response
         
-    def generate(self, prompt:str) -> str:
+    def generate(
+            self, 
+            prompt:str, 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> str:
         """complate the prompt and return the response"""
-        response = self._generate(prompt, False)
+        response = self._generate(prompt, False, max_tokens, options)
         if response.status_code == 200:
             response_data = response.json()
             if response_data['response'] == "" or response_data['response'] == None:
@@ -34,9 +208,13 @@ class LangModel:
         else:
             ValueError(f"Error: {response.status_code}, {response.text}")
 
-    def stream_generate(self, prompt:str) -> Generator[dict[str, str], None, None]:
+    def stream_generate(
+            self, 
+            prompt:str, 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> Generator[dict[str, str], None, None]:
         """complate the prompt and return the response"""
-        response = self._generate(prompt, True)
+        response = self._generate(prompt, True, max_tokens, options)
         if response.status_code == 200:
             for line in response.iter_lines():
                 if line:
@@ -46,17 +224,26 @@ class LangModel:
         else:
             ValueError(f"Error: {response.status_code}, {response.text}")
 
-    def _chat(self, messages:list[dict[str, str]], stream:bool) -> str:
-        data = {
-            "model": self.model_name,
+    def _chat(
+            self, 
+            messages:list[dict[str, str]], 
+            stream:bool, 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> str:
+        data = self._payload({
             "messages": messages,
             "stream": stream,
-        }
+        }, max_tokens, options)
+        import requests #type:ignore # 同期版を使う場合だけ読み込む
         response = requests.post(f"{self.api_url}/chat", headers=self.headers, json=data)
         return response
 
-    def chat(self, messages:list[dict[str, str]]) -> str: 
-        response = self._chat(messages, False)
+    def chat(
+            self, 
+            messages:list[dict[str, str]], 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> str: 
+        response = self._chat(messages, False, max_tokens, options)
         if response.status_code == 200:
                 response_data = response.json()
                 return response_data['message']
@@ -65,8 +252,10 @@ class LangModel:
 
     def stream_chat(
             self, 
-            messages:list[dict[str, str]]) -> Generator[dict[str, str], None, None]:
-        response = self._chat(messages, True)
+            messages:list[dict[str, str]], 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> Generator[dict[str, str], None, None]:
+        response = self._chat(messages, True, max_tokens, options)
         if response.status_code == 200:
             for line in response.iter_lines():
                 if line:
@@ -76,6 +265,190 @@ class LangModel:
         else:
             ValueError(f"Error: {response.status_code}, {response.text}")
 
+    def _session_key(self) -> tuple:
+        # 接続数やタイムアウトの違うインスタンスは別のセッションを使う
+        return (self.api_url, self.pool_size, self.connect_timeout, self.read_timeout)
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """同じ接続先・接続設定のインスタンスで共有するセッションを返す。ループが変わっていれば作り直す"""
+        loop = asyncio.get_running_loop()
+        entry = _sessions.get(self._session_key())
+        if entry is not None:
+            session_loop, session = entry
+            if session_loop is loop and not session.closed:
+                return session
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size, 
+            keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(
+            total=None, 
+            sock_connect=self.connect_timeout, 
+            sock_read=self.read_timeout)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _sessions[self._session_key()] = (loop, session)
+        return session
+
+    async def aclose(self) -> None:
+        """共有セッションを閉じる"""
+        entry = _sessions.pop(self._session_key(), None)
+        if entry is not None and not entry[1].closed:
+            await entry[1].close()
+
+    async def _apost(self, endpoint:str, data:dict) -> aiohttp.ClientResponse:
+        """
+        POST with retry and exponential backoff.
+        The caller is responsible for releasing the returned response.
+        """
+        session = await self._get_session()
+        delay = self.retry_backoff
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt >= self.max_retries
+            try:
+                response = await session.post(
+                    f"{self.api_url}/{endpoint}", headers=self.headers, json=data)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if last_attempt:
+                    raise
+            else:
+                if response.status not in RETRY_STATUS or last_attempt:
+                    return response
+                response.release()
+            # jitterを加えて同時リトライが揃わないようにする
+            await asyncio.sleep(delay * (1 + random.random() * 0.1))
+            delay *= 2
+
+    async def _aiter_lines(
+            self, 
+            endpoint:str, 
+            data:dict) -> AsyncGenerator[dict[str, str], None]:
+        response = await self._apost(endpoint, data)
+        async with response:
+            if response.status != 200:
+                raise ValueError(f"Error: {response.status}, {await response.text()}")
+            async for line in response.content:
+                line = line.strip()
+                if line:
+                    response_data:dict[str, str] = json.loads(line.decode('utf-8'))
+                    yield response_data
+
+    async def agenerate(
+            self, 
+            prompt:str, 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> str:
+        """complate the prompt and return the response (async)"""
+        key = prompt_session.get()
+        data = self._payload(self._continue({
+            "prompt": prompt,
+            "stream": False,
+        }, key), max_tokens, options)
+        response = await self._apost("generate", data)
+        async with response:
+            if response.status != 200:
+                raise ValueError(f"Error: {response.status}, {await response.text()}")
+            response_data = await response.json(content_type=None)
+        if response_data.get('response') in ("", None):
+            raise ValueError(f"Error: {response_data.get('error')}")
+        self._record(key, prompt, response_data['response'], response_data)
+        return response_data['response']
+
+    async def astream_generate(
+            self, 
+            prompt:str, 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> AsyncGenerator[dict[str, str], None]:
+        """complate the prompt and yield the response chunks (async)"""
+        key = prompt_session.get()
+        data = self._payload(self._continue({
+            "prompt": prompt,
+            "stream": True,
+        }, key), max_tokens, options)
+        text = []
+        async for response_data in self._aiter_lines("generate", data):
+            text.append(response_data.get('response') or '')
+            if response_data.get('done'):
+                self._record(key, prompt, ''.join(text), response_data)
+            yield response_data
+
+    async def achat(
+            self, 
+            messages:list[dict[str, str]], 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> dict[str, str]:
+        data = self._payload({
+            "messages": messages,
+            "stream": False,
+        }, max_tokens, options)
+        response = await self._apost("chat", data)
+        async with response:
+            if response.status != 200:
+                raise ValueError(f"Error: {response.status}, {await response.text()}")
+            response_data = await response.json(content_type=None)
+        self._record(
+            prompt_session.get(), 
+            render_messages(messages), 
+            render_messages([response_data['message']]), 
+            response_data)
+        return response_data['message']
+
+    async def astream_chat(
+            self, 
+            messages:list[dict[str, str]], 
+            max_tokens:int|None=None, 
+            options:dict|None=None) -> AsyncGenerator[dict[str, str], None]:
+        key = prompt_session.get()
+        data = self._payload({
+            "messages": messages,
+            "stream": True,
+        }, max_tokens, options)
+        text = []
+        async for response_data in self._aiter_lines("chat", data):
+            text.append((response_data.get('message') or {}).get('content', ''))
+            if response_data.get('done'):
+                self._record(
+                    key, 
+                    render_messages(messages), 
+                    render_messages([{"role": "assistant", "content": ''.join(text)}]), 
+                    response_data)
+            yield response_data
+
+    async def warm_up(self) -> float:
+        """
+        空のプロンプトでモデルをメモリに読み込ませ、keep_aliveの間残しておく。
+        Returns: かかった秒数 (読み込み済みならほぼ0)
+        """
+        start = time.monotonic()
+        response = await self._apost("generate", self._payload({"prompt": "", "stream": False}))
+        async with response:
+            if response.status != 200:
+                raise ValueError(f"Error: {response.status}, {await response.text()}")
+            await response.read()
+        return time.monotonic() - start
+
+    async def keep_warm(
+            self, 
+            interval:float=240.0, 
+            active_hours:tuple[int, int]|None=None) -> None:
+        """
+        interval秒毎にwarm_upして、モデルがアンロードされないようにする。
+        active_hours=(開始, 終了) を指定するとその時間帯 (ローカル時刻) だけ行う。(22, 2) のように日をまたいでもよい。
+        """
+        while True:
+            if active_hours is None or in_hours(datetime.now().hour, active_hours):
+                try:
+                    elapsed = await self.warm_up()
+                    if elapsed > 1.0:
+                        print(f'{self.model_name} reloaded in {elapsed:.1f}s')
+                except Exception as e:
+                    print(f'keep warm failed: {e}')
+            await asyncio.sleep(interval)
+
+def in_hours(hour:int, hours:tuple[int, int]) -> bool:
+    start, end = hours
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
 if __name__ == '__main__':
     def value_from_env():
         api_key = os.environ['OLLAMA_API_KEY']
@@ -1,16 +1,20 @@
 import re
-import pathlib
 from langchain_core.language_models import BaseChatModel #type:ignore
-from langchain_core.messages import SystemMessage #type:ignore
-from langchain_community.document_loaders import AsyncChromiumLoader #type:ignore
-from langchain_community.document_transformers import BeautifulSoupTransformer #type:ignore
-from LangModel import LangModel as LM
-import OllamaLangModel
+import Summarizer
+import Metrics
+import PromptAssets
+import LeakFilter
 import urllib.parse
-from langchain.text_splitter import RecursiveCharacterTextSplitter #type:ignore
-from langchain_core.prompts import PromptTemplate #type:ignore
-import subprocess
+import asyncio
+import atexit
 import warnings
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from LangModel import LangModel as LM
+    import BrowserPool
+    import SummaryCache
+
+# LangModel (aiohttp) とBrowserPoolは使うときにimportする (Botの起動時に読み込まない)
 
 def get_name(author)->str:
     if author.display_name is not None:
@@ -38,24 +42,14 @@ def sanitize_breakrow(message:str)->str:
     content = re.sub(pattern, r'\n', message)
     return content
 
-def ban_system_prompt(message:str)->str:
+def ban_system_prompt(message:str, keywords:list[str]|None=None)->str:
     '''
     システムプロンプトを出力していたらそれを削除する
+    keywordsを省略した場合は/prompts/system_prompt_keywords.txtの内容を使う (読み込みは初回のみ)
     '''
-    # TODO path がハードコードされているので修正する
-    path = '/prompts/system_prompt_keywords.txt'
-    path = pathlib.Path(path)
-    if not path.exists():
-        return message
-    with open(path, 'r') as f:
-        keywords = f.readlines()
-    keyword_count = 0
-    for keyword in keywords:
-        if keyword in message:
-            keyword_count += 1
-    if keyword_count >= len(keywords) * 0.2:
-        return '検閲により削除済み'
-    return message
+    if keywords is None:
+        keywords = PromptAssets.default().keywords()
+    return LeakFilter.default().censor(message, keywords)
 
 
 def has_url(message:str) -> bool|list[str]:
@@ -84,18 +78,77 @@ def remove_encoded_url(message:str) -> str:
     url_pattern = r'%[0-9A-Fa-f]{2}'
     return re.sub(url_pattern, '', message)
 
+# summarize (同期版) で使い回すイベントループとブラウザプール
+# Playwrightのブラウザは起動したループでしか使えないので、ループごと残しておく
+_loop: asyncio.AbstractEventLoop|None = None
+_script_pool: 'BrowserPool.BrowserPool|None' = None
+
+def _script_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        atexit.register(_close_script_loop)
+    return _loop
+
+def _close_script_loop() -> None:
+    global _loop, _script_pool
+    if _loop is None or _loop.is_closed():
+        return
+    if _script_pool is not None:
+        _loop.run_until_complete(_script_pool.close())
+        _script_pool = None
+    _loop.close()
+    _loop = None
+
 def summarize(
         url:str, 
         lang_model:BaseChatModel, 
         debug:bool=False,
         read_max_chars:int=20000, # ページの最大文字数　以降は読まない
         summarize_chunk_size:int=2000, # 要約のchunk size
-        summarize_max_chars:int=2000, # 要約の最大文字数
+        summarize_token_budget:int=1500, # 要約の最大トークン数
+        summarize_concurrency:int=4, # 同時に行う要約の数
+    ) -> tuple[str, list[str]]:
+    """
+    Synchronous wrapper of asummarize for scripts.
+    The browser pool and its event loop are kept between calls and closed at exit.
+    """
+    global _script_pool
+    loop = _script_loop()
+    if _script_pool is None:
+        import BrowserPool
+        _script_pool = BrowserPool.BrowserPool(size=1)
+    return loop.run_until_complete(asummarize(
+        url, 
+        lang_model, 
+        browser_pool=_script_pool,
+        debug=debug,
+        read_max_chars=read_max_chars,
+        summarize_chunk_size=summarize_chunk_size,
+        summarize_token_budget=summarize_token_budget,
+        summarize_concurrency=summarize_concurrency,
+    ))
+
+async def asummarize(
+        url:str, 
+        lang_model:BaseChatModel, 
+        browser_pool:'BrowserPool.BrowserPool',
+        debug:bool=False,
+        read_max_chars:int=20000, # ページの最大文字数　以降は読まない
+        summarize_chunk_size:int=2000, # 要約のchunk size
+        summarize_token_budget:int=1500, # 要約の最大トークン数
+        summarize_concurrency:int=4, # 同時に行う要約の数
+        cache:'SummaryCache.SummaryCache|None'=None, # 要約のキャッシュ
+        page_content:str|None=None, # 取得済みの本文 (指定するとブラウザで読み込まない)
+        limiter:asyncio.Semaphore|None=None, # LLM呼び出しの全体の同時実行数の制限
     ) -> tuple[str, list[str]]:
     """
     Summarizes the given URL.
+    Chunks are summarized concurrently and the partial summaries are reduced
+    in a tree until they fit in summarize_token_budget.
     Args:
         url (str): The URL to summarize.
+        browser_pool (BrowserPool.BrowserPool): The browser pool used to render the page.
     Returns:
         str: The summarized content.
     """
@@ -105,19 +158,13 @@ def summarize(
     if debug:
         print('summarize url:', url)
     
-    # Load HTML
-    page_content = subprocess.run(
-        ['python', 'page_loader.py', '--url', url],
-        text=True,
-        capture_output=True
-    ).stdout
+    if page_content is None:
+        # Load HTML (常駐しているブラウザのプールから借りる)
+        with Metrics.span('summarize.load'):
+            page_content = await browser_pool.load_text(url)
     page_content = remove_url(page_content)
     page_content = remove_encoded_url(page_content)
     
-    prompt_template = PromptTemplate(
-        input_variables=['page_content'],
-        template='要約タスク: 以下の文章を要約してください。どんな言語でも要約を日本語で行ってください。\n\n{page_content}'
-    )
     if len(page_content) > read_max_chars:
         # ページの最大文字数を超えた場合は、最大文字数までに切り捨てる
         # その旨の情報を追加
@@ -126,32 +173,20 @@ def summarize(
         # 警告も表示
         warnings.warn(f'The page content is too long. Only the first {read_max_chars} characters were read.')
     
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=summarize_chunk_size, chunk_overlap=summarize_chunk_size//10)
-    summarized_page_content = page_content
-    if debug:
-        loop_count = 0
-    current_summarized_chars = len(summarized_page_content)
-    while len(summarized_page_content) > summarize_max_chars:
+    summarizer = Summarizer.MapReduceSummarizer(
+        lang_model,
+        concurrency=summarize_concurrency,
+        chunk_size=summarize_chunk_size,
+        token_budget=summarize_token_budget,
+        cache=cache,
+        limiter=limiter,
+    )
+    with Metrics.span('summarize.map_reduce', chars=len(page_content)):
+        summarized_page_content = await summarizer.summarize(page_content)
+    for report in summarizer.reports:
+        info.append(f'info: {report}')
         if debug:
-            loop_count += 1
-            print('loop_count:', loop_count)
-            print('current summarized chars:', len(summarized_page_content))
-        split_texts = text_splitter.split_text(summarized_page_content)
-        next_summarized_page_content = []
-        for text_chunk in split_texts:
-            messages = [
-                SystemMessage(content=prompt_template.format(page_content=text_chunk)),
-            ]
-            response = lang_model.invoke(messages)
-            next_summarized_page_content.append(response.content)
-            if debug:
-                print('summarize response:', response)
-        summarized_page_content = '\n\n'.join(next_summarized_page_content)
-        next_summarized_chars = len(summarized_page_content)
-        # 増えたら終了
-        if current_summarized_chars <= next_summarized_chars:
-            break
-        current_summarized_chars = next_summarized_chars
+            print(report)
 
     if debug:
         print('page content:', page_content)
@@ -168,7 +203,7 @@ def summarize(
 
 
 # 返答すべきか考える関数
-def should_reply(model:LM, messages:list[dict[str, str]], debug:bool=False) -> bool:
+def should_reply(model:'LM', messages:list[dict[str, str]], debug:bool=False) -> bool:
     """
     Determines whether the AI assistant should reply based on the given conversation messages.
     Args:
@@ -223,8 +258,10 @@ if __name__ == '__main__':
             "Content-Type": "application/json",
         }
         return api_key, api_url, headers
+    import OllamaLangModel
+    import LangModel
     api_key, api_url, headers = value_from_env()
-    lm = LM(api_key, api_url, "gemma2:9b")
+    lm = LangModel.LangModel(api_key, api_url, "gemma2:9b")
     lang_model = OllamaLangModel.OllamaAPIChatModel(
         lang_model=lm
     )
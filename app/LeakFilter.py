@@ -0,0 +1,132 @@
+import math
+import unicodedata
+from collections import OrderedDict, deque
+
+CENSORED = '検閲により削除済み'
+
+def normalize(text:str) -> str:
+    """NFKCで正規化し、小文字にして空白を取り除く"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    return ''.join(c for c in text if not c.isspace())
+
+class KeywordAutomaton:
+    """
+    正規化したキーワードから作るAho-Corasickオートマトン。
+    文章の長さに比例する時間で、含まれている全てのキーワードを見つける。
+    """
+    def __init__(self, keywords:list[str]):
+        self.keywords: list[str] = []
+        seen = set()
+        for keyword in keywords:
+            keyword = normalize(keyword)
+            if keyword and keyword not in seen:
+                seen.add(keyword)
+                self.keywords.append(keyword)
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[tuple[int, ...]] = [()]
+        for index, keyword in enumerate(self.keywords):
+            state = 0
+            for c in keyword:
+                next_state = self._goto[state].get(c)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][c] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                state = next_state
+            self._output[state] = self._output[state] + (index,)
+        # 幅優先で失敗遷移を作り、出力を失敗先の分まで合わせておく
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(c, 0)
+                self._fail[next_state] = fail
+                self._output[next_state] = self._output[next_state] + self._output[fail]
+
+    def step(self, state:int, c:str) -> int:
+        while state and c not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(c, 0)
+
+    def output(self, state:int) -> tuple[int, ...]:
+        return self._output[state]
+
+    def __len__(self) -> int:
+        return len(self.keywords)
+
+class LeakScanner:
+    """
+    ストリーミング中の返信をchunk毎に受け取り、漏洩を検出した時点でleakedをTrueにする。
+    chunkの境界をまたぐキーワードも検出できる。
+    """
+    def __init__(self, automaton:KeywordAutomaton, ratio:float=0.2):
+        self.automaton = automaton
+        self.threshold = max(1, math.ceil(len(automaton) * ratio)) if len(automaton) else 0
+        self.state = 0
+        self.matched: set[int] = set()
+        self.leaked = False
+
+    def feed(self, chunk:str) -> bool:
+        """chunkを追加する。漏洩を検出したらTrueを返す"""
+        if self.leaked or not self.threshold:
+            return self.leaked
+        automaton = self.automaton
+        state = self.state
+        for c in normalize(chunk):
+            state = automaton.step(state, c)
+            output = automaton.output(state)
+            if output:
+                self.matched.update(output)
+                if len(self.matched) >= self.threshold:
+                    self.leaked = True
+                    break
+        self.state = state
+        return self.leaked
+
+class LeakFilter:
+    """
+    キーワードのうちratio以上の割合が返信に含まれていれば、システムプロンプトの漏洩とみなす。
+    キーワードの組み合わせ毎にオートマトンをキャッシュする。
+    """
+    def __init__(self, ratio:float=0.2, cache_size:int=32):
+        self.ratio = ratio
+        self.cache_size = cache_size
+        self._automata: OrderedDict[tuple[str, ...], KeywordAutomaton] = OrderedDict()
+        self.stats = {'checked': 0, 'leaked': 0}
+
+    def automaton(self, keywords:list[str]) -> KeywordAutomaton:
+        key = tuple(keywords)
+        automaton = self._automata.get(key)
+        if automaton is None:
+            automaton = KeywordAutomaton(keywords)
+            self._automata[key] = automaton
+            while len(self._automata) > self.cache_size:
+                self._automata.popitem(last=False)
+        else:
+            self._automata.move_to_end(key)
+        return automaton
+
+    def scanner(self, keywords:list[str]) -> LeakScanner:
+        return LeakScanner(self.automaton(keywords), self.ratio)
+
+    def is_leaked(self, text:str, keywords:list[str]) -> bool:
+        self.stats['checked'] += 1
+        leaked = self.scanner(keywords).feed(text)
+        if leaked:
+            self.stats['leaked'] += 1
+        return leaked
+
+    def censor(self, text:str, keywords:list[str]) -> str:
+        return CENSORED if self.is_leaked(text, keywords) else text
+
+_default = LeakFilter()
+
+def default() -> LeakFilter:
+    return _default
@@ -0,0 +1,288 @@
+import json
+import time
+import uuid
+import contextvars
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from aiohttp import web #type:ignore
+
+# 処理時間のヒストグラムの区切り (秒)
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names:tuple[str, ...], values:tuple, extra:str='') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value:float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name:str, help:str, labelnames:tuple[str, ...]=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels:dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self) -> list[str]:
+        return []
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}', *self.samples()]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name:str, help:str, labelnames:tuple[str, ...]=()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount:float=1.0, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def items(self) -> dict[tuple, float]:
+        """ラベル -> 値"""
+        return dict(self._values)
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in sorted(self._values.items())]
+
+class Gauge(Metric):
+    """値をset()するか、set_function()で読み出し時に計算する"""
+    kind = 'gauge'
+
+    def __init__(self, name:str, help:str, labelnames:tuple[str, ...]=()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._functions: dict[tuple, object] = {}
+
+    def set(self, value:float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function, **labels) -> None:
+        self._functions[self._key(labels)] = function
+
+    def samples(self) -> list[str]:
+        values = dict(self._values)
+        for key, function in self._functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                continue
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in sorted(values.items())]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name:str,
+            help:str,
+            labelnames:tuple[str, ...]=(),
+            buckets:tuple[float, ...]=DEFAULT_BUCKETS,
+        ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # ラベル -> (バケット毎の件数, 合計, 件数)
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value:float, **labels) -> None:
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = [[0] * len(self.buckets), 0.0, 0]
+            self._values[key] = entry
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def totals(self) -> dict[tuple, tuple[float, int]]:
+        """ラベル -> (合計, 件数)"""
+        return {key: (total, count) for key, (_, total, count) in self._values.items()}
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="{}"'.format(_format_value(bound))
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+class StatsCollector(Metric):
+    """
+    各クラスのstats辞書 (キャッシュのヒット数など) をそのままカウンタとして公開する。
+    stats辞書の値はスクレイプ時に読み出す。
+    """
+    kind = 'counter'
+
+    def __init__(self, name:str, help:str, label:str='event'):
+        super().__init__(name, help, ('component', label))
+        self._sources: dict[str, object] = {}
+
+    def register(self, component:str, stats_getter) -> None:
+        self._sources[component] = stats_getter
+
+    def samples(self) -> list[str]:
+        lines = []
+        for component, getter in sorted(self._sources.items()):
+            try:
+                stats = getter()
+            except Exception:
+                continue
+            for event, value in sorted(stats.items()):
+                lines.append(
+                    f'{self.name}{_format_labels(self.labelnames, (component, event))} {_format_value(value)}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric:Metric) -> Metric:
+        # 同じ名前は同じメトリクスを返す (モジュールの再読み込み対策)
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name:str, help:str, labelnames:tuple[str, ...]=()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name:str, help:str, labelnames:tuple[str, ...]=()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name:str, help:str, labelnames:tuple[str, ...]=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'discord_bot_stage_seconds', 'Time spent in each stage of the reply pipeline.', ('stage',))
+STAGE_ERRORS = REGISTRY.counter(
+    'discord_bot_stage_errors_total', 'Exceptions raised by each stage of the reply pipeline.', ('stage',))
+REQUESTS = REGISTRY.counter(
+    'discord_bot_requests_total', 'Answered mention batches by route.', ('route',))
+LLM_TOKENS = REGISTRY.counter(
+    'discord_bot_llm_tokens_total', 'LLM tokens by backend and direction (prompt/completion).', ('backend', 'kind'))
+LLM_ERRORS = REGISTRY.counter(
+    'discord_bot_llm_errors_total', 'Failed LLM requests by backend.', ('backend',))
+LLM_FIRST_TOKEN_SECONDS = REGISTRY.histogram(
+    'discord_bot_llm_first_token_seconds', 'Time to the first token by backend.', ('backend',))
+QUEUE_DEPTH = REGISTRY.gauge(
+    'discord_bot_queue_depth', 'Work waiting or running, by queue.', ('queue',))
+COMPONENT_EVENTS = REGISTRY.register(StatsCollector(
+    'discord_bot_component_events_total', 'Cache hits/misses and other events reported by components.'))
+STARTUP_SECONDS = REGISTRY.gauge(
+    'discord_bot_startup_seconds', 'Seconds from process start to each startup phase.', ('phase',))
+
+# 処理中のリクエストのIDと、現在のスパン
+request_id: contextvars.ContextVar[str|None] = contextvars.ContextVar('request_id', default=None)
+_current_span: contextvars.ContextVar[str|None] = contextvars.ContextVar('current_span', default=None)
+
+class Tracer:
+    """有効な場合、スパンの終了ごとに1行のJSONを出力する"""
+    def __init__(self, enabled:bool=False, sink=print):
+        self.enabled = enabled
+        self.sink = sink
+
+    def emit(self, record:dict) -> None:
+        if self.enabled:
+            self.sink(json.dumps(record, ensure_ascii=False))
+
+tracer = Tracer()
+
+def new_request() -> str:
+    """新しいリクエストIDを発行して、以降の同じタスク内のスパンに付ける"""
+    rid = uuid.uuid4().hex[:12]
+    request_id.set(rid)
+    _current_span.set(None)
+    return rid
+
+@contextmanager
+def span(stage:str, **attributes):
+    """
+    Usage:
+        with Metrics.span('search'):
+            results = await search_service.run(query)
+    処理時間をSTAGE_SECONDSに記録し、例外はSTAGE_ERRORSに数える。
+    """
+    span_id = uuid.uuid4().hex[:8]
+    parent = _current_span.get()
+    token = _current_span.set(span_id)
+    start = time.monotonic()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.monotonic() - start
+        _current_span.reset(token)
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if tracer.enabled:
+            record = {
+                'request_id': request_id.get(),
+                'span': span_id,
+                'parent': parent,
+                'stage': stage,
+                'seconds': round(elapsed, 6),
+            }
+            if error is not None:
+                record['error'] = error
+            record.update(attributes)
+            tracer.emit(record)
+
+def mark_startup(phase:str, started_at:float) -> float:
+    """started_at (time.monotonic()) からの秒数をSTARTUP_SECONDSに記録する"""
+    elapsed = time.monotonic() - started_at
+    STARTUP_SECONDS.set(elapsed, phase=phase)
+    return elapsed
+
+def record_usage(backend:str, prompt_tokens:int, completion_tokens:int) -> None:
+    LLM_TOKENS.inc(prompt_tokens, backend=backend, kind='prompt')
+    LLM_TOKENS.inc(completion_tokens, backend=backend, kind='completion')
+
+async def serve(host:str='127.0.0.1', port:int=9108, registry:Registry=REGISTRY) -> 'web.AppRunner':
+    """/metrics をPrometheusのテキスト形式で返すHTTPサーバーを起動する"""
+    from aiohttp import web #type:ignore
+    async def metrics(request):
+        return web.Response(
+            text=registry.render(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
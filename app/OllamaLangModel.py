@@ -1,6 +1,8 @@
-from typing import Any, Dict, List, Optional, Iterator
+from typing import Any, Dict, List, Optional, Iterator, AsyncIterator
 from langchain_core.callbacks import CallbackManagerForLLMRun #type:ignore
-from langchain_core.callbacks.manager import CallbackManagerForLLMRun #type:ignore
+from langchain_core.callbacks.manager import ( #type:ignore
+    CallbackManagerForLLMRun, 
+    AsyncCallbackManagerForLLMRun)
 from langchain_core.language_models import BaseChatModel #type:ignore
 from langchain_core.language_models.llms import LLM #type:ignore
 from langchain_core.messages import AIMessage, BaseMessage, AIMessageChunk #type:ignore
@@ -12,6 +14,10 @@ from langchain_core.outputs import ( #type:ignore
 import LangModel
 import asyncio
 
+def request_options(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """max_tokens / options given to invoke() are passed on to lang_model as request-level settings"""
+    return {"max_tokens": kwargs.get("max_tokens"), "options": kwargs.get("options")}
+
 class OllamaAPIModel(LLM):
     """
     OllamaAPIModel is a subclass of LLM that interfaces with a language model to generate responses to input prompts.
@@ -42,7 +48,21 @@ class OllamaAPIModel(LLM):
         """
         if stop is not None:
             raise ValueError("stop kwargs are not permitted.")
-        return self.lang_model.generate(prompt)
+        return self.lang_model.generate(prompt, **request_options(kwargs))
+    
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        """
+        generates a response to the input prompt without blocking the event loop
+        """
+        if stop is not None:
+            raise ValueError("stop kwargs are not permitted.")
+        return await self.lang_model.agenerate(prompt, **request_options(kwargs))
     
     def _stream(
         self,
@@ -56,7 +76,7 @@ class OllamaAPIModel(LLM):
         """
         if stop is not None:
             raise ValueError("stop kwargs are not permitted.")
-        for response in self.lang_model.stream_generate(prompt):
+        for response in self.lang_model.stream_generate(prompt, **request_options(kwargs)):
             if 'response' in response:
                 content = response['response']
                 chunk = GenerationChunk(text=content)
@@ -64,6 +84,26 @@ class OllamaAPIModel(LLM):
                     run_manager.on_llm_new_token(content, chunk=chunk)
                 yield chunk
 
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        """
+        generates a response to the input prompt without blocking the event loop
+        """
+        if stop is not None:
+            raise ValueError("stop kwargs are not permitted.")
+        async for response in self.lang_model.astream_generate(prompt, **request_options(kwargs)):
+            if 'response' in response:
+                content = response['response']
+                chunk = GenerationChunk(text=content)
+                if run_manager is not None:
+                    await run_manager.on_llm_new_token(content, chunk=chunk)
+                yield chunk
+
     @property
     def _identifying_params(self) -> Dict[str, Any]:
         return {"model_name": self.lang_model.model_name,}
@@ -85,6 +125,8 @@ class OllamaAPIChatModel(BaseChatModel):
             Overrides the _generate method to implement the chat model logic. This method can call an API, a local model, or any other implementation to generate a response to the input prompt.
         _stream(messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
             Overrides the _stream method to implement the chat model logic. This method can call an API, a local model, or any other implementation to generate a response to the input prompt.
+        _agenerate / _astream:
+            Async counterparts of _generate / _stream backed by the shared aiohttp connection pool.
         _llm_type() -> str:
             Returns the type of the language model.
         _identifying_params() -> Dict[str, Any]:
@@ -121,7 +163,7 @@ class OllamaAPIChatModel(BaseChatModel):
             raise ValueError("stop kwargs are not permitted.")
         
         messages = self._messages_format(messages)
-        message:str = self.lang_model.chat(messages)
+        message:str = self.lang_model.chat(messages, **request_options(kwargs))
         generation = ChatGeneration(
             message=AIMessage(content=message['content']))
         return ChatResult(generations=[generation])
@@ -130,18 +172,18 @@ class OllamaAPIChatModel(BaseChatModel):
         self,
         messages: List[BaseMessage],
         stop: Optional[List[str]] = None,
-        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
         **kwargs: Any,
     ) -> ChatResult:
         """
-        Overrides the _generate method to implement the chat model logic.
-        This method can call an API, a local model, or any other implementation to generate a response to the input prompt.
+        Async counterpart of _generate. The request goes through the shared aiohttp
+        connection pool of lang_model, so it does not block the event loop.
         """
         if stop is not None:
             raise ValueError("stop kwargs are not permitted.")
         
         messages = self._messages_format(messages)
-        message = self.lang_model.chat(messages)
+        message = await self.lang_model.achat(messages, **request_options(kwargs))
         content = message['content']
         generation = ChatGeneration(message=AIMessage(content=content))
         return ChatResult(generations=[generation])
@@ -162,7 +204,7 @@ class OllamaAPIChatModel(BaseChatModel):
             raise ValueError("stop kwargs are not permitted.")
         
         messages = self._messages_format(messages)
-        for response in self.lang_model.stream_generate(messages):
+        for response in self.lang_model.stream_chat(messages, **request_options(kwargs)):
             if 'message' in response and 'content' in response['message']:
                 content = response['message']['content']
                 chunk = ChatGenerationChunk(message=AIMessageChunk(content=content))
@@ -170,6 +212,29 @@ class OllamaAPIChatModel(BaseChatModel):
                     run_manager.on_llm_new_token(content, chunk=chunk)
                 yield chunk
 
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        """
+        Async counterpart of _stream. Chunks are read from the shared connection pool
+        so that other coroutines keep running while the model is generating.
+        """
+        if stop is not None:
+            raise ValueError("stop kwargs are not permitted.")
+        
+        messages = self._messages_format(messages)
+        async for response in self.lang_model.astream_chat(messages, **request_options(kwargs)):
+            if 'message' in response and 'content' in response['message']:
+                content = response['message']['content']
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=content))
+                if run_manager is not None:
+                    await run_manager.on_llm_new_token(content, chunk=chunk)
+                yield chunk
+
     @property
     def _llm_type(self) -> str:
         return "ollama_api_llm"
@@ -0,0 +1,147 @@
+import time
+import asyncio
+import hashlib
+from collections.abc import Awaitable, Callable
+
+class PreparedReply:
+    __slots__ = ('text', 'inputs_hash', 'prepared_at', 'refreshed')
+
+    def __init__(self, text:str|None, inputs_hash:str, prepared_at:float, refreshed:bool=False):
+        self.text = text
+        self.inputs_hash = inputs_hash
+        self.prepared_at = prepared_at
+        self.refreshed = refreshed
+
+def inputs_hash(inputs) -> str:
+    return hashlib.sha256(repr(inputs).encode('utf-8')).hexdigest()
+
+class _Pending:
+    """準備中の返信と、それを受け取るジョブの数"""
+    __slots__ = ('task', 'due', 'waiting')
+
+    def __init__(self, task:asyncio.Task, due:float):
+        self.task = task
+        self.due = due
+        self.waiting = 1
+
+class Precomputer:
+    """
+    定期投稿の返信を予定時刻より前に作っておく。
+    research(fresh) で検索結果などの入力を集め、generate(inputs) で返信を生成する。
+    refreshがTrueなら予定時刻のrefresh_margin秒前に入力をキャッシュを使わずに集め直し (fresh=True)、
+    変わっていれば作り直す。
+    同じチャンネル・同じ内容で、最初のジョブとの予定時刻の差がshare_window秒以内のジョブは1つの結果を共有する。
+    受け取られないまま予定時刻からexpire_after秒過ぎた結果は捨てる。
+    """
+    def __init__(
+            self,
+            share_window:float=300.0,
+            refresh:bool=True,
+            refresh_margin:float=60.0,
+            expire_after:float=600.0,
+        ):
+        self.share_window = share_window
+        self.refresh = refresh
+        self.refresh_margin = refresh_margin
+        self.expire_after = expire_after
+        # key -> 予定時刻の違う準備中の返信
+        self._tasks: dict[tuple, list[_Pending]] = {}
+        self.stats = {
+            'prepared': 0, 'shared': 0, 'refreshed': 0, 'used': 0, 'missed': 0, 'discarded': 0}
+
+    def key(self, channel_id:int, content:str) -> tuple:
+        return (channel_id, ' '.join(content.split()))
+
+    def _find(self, key:tuple, due:float) -> _Pending|None:
+        """予定時刻がshare_window秒以内で最も近いもの"""
+        candidates = [
+            pending for pending in self._tasks.get(key, ())
+            if abs(pending.due - due) <= self.share_window]
+        return min(candidates, key=lambda pending: abs(pending.due - due), default=None)
+
+    def _remove(self, key:tuple, pending:_Pending) -> None:
+        entries = self._tasks.get(key)
+        if entries is None or pending not in entries:
+            return
+        entries.remove(pending)
+        if not entries:
+            del self._tasks[key]
+
+    def _prune(self) -> None:
+        """受け取られなかった古い結果を捨てる"""
+        limit = time.time() - self.expire_after
+        for key, entries in list(self._tasks.items()):
+            for pending in [pending for pending in entries if pending.due < limit]:
+                pending.task.cancel()
+                self._remove(key, pending)
+                self.stats['discarded'] += 1
+
+    def prepare(
+            self,
+            key:tuple,
+            due:float,
+            research:Callable[[bool], Awaitable[object]],
+            generate:Callable[[object], Awaitable[str|None]],
+        ) -> asyncio.Task:
+        self._prune()
+        pending = self._find(key, due)
+        if pending is not None:
+            pending.waiting += 1
+            self.stats['shared'] += 1
+            return pending.task
+        task = asyncio.create_task(self._run(due, research, generate))
+        self._tasks.setdefault(key, []).append(_Pending(task, due))
+        self.stats['prepared'] += 1
+        return task
+
+    async def take(self, key:tuple, due:float) -> PreparedReply|None:
+        """準備済みの返信を受け取る。準備中なら完了を待つ"""
+        pending = self._find(key, due)
+        if pending is None:
+            self.stats['missed'] += 1
+            return None
+        pending.waiting -= 1
+        if pending.waiting <= 0:
+            self._remove(key, pending)
+        try:
+            prepared = await asyncio.shield(pending.task)
+        except Exception as e:
+            print(f'precompute failed: {e}')
+            self.stats['missed'] += 1
+            return None
+        self.stats['used'] += 1
+        return prepared
+
+    def discard(self, key:tuple, due:float) -> None:
+        """ジョブがキャンセルされた場合に呼ぶ。受け取るジョブがなくなったら準備を止める"""
+        pending = self._find(key, due)
+        if pending is None:
+            return
+        pending.waiting -= 1
+        if pending.waiting <= 0:
+            pending.task.cancel()
+            self._remove(key, pending)
+            self.stats['discarded'] += 1
+
+    async def _run(
+            self,
+            due:float,
+            research:Callable[[bool], Awaitable[object]],
+            generate:Callable[[object], Awaitable[str|None]],
+        ) -> PreparedReply:
+        inputs = await research(False)
+        prepared = PreparedReply(
+            await generate(inputs), inputs_hash(inputs), time.time())
+        if not self.refresh:
+            return prepared
+        wait = due - self.refresh_margin - time.time()
+        if wait <= 0:
+            return prepared
+        await asyncio.sleep(wait)
+        # 最初の取得から数分しか経っていないので、キャッシュを使うと同じ入力が返ってくる
+        inputs = await research(True)
+        new_hash = inputs_hash(inputs)
+        if new_hash != prepared.inputs_hash:
+            self.stats['refreshed'] += 1
+            prepared = PreparedReply(await generate(inputs), new_hash, time.time(), refreshed=True)
+        return prepared
@@ -0,0 +1,114 @@
+import os
+import asyncio
+import pathlib
+import threading
+
+SYSTEM_PROMPT = 'system_prompt.md'
+SYSTEM_PROMPT_KEYWORDS = 'system_prompt_keywords.txt'
+DEFAULT_SYSTEM_PROMPT = 'あなたは知識豊富なアシスタントです。会話を良く理解し、適切な返答を行います。基本的に日本語で答えてください。'
+
+class PromptAssets:
+    """
+    プロンプト関係のファイルを一度だけ読み込んでメモリに保持する。
+    root/{name} が全体用、root/guilds/{guild_id}/{name} がギルド毎の上書き。
+    watch() がバックグラウンドでmtimeを確認し、変更があれば読み込み直して丸ごと差し替えるので、
+    get() などの呼び出しではファイルシステムに触れない。
+    """
+    def __init__(
+            self,
+            root:str='/prompts',
+            names:tuple[str, ...]=(SYSTEM_PROMPT, SYSTEM_PROMPT_KEYWORDS),
+            poll_interval:float=5.0, # 秒
+        ):
+        self.root = pathlib.Path(root)
+        self.names = names
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        # (name, guild_id) -> (mtime, 内容)
+        self._values: dict[tuple[str, int|None], tuple[float, str]] = {}
+        self.reloads = 0
+        self.refresh()
+
+    def _paths(self) -> dict[tuple[str, int|None], pathlib.Path]:
+        paths = {}
+        for name in self.names:
+            paths[(name, None)] = self.root / name
+        guilds = self.root / 'guilds'
+        if guilds.is_dir():
+            for guild_dir in guilds.iterdir():
+                if not guild_dir.is_dir() or not guild_dir.name.isdigit():
+                    continue
+                for name in self.names:
+                    paths[(name, int(guild_dir.name))] = guild_dir / name
+        return paths
+
+    def refresh(self) -> bool:
+        """mtimeが変わったファイルだけ読み込み直す。変更があればTrueを返す"""
+        with self._lock:
+            current = self._values
+            values = {}
+            changed = False
+            for key, path in self._paths().items():
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                old = current.get(key)
+                if old is not None and old[0] == mtime:
+                    values[key] = old
+                    continue
+                try:
+                    with open(path, 'r') as f:
+                        values[key] = (mtime, f.read())
+                except OSError:
+                    continue
+                changed = True
+            if set(values) != set(current):
+                changed = True
+            if changed:
+                # 辞書ごと差し替えるので、読み込み中の値が見えることはない
+                self._values = values
+                self.reloads += 1
+            return changed
+
+    async def watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                print(f'prompt assets refresh failed: {e}')
+
+    def get(self, name:str, guild_id:int|None=None) -> str|None:
+        values = self._values
+        if guild_id is not None and (name, guild_id) in values:
+            return values[(name, guild_id)][1]
+        entry = values.get((name, None))
+        return entry[1] if entry is not None else None
+
+    def lines(self, name:str, guild_id:int|None=None) -> list[str]:
+        """空行を除いた各行 (前後の空白と改行は取り除く)"""
+        text = self.get(name, guild_id)
+        if text is None:
+            return []
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+    def system_prompt(self, guild_id:int|None=None) -> str:
+        prompt = self.get(SYSTEM_PROMPT, guild_id)
+        return prompt if prompt is not None else DEFAULT_SYSTEM_PROMPT
+
+    def keywords(self, guild_id:int|None=None) -> list[str]:
+        return self.lines(SYSTEM_PROMPT_KEYWORDS, guild_id)
+
+_default: PromptAssets|None = None
+
+def default() -> PromptAssets:
+    """/prompts を読む共有のインスタンス"""
+    global _default
+    if _default is None:
+        _default = PromptAssets()
+    return _default
+
+def set_default(assets:PromptAssets) -> None:
+    global _default
+    _default = assets
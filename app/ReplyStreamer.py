@@ -0,0 +1,136 @@
+import time
+import LangTools
+import LeakFilter
+
+# Discordの1メッセージあたりの最大文字数
+DISCORD_MAX_CHARS = 2000
+
+def split_pages(text:str, max_chars:int=DISCORD_MAX_CHARS) -> list[str]:
+    """
+    Splits text into pages of at most max_chars characters.
+    Pages are cut at the last line break when possible so that a page boundary
+    does not move once the text has grown past it.
+    """
+    pages = []
+    while len(text) > max_chars:
+        cut = text.rfind('\n', 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        pages.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    pages.append(text)
+    return pages
+
+class ReplyStreamer:
+    """
+    LLMのストリーミング出力を受け取りながら、Discordの返信メッセージを逐次編集する。
+    編集はedit_interval秒に1回までにまとめ、max_charsを超えたら新しいメッセージに続きを送信する。
+    Usage:
+        streamer = ReplyStreamer(message, prefix='**Webを検索中...**\\n\\n')
+        await streamer.start()
+        async for chunk in llm.astream(messages):
+            if not await streamer.feed(chunk.content):
+                break
+        text = await streamer.finish()
+    scannerを渡すと、システムプロンプトの漏洩を検出した時点で返信を検閲済みに置き換えて打ち切る。
+    """
+    def __init__(
+            self,
+            message,
+            prefix:str='',
+            placeholder:str='…',
+            edit_interval:float=1.0, # Discordの編集レート制限(5回/5秒)に収まるように
+            max_chars:int=DISCORD_MAX_CHARS,
+            scanner:LeakFilter.LeakScanner|None=None,
+        ):
+        self.message = message
+        self.prefix = prefix
+        self.placeholder = placeholder
+        self.edit_interval = edit_interval
+        self.max_chars = max_chars
+        self.scanner = scanner
+        self.aborted = False
+        self.text = ''
+        self.sent = [] # 送信済みのdiscord.Message
+        self.shown:list[str] = [] # 各メッセージに表示中の内容
+        self._last_flush = 0.0
+
+    async def start(self) -> None:
+        """プレースホルダーを即座に送信する"""
+        await self._show(0, self.prefix + self.placeholder)
+        self._last_flush = time.monotonic()
+
+    async def feed(self, chunk:str) -> bool:
+        """
+        生成されたトークンを追加し、前回の編集からedit_interval秒以上経っていれば反映する。
+        漏洩を検出して打ち切った場合はFalseを返すので、呼び出し側は生成を止める。
+        """
+        if self.aborted:
+            return False
+        if not chunk:
+            return True
+        self.text += chunk
+        if self.scanner is not None and self.scanner.feed(chunk):
+            await self.abort()
+            return False
+        if time.monotonic() - self._last_flush >= self.edit_interval:
+            await self.flush()
+        return True
+
+    async def abort(self) -> None:
+        """送信済みの内容を検閲済みに置き換え、続きのメッセージは削除する"""
+        self.aborted = True
+        self.text = LeakFilter.CENSORED
+        await self._show(0, self.prefix + LeakFilter.CENSORED)
+        for sent in self.sent[1:]:
+            await sent.delete()
+        del self.sent[1:]
+        del self.shown[1:]
+
+    async def fail(self, notice:str='(返信の生成に失敗しました)') -> None:
+        """
+        生成が途中で失敗した場合に呼ぶ。
+        何も表示していなければプレースホルダーを削除し、途中まで表示していれば失敗したことを書き足す。
+        呼び出し元の例外を優先するので、ここでの送信の失敗は無視する。
+        """
+        self.aborted = True
+        try:
+            if not self.text.strip():
+                for sent in self.sent:
+                    await sent.delete()
+                self.sent.clear()
+                self.shown.clear()
+                return
+            content = f'{self.prefix}{LangTools.sanitize_breakrow(self.text)}\n\n{notice}'
+            for i, page in enumerate(split_pages(content, self.max_chars)):
+                await self._show(i, page)
+        except Exception as e:
+            print(f'failed to clean up the reply: {e}')
+
+    async def flush(self) -> None:
+        if self.aborted:
+            return
+        content = self.prefix + LangTools.sanitize_breakrow(self.text)
+        if not content.strip():
+            return
+        for i, page in enumerate(split_pages(content, self.max_chars)):
+            await self._show(i, page)
+        self._last_flush = time.monotonic()
+
+    async def finish(self) -> str:
+        """残りを反映して、送信した全文を返す"""
+        await self.flush()
+        return LangTools.sanitize_breakrow(self.text)
+
+    async def _show(self, index:int, page:str) -> None:
+        if index < len(self.sent):
+            if self.shown[index] != page:
+                await self.sent[index].edit(content=page)
+                self.shown[index] = page
+            return
+        if index == 0:
+            sent = await self.message.reply(page)
+        else:
+            sent = await self.sent[-1].channel.send(page)
+        self.sent.append(sent)
+        self.shown.append(page)
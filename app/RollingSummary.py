@@ -0,0 +1,174 @@
+import time
+import sqlite3
+import asyncio
+import pathlib
+import threading
+from contextlib import nullcontext
+from langchain_core.language_models import BaseChatModel #type:ignore
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage #type:ignore
+from Tokenizer import estimate_tokens
+
+FOLD_TEMPLATE = '''あなたは会話の記録係です。
+これまでの会話の要約に新しい会話を反映して、要約を更新してください。
+登場人物、話題、決まったこと、未解決の質問を残し、{max_chars}文字以内の日本語で出力してください。要約以外は出力しないでください。
+
+# これまでの要約
+{summary}
+
+# 新しい会話
+{conversation}
+'''
+
+class SummaryStore:
+    """チャンネル毎の要約をSQLite (WALモード) に保存する"""
+    def __init__(self, path:str):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS summaries (
+                channel_id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )''')
+        self._conn.commit()
+
+    def load_all(self) -> dict[int, tuple[str, int]]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT channel_id, summary, last_message_id FROM summaries').fetchall()
+        return {channel_id: (summary, last_message_id) for channel_id, summary, last_message_id in rows}
+
+    def save(self, channel_id:int, summary:str, last_message_id:int) -> None:
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO summaries (channel_id, summary, last_message_id, updated_at) VALUES (?, ?, ?, ?)',
+                (channel_id, summary, last_message_id, time.time()))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+class RollingSummary:
+    """
+    直近の会話履歴からはみ出したメッセージを、チャンネル毎の要約に少しずつ畳み込む。
+    畳み込みは返信とは別のタスクで行い、はみ出した分がmin_fold_tokens以上たまった時だけLLMを呼ぶ。
+    ChannelHistoryのバッファから押し出されたメッセージ (evicted) は、畳み込むまでここで保持する。
+    limiterを渡すと、LLMはその枠を取ってから呼ぶ (返信と同じ同時実行数の制限に含める)。
+    """
+    def __init__(
+            self,
+            lang_model:BaseChatModel,
+            store:SummaryStore,
+            max_chars:int=800, # 要約の最大文字数
+            min_fold_tokens:int=400, # これだけたまったら畳み込む
+            limiter:asyncio.Semaphore|None=None,
+            max_evicted:int=500, # 畳み込めない間に保持する押し出されたメッセージの上限 (チャンネル毎)
+        ):
+        self.lang_model = lang_model
+        self.limiter = limiter
+        self.store = store
+        self.max_chars = max_chars
+        self.min_fold_tokens = min_fold_tokens
+        self.max_evicted = max_evicted
+        # channel_id -> (要約, 要約に含めた最後のmessage_id)
+        self._summaries: dict[int, tuple[str, int]] = store.load_all()
+        self._folding: dict[int, asyncio.Task] = {}
+        # channel_id -> 履歴のバッファから押し出されて、まだ要約に含めていないエントリ (古い順)
+        self._evicted: dict[int, list] = {}
+        self.stats = {'folds': 0, 'errors': 0}
+
+    def get(self, channel_id:int) -> str|None:
+        entry = self._summaries.get(channel_id)
+        return entry[0] if entry is not None and entry[0] else None
+
+    def evicted(self, channel_id:int, entry) -> None:
+        """ChannelHistoryのon_evict。押し出されたエントリは二度とdroppedに入らないので、ここで取っておく"""
+        _, last_message_id = self._summaries.get(channel_id, ('', 0))
+        if entry.message_id <= last_message_id:
+            return
+        evicted = self._evicted.setdefault(channel_id, [])
+        evicted.append(entry)
+        del evicted[:-self.max_evicted]
+        self.schedule_fold(channel_id, [])
+
+    def schedule_fold(self, channel_id:int, dropped:list, before:int|None=None) -> None:
+        """
+        dropped: 古くて直近の会話に入らなかったChannelHistory.HistoryEntry (新しい順)
+        before: 答えているメッセージのID。これ以降のメッセージは畳み込まない
+        押し出されたものと合わせて、まだ要約に含めていないものがたまっていれば、バックグラウンドで畳み込む
+        """
+        if channel_id in self._folding:
+            return
+        _, last_message_id = self._summaries.get(channel_id, ('', 0))
+        evicted = self._evicted.get(channel_id, [])
+        evicted_ids = {entry.message_id for entry in evicted}
+        pending = evicted + [
+            entry for entry in reversed(dropped)
+            if entry.message_id > last_message_id and entry.message_id not in evicted_ids
+            and (before is None or entry.message_id < before)]
+        if not pending:
+            return
+        pending.sort(key=lambda entry: entry.message_id)
+        tokens = sum(estimate_tokens(entry.converted.content) for entry in pending)
+        if tokens < self.min_fold_tokens:
+            return
+        task = asyncio.create_task(self._fold(channel_id, pending))
+        self._folding[channel_id] = task
+        task.add_done_callback(lambda task: self._folded(channel_id, task))
+
+    def _folded(self, channel_id:int, task:asyncio.Task) -> None:
+        self._folding.pop(channel_id, None)
+        # 畳み込んでいる間に押し出された分がたまっていれば続けて畳み込む (失敗した場合は次の機会に回す)
+        if not task.cancelled() and task.exception() is None and task.result() and channel_id in self._evicted:
+            self.schedule_fold(channel_id, [])
+
+    def _format(self, entries:list) -> str:
+        lines = []
+        for entry in entries:
+            message = entry.converted
+            if isinstance(message, AIMessage):
+                lines.append(f'AI: {message.content}')
+            else:
+                lines.append(message.content)
+        return '\n'.join(lines)
+
+    async def _fold(self, channel_id:int, pending:list) -> bool:
+        summary, _ = self._summaries.get(channel_id, ('', 0))
+        prompt = FOLD_TEMPLATE.format(
+            max_chars=self.max_chars,
+            summary=summary or '(なし)',
+            conversation=self._format(pending),
+        )
+        try:
+            async with self.limiter or nullcontext():
+                response = await self.lang_model.ainvoke([
+                    SystemMessage(content=prompt),
+                    HumanMessage(content='要約を更新してください。'),
+                ])
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f'rolling summary failed: {e}')
+            return False
+        summary = response.content.strip()[:self.max_chars]
+        last_message_id = pending[-1].message_id
+        self._summaries[channel_id] = (summary, last_message_id)
+        # 畳み込んでいる間に押し出されたものは残す
+        evicted = [
+            entry for entry in self._evicted.pop(channel_id, [])
+            if entry.message_id > last_message_id]
+        if evicted:
+            self._evicted[channel_id] = evicted
+        self.stats['folds'] += 1
+        await asyncio.to_thread(self.store.save, channel_id, summary, last_message_id)
+        return True
+
+    async def close(self) -> None:
+        tasks = list(self._folding.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.store.close()
@@ -0,0 +1,239 @@
+import time
+import heapq
+import sqlite3
+import asyncio
+import pathlib
+import threading
+from collections.abc import Awaitable, Callable
+
+class ScheduledJob:
+    __slots__ = ('job_id', 'channel_id', 'message_id', 'content', 'due', 'recurrence', 'guild_id')
+
+    def __init__(
+            self,
+            job_id:int|None,
+            channel_id:int,
+            message_id:int,
+            content:str,
+            due:float, # UNIX時刻
+            recurrence:float|None=None, # 繰り返し間隔(秒) Noneなら1回だけ
+            guild_id:int|None=None, # シャード毎にジョブを分けるのに使う (DMならNone)
+        ):
+        self.job_id = job_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.content = content
+        self.due = due
+        self.recurrence = recurrence
+        self.guild_id = guild_id
+
+    def __repr__(self) -> str:
+        return f'ScheduledJob({self.job_id}, channel={self.channel_id}, due={self.due}, recurrence={self.recurrence})'
+
+class JobStore:
+    """ScheduledJobをSQLite (WALモード) に保存する"""
+    def __init__(self, path:str):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                due REAL NOT NULL,
+                recurrence REAL
+            )''')
+        # guild_idの列がない古いデータベースに追加する
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')]
+        if 'guild_id' not in columns:
+            self._conn.execute('ALTER TABLE jobs ADD COLUMN guild_id INTEGER')
+        self._conn.commit()
+
+    def add(self, job:ScheduledJob) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO jobs (channel_id, message_id, content, due, recurrence, guild_id) VALUES (?, ?, ?, ?, ?, ?)',
+                (job.channel_id, job.message_id, job.content, job.due, job.recurrence, job.guild_id))
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def update_due(self, job_id:int, due:float) -> None:
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET due = ? WHERE job_id = ?', (due, job_id))
+            self._conn.commit()
+
+    def remove(self, job_id:int) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+            self._conn.commit()
+
+    def load_all(self) -> list[ScheduledJob]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT job_id, channel_id, message_id, content, due, recurrence, guild_id FROM jobs').fetchall()
+        return [ScheduledJob(*row) for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+class Scheduler:
+    """
+    最小ヒープで次に実行するジョブを管理し、その時刻まで眠って実行する。
+    ジョブはJobStoreに保存され、起動時にload()で復元する。
+    preparerを渡すと、予定時刻のlead_time秒前にも呼び出す (返信の事前生成用)。
+    その時刻を既に過ぎているジョブは準備せずに実行だけする。
+    """
+    def __init__(
+            self,
+            store:JobStore,
+            handler:Callable[[ScheduledJob], Awaitable[None]],
+            preparer:Callable[[ScheduledJob], Awaitable[None]]|None=None,
+            lead_time:float=0.0, # 秒
+            on_cancel:Callable[[ScheduledJob], None]|None=None, # キャンセルされたジョブの後始末 (事前生成の破棄など)
+        ):
+        self.store = store
+        self.handler = handler
+        self.preparer = preparer
+        self.lead_time = lead_time
+        self.on_cancel = on_cancel
+        self._heap: list[tuple[float, int]] = []
+        # (準備を始める時刻, 予定時刻, job_id)
+        self._prepare_heap: list[tuple[float, float, int]] = []
+        self._jobs: dict[int, ScheduledJob] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task|None = None
+        self._running: set[asyncio.Task] = set()
+
+    def load(self, owns:Callable[[ScheduledJob], bool]|None=None) -> int:
+        """
+        保存されているジョブを復元する。停止中に期限が過ぎたものはすぐに実行される。
+        ownsを渡すと、それがTrueを返すジョブだけを受け持つ (シャードを分けた複数のプロセスで動かす場合)
+        """
+        for job in self.store.load_all():
+            if owns is None or owns(job):
+                self._push(job)
+        return len(self._jobs)
+
+    def _push(self, job:ScheduledJob) -> None:
+        self._jobs[job.job_id] = job
+        heapq.heappush(self._heap, (job.due, job.job_id))
+        self._push_prepare(job)
+        self._wakeup.set()
+
+    def _push_prepare(self, job:ScheduledJob) -> None:
+        if self.preparer is None or self.lead_time <= 0:
+            return
+        prepare_at = job.due - self.lead_time
+        # 準備の時刻を過ぎている (期限切れで復元した、直前に追加された) ジョブは、
+        # 準備と実行が続けて走り、準備の登録より先に実行してしまうので事前生成しない
+        if prepare_at <= time.time():
+            return
+        heapq.heappush(self._prepare_heap, (prepare_at, job.due, job.job_id))
+
+    async def add(self, job:ScheduledJob) -> ScheduledJob:
+        job.job_id = await asyncio.to_thread(self.store.add, job)
+        self._push(job)
+        return job
+
+    async def cancel(self, job_id:int) -> bool:
+        # ヒープからは取り出した時に読み飛ばす
+        job = self._jobs.pop(job_id, None)
+        if job is None:
+            return False
+        if self.on_cancel is not None:
+            self.on_cancel(job)
+        await asyncio.to_thread(self.store.remove, job_id)
+        return True
+
+    def pending(self) -> list[ScheduledJob]:
+        return sorted(self._jobs.values(), key=lambda job: job.due)
+
+    def count(self) -> int:
+        """予定されているジョブの数 (pending()のように並べ替えない)"""
+        return len(self._jobs)
+
+    def start(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            # キャンセル済みや更新前のエントリを読み飛ばす
+            while self._heap and self._stale(*self._heap[0]):
+                heapq.heappop(self._heap)
+            while self._prepare_heap and self._stale(*self._prepare_heap[0][1:]):
+                heapq.heappop(self._prepare_heap)
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            next_fire = self._heap[0][0]
+            next_prepare = self._prepare_heap[0][0] if self._prepare_heap else next_fire
+            delay = min(next_fire, next_prepare) - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if self._prepare_heap and next_prepare < next_fire:
+                _, _, job_id = heapq.heappop(self._prepare_heap)
+                self._spawn(self.preparer, self._snapshot(self._jobs[job_id]))
+                continue
+            _, job_id = heapq.heappop(self._heap)
+            # 繰り返しのジョブは_finishで次回の時刻に進むので、今回分を複製して渡す
+            fired = self._snapshot(self._jobs[job_id])
+            await self._finish(self._jobs[job_id])
+            self._spawn(self.handler, fired)
+
+    def _snapshot(self, job:ScheduledJob) -> ScheduledJob:
+        return ScheduledJob(
+            job.job_id, job.channel_id, job.message_id, job.content, job.due, job.recurrence, job.guild_id)
+
+    def _spawn(self, handler:Callable[[ScheduledJob], Awaitable[None]], job:ScheduledJob) -> None:
+        task = asyncio.create_task(self._dispatch(handler, job))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    def _stale(self, due:float, job_id:int) -> bool:
+        job = self._jobs.get(job_id)
+        return job is None or job.due != due
+
+    async def _finish(self, job:ScheduledJob) -> None:
+        """繰り返しのジョブは次回の時刻に進め、それ以外は削除する"""
+        if job.recurrence:
+            now = time.time()
+            due = job.due
+            while due <= now:
+                due += job.recurrence
+            job.due = due
+            heapq.heappush(self._heap, (job.due, job.job_id))
+            self._push_prepare(job)
+            await asyncio.to_thread(self.store.update_due, job.job_id, job.due)
+        else:
+            self._jobs.pop(job.job_id, None)
+            await asyncio.to_thread(self.store.remove, job.job_id)
+
+    async def _dispatch(
+            self, 
+            handler:Callable[[ScheduledJob], Awaitable[None]], 
+            job:ScheduledJob) -> None:
+        try:
+            await handler(job)
+        except Exception as e:
+            print(f'scheduled job {job.job_id} failed: {e}')
@@ -0,0 +1,160 @@
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class SearchResult:
+    __slots__ = ('title', 'snippet', 'link')
+
+    def __init__(self, title:str, snippet:str, link:str):
+        self.title = title
+        self.snippet = snippet
+        self.link = link
+
+    def __repr__(self) -> str:
+        return f'SearchResult({self.title!r}, {self.link!r})'
+
+def format_results(results:list[SearchResult], max_chars:int=3000) -> str:
+    """検索結果をプロンプトに入れる文字列にする。max_charsを超える分は入れない"""
+    lines = []
+    total = 0
+    for result in results:
+        line = f'- {result.title}: {result.snippet} ({result.link})'
+        if lines and total + len(line) > max_chars:
+            break
+        lines.append(line[:max_chars])
+        total += len(line)
+    return '\n'.join(lines)
+
+class SearchService:
+    """
+    検索バックエンド (DuckDuckGoSearchAPIWrapperなど、results()を持つもの) を
+    イベントループの外のスレッドプールで実行する。
+    同じ検索が同時に来た場合は1回だけ実行して結果を共有し、
+    結果は (query, region, time) 毎にttl秒キャッシュする。
+    backendの代わりにbackend_factoryを渡すと、初回の検索時に (importも含めて) スレッドプールで作る。
+    shared (SharedStore) を渡すと、結果を他のワーカープロセスとも共有する。
+    """
+    def __init__(
+            self,
+            backend=None,
+            max_workers:int=4,
+            ttl:float=600.0,
+            max_entries:int=512,
+            backend_factory=None,
+            shared=None,
+        ):
+        if backend is None and backend_factory is None:
+            raise ValueError('backend or backend_factory is required')
+        self.backend = backend
+        self._backend_factory = backend_factory
+        self._backend_lock = asyncio.Lock()
+        self.shared = shared
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='search')
+        self._cache: OrderedDict[tuple, tuple[float, list[SearchResult]]] = OrderedDict()
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self._variants: dict[tuple, object] = {}
+        self.stats = {'hit': 0, 'shared': 0, 'store_hit': 0, 'miss': 0, 'error': 0}
+
+    def _backend_for(self, region:str|None, time_window:str|None):
+        """regionやtimeが既定値と違う場合はその設定のバックエンドを作る"""
+        region = region or self.backend.region
+        time_window = time_window or self.backend.time
+        if region == self.backend.region and time_window == self.backend.time:
+            return self.backend
+        key = (region, time_window)
+        if key not in self._variants:
+            self._variants[key] = self.backend.copy(update={'region': region, 'time': time_window})
+        return self._variants[key]
+
+    async def _load_backend(self) -> None:
+        if self.backend is not None:
+            return
+        async with self._backend_lock:
+            if self.backend is None:
+                loop = asyncio.get_running_loop()
+                self.backend = await loop.run_in_executor(self._executor, self._backend_factory)
+
+    def _run(self, backend, query:str, max_results:int, key:tuple, fresh:bool=False) -> list[SearchResult]:
+        """スレッドプールで実行する。共有のストアにあればそれを使い、なければ検索して保存する"""
+        store_key = json.dumps(key, ensure_ascii=False)
+        if self.shared is not None and not fresh:
+            try:
+                stored = self.shared.get('search', store_key)
+            except Exception:
+                stored = None
+            if stored is not None:
+                self.stats['store_hit'] += 1
+                return [SearchResult(*result) for result in stored]
+        results = [
+            SearchResult(
+                result.get('title', ''),
+                result.get('snippet', ''),
+                result.get('link', ''))
+            for result in backend.results(query, max_results)
+        ]
+        if self.shared is not None:
+            try:
+                self.shared.set(
+                    'search', store_key, 
+                    [[result.title, result.snippet, result.link] for result in results], 
+                    ttl=self.ttl)
+            except Exception as e:
+                print(f'shared search cache unavailable: {e}')
+        return results
+
+    async def search(
+            self,
+            query:str,
+            region:str|None=None,
+            time_window:str|None=None,
+            max_results:int|None=None,
+            fresh:bool=False, # Trueならキャッシュを使わずに検索し直す (結果はキャッシュする)
+        ) -> list[SearchResult]:
+        await self._load_backend()
+        backend = self._backend_for(region, time_window)
+        max_results = max_results or self.backend.max_results
+        key = (' '.join(query.split()), backend.region, backend.time, max_results)
+
+        cached = self._cache.get(key) if not fresh else None
+        if cached is not None:
+            expires_at, results = cached
+            if time.monotonic() < expires_at:
+                self._cache.move_to_end(key)
+                self.stats['hit'] += 1
+                return results
+            del self._cache[key]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.stats['shared'] += 1
+            return await asyncio.shield(inflight)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self._run, backend, query, max_results, key, fresh)
+        self._inflight[key] = future
+        self.stats['miss'] += 1
+        try:
+            results = await asyncio.shield(future)
+        except Exception:
+            self.stats['error'] += 1
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        self._cache[key] = (time.monotonic() + self.ttl, results)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return results
+
+    async def run(self, query:str, max_chars:int=3000, **kwargs) -> str:
+        """DuckDuckGoSearchAPIWrapper.runの代わりに、プロンプト用の文字列を返す"""
+        results = await self.search(query, **kwargs)
+        if not results:
+            return 'No good DuckDuckGo Search Result was found'
+        return format_results(results, max_chars)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
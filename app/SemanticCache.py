@@ -0,0 +1,222 @@
+import re
+import time
+import zlib
+import hashlib
+import asyncio
+import unicodedata
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import numpy as np #type:ignore
+
+# numpyは読み込みに時間がかかるので、埋め込みモデルを読み込むとき (起動後のバックグラウンド) にimportする
+
+CHAT = 'chat'
+SEARCH = 'search'
+
+# 文末の記号は意味を変えないので取り除く
+TRAILING_PATTERN = re.compile(r'[\s?？!！。、.,~〜ー]+$')
+
+def normalize_question(text:str) -> str:
+    """NFKCで正規化し、小文字にして空白をまとめ、文末の記号を取り除く"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = ' '.join(text.split())
+    return TRAILING_PATTERN.sub('', text)
+
+def context_key(*parts:str) -> str:
+    """返答が依存する文脈 (直前の会話、発言者など) のハッシュ。同じ文脈の場合だけキャッシュを使う"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+class HashingEmbedder:
+    """
+    文字n-gramをハッシュして数えるだけの埋め込み。モデルが使えない場合の代わりで、
+    言い換えには弱いが、表記揺れ程度の同じ質問は拾える。
+    """
+    threshold = 0.85
+
+    def __init__(self, dim:int=1024, ngrams:tuple[int, ...]=(2, 3)):
+        self.dim = dim
+        self.ngrams = ngrams
+
+    def embed(self, texts:list[str]) -> 'np.ndarray':
+        import numpy as np #type:ignore
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for n in self.ngrams:
+                for i in range(max(len(text) - n + 1, 1)):
+                    vectors[row, zlib.crc32(text[i:i + n].encode('utf-8')) % self.dim] += 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+class FastEmbedEmbedder:
+    """fastembed (ONNX Runtime) によるCPU上の多言語の文埋め込み"""
+    threshold = 0.92
+
+    def __init__(self, model_name:str='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'):
+        from fastembed import TextEmbedding #type:ignore
+        self.model = TextEmbedding(model_name=model_name)
+
+    def embed(self, texts:list[str]) -> 'np.ndarray':
+        import numpy as np #type:ignore
+        vectors = np.array(list(self.model.embed(texts)), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+def default_embedder():
+    """fastembedがインストールされていればそれを、なければHashingEmbedderを使う"""
+    try:
+        return FastEmbedEmbedder()
+    except Exception as e:
+        print(f'fastembed unavailable, using hashing embedder: {e}')
+        return HashingEmbedder()
+
+class CachedAnswer:
+    __slots__ = ('question', 'kind', 'context', 'reply', 'expires')
+
+    def __init__(self, question:str, kind:str, context:str, reply:str, expires:float):
+        self.question = question
+        self.kind = kind
+        self.context = context
+        self.reply = reply
+        self.expires = expires
+
+class VectorIndex:
+    """1つのスコープ (チャンネルかギルド) の埋め込みを固定長のリングバッファに持つ"""
+    def __init__(self, capacity:int):
+        import numpy as np #type:ignore
+        self.capacity = capacity
+        self.vectors: 'np.ndarray|None' = None
+        self.answers: list[CachedAnswer|None] = [None] * capacity
+        # 期限切れと種類・文脈の違うものを一度にはじくための配列
+        self.expires = np.zeros(capacity, dtype=np.float64)
+        self.kinds = np.full(capacity, '', dtype=object)
+        self.contexts = np.full(capacity, '', dtype=object)
+        self._next = 0
+
+    def add(self, vector:'np.ndarray', answer:CachedAnswer) -> None:
+        import numpy as np #type:ignore
+        if self.vectors is None:
+            self.vectors = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+        # いっぱいなら一番古いものを上書きする
+        slot = self._next % self.capacity
+        self.vectors[slot] = vector
+        self.answers[slot] = answer
+        self.expires[slot] = answer.expires
+        self.kinds[slot] = answer.kind
+        self.contexts[slot] = answer.context
+        self._next += 1
+
+    def search(
+            self, 
+            vector:'np.ndarray', 
+            kind:str, 
+            context:str, 
+            now:float) -> tuple[CachedAnswer|None, float]:
+        import numpy as np #type:ignore
+        if self.vectors is None:
+            return None, 0.0
+        size = min(self._next, self.capacity)
+        similarities = self.vectors[:size] @ vector
+        valid = (
+            (self.expires[:size] > now) 
+            & (self.kinds[:size] == kind) 
+            & (self.contexts[:size] == context))
+        if not valid.any():
+            return None, 0.0
+        similarities = np.where(valid, similarities, -1.0)
+        best = int(np.argmax(similarities))
+        return self.answers[best], float(similarities[best])
+
+class SemanticCache:
+    """
+    繰り返される質問への返答のキャッシュ。
+    正規化した質問を埋め込み、同じスコープ (チャンネルかギルド) で同じ種類の返答のうち
+    コサイン類似度がthreshold以上のものがあれば、その返答を返す。
+    検索結果に基づく返答は古くなりやすいので、通常の会話より短いTTLにする。
+    contextを指定すると、文脈のハッシュが一致するものだけを返す (会話の流れに依存する返答用)。
+    埋め込みの計算はイベントループを止めないように別スレッドで行う。
+    埋め込みモデルはload()で読み込む。読み込みが終わるまでは常にキャッシュに外れる。
+    """
+    def __init__(
+            self,
+            embedder=None,
+            threshold:float|None=None, # 省略時は埋め込みに合わせた値
+            chat_ttl:float=6 * 60 * 60,
+            search_ttl:float=30 * 60,
+            capacity:int=256, # スコープ毎に保存する返答の数
+            max_scopes:int=1000,
+        ):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.ttls = {CHAT: chat_ttl, SEARCH: search_ttl}
+        self.capacity = capacity
+        self.max_scopes = max_scopes
+        self._indexes: OrderedDict[object, VectorIndex] = OrderedDict()
+        self._embedder_lock = asyncio.Lock()
+        self._loading: asyncio.Task|None = None
+        # lookupで外れた質問をstoreで埋め込み直さないように直近のものを覚えておく
+        self._vectors: OrderedDict[str, 'np.ndarray'] = OrderedDict()
+        self.stats = {'hit': 0, 'miss': 0, 'stored': 0}
+
+    async def load(self) -> None:
+        """埋め込みモデルを読み込む (ダウンロードを含むので起動時にバックグラウンドで呼ぶ)"""
+        async with self._embedder_lock:
+            if self.embedder is None:
+                self.embedder = await asyncio.to_thread(default_embedder)
+
+    def _ready(self) -> bool:
+        """モデルを読み込み済みか。まだなら読み込みを始めて、返答を待たせない"""
+        if self.embedder is not None:
+            return True
+        if self._loading is None:
+            self._loading = asyncio.create_task(self.load())
+        return False
+
+    async def _embed(self, question:str) -> 'np.ndarray':
+        vector = self._vectors.get(question)
+        if vector is not None:
+            self._vectors.move_to_end(question)
+            return vector
+        vector = (await asyncio.to_thread(self.embedder.embed, [question]))[0]
+        self._vectors[question] = vector
+        while len(self._vectors) > 256:
+            self._vectors.popitem(last=False)
+        return vector
+
+    def _threshold(self) -> float:
+        if self.threshold is not None:
+            return self.threshold
+        return self.embedder.threshold
+
+    async def lookup(self, scope, question:str, kind:str, context:str='') -> str|None:
+        question = normalize_question(question)
+        index = self._indexes.get(scope)
+        if not question or index is None or not self._ready():
+            self.stats['miss'] += 1
+            return None
+        self._indexes.move_to_end(scope)
+        vector = await self._embed(question)
+        answer, similarity = index.search(vector, kind, context, time.time())
+        if answer is None or similarity < self._threshold():
+            self.stats['miss'] += 1
+            return None
+        self.stats['hit'] += 1
+        return answer.reply
+
+    async def store(self, scope, question:str, kind:str, reply:str, context:str='') -> None:
+        question = normalize_question(question)
+        if not question or not reply or not self._ready():
+            return
+        vector = await self._embed(question)
+        index = self._indexes.get(scope)
+        if index is None:
+            index = VectorIndex(self.capacity)
+            self._indexes[scope] = index
+            while len(self._indexes) > self.max_scopes:
+                self._indexes.popitem(last=False)
+        index.add(vector, CachedAnswer(question, kind, context, reply, time.time() + self.ttls[kind]))
+        self.stats['stored'] += 1
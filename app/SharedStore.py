@@ -0,0 +1,102 @@
+import json
+import time
+import sqlite3
+import pathlib
+import threading
+
+class SQLiteStore:
+    """
+    同じホストの複数のワーカープロセスで共有するキャッシュ (SQLite, WALモード)。
+    namespace毎のキーに、JSONにできる値を有効期限付きで保存する。
+    呼び出しはブロックするので、イベントループからはasyncio.to_threadかスレッドプールで使う。
+    """
+    def __init__(self, path:str, max_entries:int=100000):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        # 他のプロセスが書き込み中ならtimeout秒まで待つ
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10.0)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires REAL,
+                PRIMARY KEY (namespace, key)
+            )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)')
+        self._conn.commit()
+
+    def get(self, namespace:str, key:str):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, expires FROM entries WHERE namespace = ? AND key = ?',
+                (namespace, key)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires < time.time():
+            return None
+        return json.loads(value)
+
+    def set(self, namespace:str, key:str, value, ttl:float|None=None) -> None:
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries (namespace, key, value, expires) VALUES (?, ?, ?, ?)',
+                (namespace, key, json.dumps(value, ensure_ascii=False), expires))
+            self._conn.commit()
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._evict()
+
+    def _evict(self) -> None:
+        """期限切れを削除し、max_entriesを超えた分は期限の近い順に削除する"""
+        self._conn.execute('DELETE FROM entries WHERE expires < ?', (time.time(),))
+        (count,) = self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                'DELETE FROM entries WHERE rowid IN '
+                '(SELECT rowid FROM entries ORDER BY expires IS NULL, expires LIMIT ?)',
+                (count - self.max_entries,))
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+class RedisStore:
+    """SQLiteStoreと同じ使い方で、Redisにキャッシュを保存する (複数のホストで共有する場合)"""
+    def __init__(self, url:str, prefix:str='discord-bot'):
+        import redis #type:ignore
+        self._client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, namespace:str, key:str) -> str:
+        return f'{self.prefix}:{namespace}:{key}'
+
+    def get(self, namespace:str, key:str):
+        value = self._client.get(self._key(namespace, key))
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, namespace:str, key:str, value, ttl:float|None=None) -> None:
+        self._client.set(
+            self._key(namespace, key),
+            json.dumps(value, ensure_ascii=False),
+            px=int(ttl * 1000) if ttl is not None else None)
+
+    def close(self) -> None:
+        self._client.close()
+
+def open_store(url:str):
+    """
+    'redis://host:6379/0' ならRedisStore、それ以外 (ファイルのパス) ならSQLiteStoreを返す
+    """
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    return SQLiteStore(url)
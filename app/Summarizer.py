@@ -0,0 +1,151 @@
+import time
+import asyncio
+from contextlib import nullcontext
+from collections.abc import Callable
+from langchain_core.language_models import BaseChatModel #type:ignore
+from langchain_core.messages import SystemMessage #type:ignore
+from langchain_core.prompts import PromptTemplate #type:ignore
+import SummaryCache
+from Tokenizer import estimate_tokens
+
+SUMMARIZE_TEMPLATE = '要約タスク: 以下の文章を要約してください。どんな言語でも要約を日本語で行ってください。\n\n{page_content}'
+
+class RoundReport:
+    """1ラウンド分のLLM呼び出し回数と所要時間"""
+    __slots__ = ('round', 'stage', 'calls', 'seconds', 'tokens_in', 'tokens_out')
+
+    def __init__(self, round:int, stage:str, calls:int, seconds:float, tokens_in:int, tokens_out:int):
+        self.round = round
+        self.stage = stage # 'map' / 'reduce'
+        self.calls = calls
+        self.seconds = seconds
+        self.tokens_in = tokens_in
+        self.tokens_out = tokens_out
+
+    def __str__(self) -> str:
+        return f'round {self.round} ({self.stage}): {self.calls} calls, {self.seconds:.2f}s, {self.tokens_in} -> {self.tokens_out} tokens'
+
+class MapReduceSummarizer:
+    """
+    文章をchunkに分けて並列に要約し (map)、要約同士をまとめて要約し直す (reduce) ことを
+    全体がtoken_budget以下になるまで木構造で繰り返す。
+    同時に実行するLLM呼び出しはconcurrencyまでに制限する。
+    limiter (asyncio.Semaphoreなど) を渡すと、各呼び出しはその枠も取ってから行う (ボット全体の同時実行数の制限)。
+    """
+    def __init__(
+            self,
+            lang_model:BaseChatModel,
+            concurrency:int=4,
+            chunk_size:int=2000, # mapで分割する文字数
+            token_budget:int=1500, # 最終的な要約のトークン数の上限
+            reduce_input_tokens:int=3000, # reduce 1回に入力するトークン数の上限
+            max_rounds:int=6,
+            count_tokens:Callable[[str], int]=estimate_tokens,
+            template:str=SUMMARIZE_TEMPLATE,
+            cache:SummaryCache.SummaryCache|None=None,
+            limiter:asyncio.Semaphore|None=None,
+        ):
+        self.lang_model = lang_model
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.token_budget = token_budget
+        self.reduce_input_tokens = reduce_input_tokens
+        self.max_rounds = max_rounds
+        self.count_tokens = count_tokens
+        self.template = template
+        self.cache = cache
+        self.model_key = SummaryCache.model_key(lang_model)
+        self.prompt_template = PromptTemplate(
+            input_variables=['page_content'], template=template)
+        # langchainのtext_splitterは読み込みに時間がかかるので要約するときにimportする
+        from langchain.text_splitter import RecursiveCharacterTextSplitter #type:ignore
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_size//10)
+        self.reports: list[RoundReport] = []
+
+    async def _summarize_chunk(self, semaphore:asyncio.Semaphore, text:str) -> str:
+        messages = [
+            SystemMessage(content=self.prompt_template.format(page_content=text)),
+        ]
+        async with semaphore, self.limiter or nullcontext():
+            response = await self.lang_model.ainvoke(messages)
+        return response.content
+
+    async def _run_round(self, stage:str, texts:list[str]) -> list[str]:
+        """キャッシュにないものだけLLMで並列に要約する"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+        results: list[str|None] = [None] * len(texts)
+        keys: list[str|None] = [None] * len(texts)
+        if self.cache is not None:
+            for i, text in enumerate(texts):
+                keys[i] = self.cache.chunk_key(text, self.model_key, self.template)
+                results[i] = await self.cache.aget(keys[i])
+        missing = [i for i, result in enumerate(results) if result is None]
+        summaries = await asyncio.gather(
+            *(self._summarize_chunk(semaphore, texts[i]) for i in missing))
+        for i, summary in zip(missing, summaries):
+            results[i] = summary
+            if self.cache is not None:
+                await self.cache.aput(keys[i], summary)
+        self.reports.append(RoundReport(
+            round=len(self.reports) + 1,
+            stage=stage,
+            calls=len(missing),
+            seconds=time.perf_counter() - start,
+            tokens_in=sum(self.count_tokens(text) for text in texts),
+            tokens_out=sum(self.count_tokens(text) for text in results),
+        ))
+        return results
+
+    def split(self, text:str) -> list[str]:
+        return self.text_splitter.split_text(text)
+
+    def group(self, summaries:list[str]) -> list[str]:
+        """reduce_input_tokensに収まるように隣り合う要約をまとめる"""
+        groups = []
+        current = []
+        current_tokens = 0
+        for summary in summaries:
+            tokens = self.count_tokens(summary)
+            if current and current_tokens + tokens > self.reduce_input_tokens:
+                groups.append('\n\n'.join(current))
+                current = []
+                current_tokens = 0
+            current.append(summary)
+            current_tokens += tokens
+        if current:
+            groups.append('\n\n'.join(current))
+        return groups
+
+    async def map(self, chunks:list[str]) -> list[str]:
+        return await self._run_round('map', chunks)
+
+    async def reduce(self, summaries:list[str]) -> str:
+        """要約の合計がtoken_budget以下になるまで木構造でまとめる"""
+        total = sum(self.count_tokens(summary) for summary in summaries)
+        while total > self.token_budget and len(self.reports) < self.max_rounds:
+            next_summaries = await self._run_round('reduce', self.group(summaries))
+            next_total = sum(self.count_tokens(summary) for summary in next_summaries)
+            # 減らなくなったら終了
+            if next_total >= total:
+                break
+            summaries, total = next_summaries, next_total
+        return '\n\n'.join(summaries)
+
+    async def summarize(self, text:str) -> str:
+        self.reports = []
+        if self.count_tokens(text) <= self.token_budget:
+            return text
+        key = None
+        if self.cache is not None:
+            key = self.cache.final_key(text, self.model_key, self.chunk_size, self.template)
+            cached = await self.cache.aget(key, kind='final')
+            if cached is not None:
+                return cached
+        summaries = await self.map(self.split(text))
+        summary = await self.reduce(summaries)
+        if self.cache is not None:
+            await self.cache.aput(key, summary)
+        return summary
@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+def model_key(lang_model) -> str:
+    """キャッシュキーに使うモデルの識別子"""
+    try:
+        params = lang_model._identifying_params
+    except Exception:
+        params = None
+    if params:
+        return f'{type(lang_model).__name__}:{sorted(params.items())}'
+    return type(lang_model).__name__
+
+def make_key(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+class SummaryCache:
+    """
+    要約結果の内容アドレス型キャッシュ。
+    最終的な要約はページ本文・モデル・chunk size・テンプレートのハッシュで、
+    chunk毎の途中の要約は入力文・モデル・テンプレートのハッシュで保存するので、
+    一部だけ変わったページでは変わったchunkだけ要約し直せばよい。
+    保存している文字数の合計がmax_charsを超えたら古い順に削除する。
+    shared (SharedStore) を渡すと、aget / aputで他のワーカープロセスとも共有する。
+    """
+    def __init__(self, max_chars:int=5_000_000, shared=None, shared_ttl:float=7 * 24 * 60 * 60):
+        self.max_chars = max_chars
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._chars = 0
+        self.stats = {'final_hit': 0, 'final_miss': 0, 'chunk_hit': 0, 'chunk_miss': 0, 'store_hit': 0}
+
+    def final_key(self, text:str, model:str, chunk_size:int, template:str) -> str:
+        return make_key('final', model, chunk_size, template, text)
+
+    def chunk_key(self, text:str, model:str, template:str) -> str:
+        return make_key('chunk', model, template, text)
+
+    def get(self, key:str, kind:str='chunk') -> str|None:
+        value = self._entries.get(key)
+        if value is None:
+            self.stats[f'{kind}_miss'] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats[f'{kind}_hit'] += 1
+        return value
+
+    def put(self, key:str, value:str) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._chars -= len(old)
+        self._entries[key] = value
+        self._chars += len(value)
+        while self._chars > self.max_chars and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._chars -= len(evicted)
+
+    async def aget(self, key:str, kind:str='chunk') -> str|None:
+        """getと同じだが、手元になければ共有のストアも探す"""
+        value = self._entries.get(key)
+        if value is not None or self.shared is None:
+            return self.get(key, kind)
+        try:
+            value = await asyncio.to_thread(self.shared.get, 'summary', key)
+        except Exception:
+            value = None
+        if value is None:
+            self.stats[f'{kind}_miss'] += 1
+            return None
+        self.stats['store_hit'] += 1
+        self.put(key, value)
+        return value
+
+    async def aput(self, key:str, value:str) -> None:
+        self.put(key, value)
+        if self.shared is not None:
+            try:
+                await asyncio.to_thread(self.shared.set, 'summary', key, value, self.shared_ttl)
+            except Exception as e:
+                print(f'shared summary cache unavailable: {e}')
+
+    def __len__(self) -> int:
+        return len(self._entries)
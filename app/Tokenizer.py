@@ -0,0 +1,86 @@
+def estimate_tokens(text:str) -> int:
+    """
+    トークン数の概算。ASCIIは4文字で1トークン、それ以外 (日本語など) は1文字1トークンとする
+    """
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+# モデル名の前方一致で決めるコンテキスト長
+CONTEXT_WINDOWS: dict[str, int] = {
+    'gpt-4o': 128000,
+    'gpt-4': 8192,
+    'gpt-3.5': 16385,
+    'gemma2': 8192,
+    'gemma': 8192,
+    'llama3': 8192,
+    'llama-3': 8192,
+    'mixtral': 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+class Tokenizer:
+    """概算によるトークナイザ。Ollama / Groqのモデルなど、専用のものがない場合に使う"""
+    # 1メッセージあたりのrole等のオーバーヘッド
+    message_overhead = 4
+
+    def count(self, text:str) -> int:
+        return estimate_tokens(text)
+
+    def truncate(self, text:str, max_tokens:int) -> str:
+        """先頭からmax_tokensに収まる分だけ残す"""
+        tokens = 0
+        ascii_run = 0
+        for i, c in enumerate(text):
+            if c.isascii():
+                ascii_run += 1
+                if ascii_run % 4 == 1:
+                    tokens += 1
+            else:
+                tokens += 1
+            if tokens > max_tokens:
+                return text[:i]
+        return text
+
+class TiktokenTokenizer(Tokenizer):
+    """OpenAIのモデル用。tiktokenがインストールされていなければ概算を使う"""
+    def __init__(self, model_name:str):
+        import tiktoken #type:ignore
+        try:
+            self.encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding('o200k_base')
+
+    def count(self, text:str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text:str, max_tokens:int) -> str:
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[:max_tokens])
+
+def model_name_of(llm) -> str:
+    for attr in ('model_name', 'model'):
+        name = getattr(llm, attr, None)
+        if isinstance(name, str):
+            return name
+    lang_model = getattr(llm, 'lang_model', None)
+    if lang_model is not None:
+        return lang_model.model_name
+    return ''
+
+def for_model(llm) -> Tokenizer:
+    name = model_name_of(llm)
+    if name.startswith(('gpt-', 'o1', 'o3', 'o4')):
+        try:
+            return TiktokenTokenizer(name)
+        except ImportError:
+            pass
+    return Tokenizer()
+
+def context_window(llm) -> int:
+    name = model_name_of(llm)
+    for prefix, window in CONTEXT_WINDOWS.items():
+        if name.startswith(prefix):
+            return window
+    return DEFAULT_CONTEXT_WINDOW
@@ -0,0 +1,240 @@
+import os
+import re
+import json
+import time
+import asyncio
+import codecs
+import hashlib
+import pathlib
+import aiohttp #type:ignore
+
+# 本文として読み込むContent-Type
+TEXT_CONTENT_TYPES = (
+    'text/html',
+    'text/plain',
+    'application/xhtml+xml',
+    'application/xml',
+    'text/xml',
+)
+META_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([A-Za-z0-9_\-]+)', re.IGNORECASE)
+
+class FetchError(Exception):
+    """Webページを取得できなかった場合の例外"""
+
+class FetchResult:
+    __slots__ = ('url', 'text', 'content_type', 'truncated', 'from_cache')
+
+    def __init__(self, url:str, text:str, content_type:str, truncated:bool, from_cache:bool):
+        self.url = url
+        self.text = text
+        self.content_type = content_type
+        self.truncated = truncated
+        self.from_cache = from_cache
+
+class DiskCache:
+    """
+    ETag / Last-Modified を保持するディスクキャッシュ。
+    ttl秒以内なら再検証せずに返し、max_entries / max_bytes を超えたら最終利用の古い順に削除する。
+    件数と合計サイズはメモリ上で数え、上限を超えた時 (と他のプロセスの書き込み分を数え直すため
+    rescan_every回の書き込み毎) だけディレクトリを走査する。
+    """
+    def __init__(
+            self,
+            cache_dir:str,
+            ttl:float=3600.0,
+            max_entries:int=1000,
+            max_bytes:int=200*1024*1024,
+            rescan_every:int=500,
+        ):
+        self.dir = pathlib.Path(cache_dir)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.rescan_every = rescan_every
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._entries: int|None = None # 未走査ならNone
+        self._bytes = 0
+        self._puts = 0
+
+    def _path(self, url:str) -> pathlib.Path:
+        return self.dir / (hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url:str) -> dict|None:
+        path = self._path(url)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # mtimeを最終利用時刻としてLRUに使う
+        os.utime(path)
+        return entry
+
+    def is_fresh(self, entry:dict) -> bool:
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def put(self, url:str, entry:dict) -> None:
+        path = self._path(url)
+        try:
+            old_size = path.stat().st_size
+        except OSError:
+            old_size = None
+        # 同じディレクトリを複数のワーカープロセスで共有するので、一時ファイルはプロセス毎に分ける
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        size = tmp.stat().st_size
+        os.replace(tmp, path)
+        self._puts += 1
+        if self._entries is None or self._puts % self.rescan_every == 0:
+            self.evict()
+            return
+        if old_size is None:
+            self._entries += 1
+        self._bytes += size - (old_size or 0)
+        if self._entries > self.max_entries or self._bytes > self.max_bytes:
+            self.evict()
+
+    def touch(self, url:str, entry:dict) -> None:
+        """304で再検証できた場合に取得時刻だけ更新する"""
+        entry['fetched_at'] = time.time()
+        self.put(url, entry)
+
+    def evict(self) -> None:
+        """ディレクトリを走査して件数と合計サイズを数え直し、上限を超えた分を削除する"""
+        files = []
+        for path in self.dir.glob('*.json'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        files.sort()
+        while files and (len(files) > self.max_entries or total > self.max_bytes):
+            _, size, path = files.pop(0)
+            path.unlink(missing_ok=True)
+            total -= size
+        self._entries = len(files)
+        self._bytes = total
+
+class WebFetcher:
+    """
+    共有のaiohttpセッションでWebページを取得する。
+    ホスト毎の同時接続数、接続/読み込みタイムアウト、Content-Typeの制限、
+    読み込みバイト数の上限とディスクキャッシュを備える。
+    """
+    def __init__(
+            self,
+            cache_dir:str|None=None,
+            cache_ttl:float=3600.0,
+            max_bytes:int=2*1024*1024, # 1ページあたりの最大読み込みバイト数
+            limit:int=32, # 全体の同時接続数
+            limit_per_host:int=4, # ホスト毎の同時接続数
+            connect_timeout:float=5.0,
+            read_timeout:float=10.0,
+            total_timeout:float=30.0,
+            user_agent:str='Mozilla/5.0 (compatible; discord-bot)',
+        ):
+        self.max_bytes = max_bytes
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout)
+        self.headers = {'User-Agent': user_agent}
+        self.cache = DiskCache(cache_dir, ttl=cache_ttl) if cache_dir is not None else None
+        self._session: aiohttp.ClientSession|None = None
+        self.stats = {'hit': 0, 'revalidated': 0, 'miss': 0}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout, headers=self.headers)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def fetch(self, url:str, fresh:bool=False) -> FetchResult:
+        """freshがTrueなら有効期限内のキャッシュでもサーバーに確認する (ETagなどで条件付きリクエストにする)"""
+        entry = None
+        if self.cache is not None:
+            entry = await asyncio.to_thread(self.cache.get, url)
+            if entry is not None and not fresh and self.cache.is_fresh(entry):
+                self.stats['hit'] += 1
+                return self._result(url, entry, from_cache=True)
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        session = self._get_session()
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304 and entry is not None:
+                    self.stats['revalidated'] += 1
+                    await asyncio.to_thread(self.cache.touch, url, entry)
+                    return self._result(url, entry, from_cache=True)
+                if response.status != 200:
+                    raise FetchError(f'HTTP {response.status}')
+                content_type = response.headers.get('Content-Type', '')
+                mime = content_type.split(';')[0].strip().lower()
+                if mime and mime not in TEXT_CONTENT_TYPES:
+                    raise FetchError(f'unsupported content type: {mime}')
+                # 保存してはいけない (共有キャッシュに置いてはいけない) レスポンス
+                cache_control = response.headers.get('Cache-Control', '').lower()
+                cacheable = 'no-store' not in cache_control and 'private' not in cache_control
+                body, truncated = await self._read_capped(response)
+                text = body.decode(self._encoding(response, body), errors='replace')
+                self.stats['miss'] += 1
+                new_entry = {
+                    'url': url,
+                    'text': text,
+                    'content_type': mime,
+                    'truncated': truncated,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'fetched_at': time.time(),
+                }
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise FetchError(f'{type(e).__name__}: {e}') from e
+
+        if self.cache is not None and cacheable:
+            await asyncio.to_thread(self.cache.put, url, new_entry)
+        return self._result(url, new_entry, from_cache=False)
+
+    async def _read_capped(self, response:aiohttp.ClientResponse) -> tuple[bytes, bool]:
+        """max_bytesまでしか読み込まない"""
+        chunks = []
+        size = 0
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= self.max_bytes:
+                return b''.join(chunks)[:self.max_bytes], True
+        return b''.join(chunks), False
+
+    def _encoding(self, response:aiohttp.ClientResponse, body:bytes) -> str:
+        candidates = []
+        if response.charset:
+            candidates.append(response.charset)
+        match = META_CHARSET_PATTERN.search(body[:4096])
+        if match:
+            candidates.append(match.group(1).decode('ascii'))
+        for encoding in candidates:
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                continue
+            return encoding
+        return 'utf-8'
+
+    def _result(self, url:str, entry:dict, from_cache:bool) -> FetchResult:
+        return FetchResult(
+            url, entry['text'], entry['content_type'], entry['truncated'], from_cache)
@@ -0,0 +1,294 @@
+"""
+オフラインのベンチマーク。
+Discord・Ollama・DuckDuckGo・WebページをFakeBackendsのローカルな代役に置き換えて
+LangchainBot.on_messageを同時に実行し、レイテンシ (p50/p95/p99) とスループットを測る。
+Usage:
+    python bench.py --messages 200 --concurrency 16
+    python bench.py --messages 100 --concurrency 8 --stream --mix chat=1,search=1,url=1 --json result.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+import discord #type:ignore
+import Client
+import LangModel
+import OllamaLangModel
+import Metrics
+import FakeBackends
+
+# 種類毎の質問の例。analyzeはローカルで判定できずLLMで意図を分析させるもの
+WORKLOADS: dict[str, list[str]] = {
+    'chat': [
+        'こんにちは、調子はどう？',
+        'おすすめの本を教えて',
+        '猫と犬ならどっちが好き？',
+        '週末の過ごし方について話そう',
+    ],
+    'search': [
+        '最新のニュースを教えて',
+        '今日の天気は？',
+        '新作ゲームの発売日を調べて',
+        '今週の株価の動きは？',
+    ],
+    'url': [
+        'この記事を要約して {url}',
+        'このページについて教えて {url}',
+    ],
+    'analyze': [
+        '次の予定はどうしよう',
+        '値段はどれくらいかな',
+    ],
+}
+
+class BenchBot(Client.LangchainBot):
+    """まとめて応答したメッセージのそれぞれに完了時刻を記録する"""
+    async def respond(self, messages: list):
+        error = None
+        try:
+            await super().respond(messages)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            done_at = time.perf_counter()
+            for message in messages:
+                message.done_at = done_at
+                message.error = error
+                message.done.set()
+
+def make_bot(
+        ollama_url:str,
+        search_backend:FakeBackends.FakeSearchBackend,
+        workdir:str,
+        **kwargs) -> tuple[BenchBot, FakeBackends.FakeUser]:
+    """代役に接続したLangchainBotを作る。Discordにはログインしない"""
+    llm = OllamaLangModel.OllamaAPIChatModel(
+        lang_model=LangModel.LangModel(
+            api_key='bench',
+            api_url=ollama_url,
+            model_name='bench',
+            pool_size=64,
+        )
+    )
+    kwargs.setdefault('system_prompt', 'あなたはベンチマーク用のアシスタントです。')
+    kwargs.setdefault('search_backend_factory', lambda: search_backend)
+    bot = BenchBot(
+        llm=llm,
+        intents=discord.Intents.default(),
+        schedule_db_path=os.path.join(workdir, 'schedule.sqlite3'),
+        memory_db_path=os.path.join(workdir, 'memory.sqlite3'),
+        **kwargs,
+    )
+    bot_user = FakeBackends.FakeUser('bench-bot', bot=True)
+    # Client.userはログイン時に設定される接続状態のユーザーを返す
+    bot._connection.user = bot_user
+    return bot, bot_user
+
+def percentile(values:list[float], q:float) -> float|None:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(q * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def latency_summary(values:list[float]) -> dict:
+    return {
+        'count': len(values),
+        'p50': percentile(values, 0.50),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': max(values) if values else None,
+    }
+
+def stage_summary() -> dict:
+    """Metricsに記録されたステージ毎の平均処理時間"""
+    return {
+        labels[0]: {'count': count, 'mean': total / count}
+        for labels, (total, count) in Metrics.STAGE_SECONDS.totals().items() if count
+    }
+
+class Sample:
+    __slots__ = ('kind', 'start', 'first_reply', 'done', 'error')
+
+    def __init__(self, kind:str, start:float, first_reply:float|None, done:float|None, error:str|None):
+        self.kind = kind
+        self.start = start
+        self.first_reply = first_reply
+        self.done = done
+        self.error = error
+
+def report(samples:list[Sample], elapsed:float) -> dict:
+    ok = [sample for sample in samples if sample.error is None and sample.done is not None]
+    result = {
+        'messages': len(samples),
+        'errors': len(samples) - len(ok),
+        'elapsed': elapsed,
+        'messages_per_sec': len(ok) / elapsed if elapsed > 0 else 0.0,
+        # 最初の返信 (ストリーミングならプレースホルダー) が見えるまで
+        'first_reply': latency_summary(
+            [sample.first_reply - sample.start for sample in ok if sample.first_reply is not None]),
+        # 応答が完了するまで
+        'done': latency_summary([sample.done - sample.start for sample in ok]),
+        'by_kind': {},
+    }
+    for kind in sorted({sample.kind for sample in samples}):
+        result['by_kind'][kind] = latency_summary(
+            [sample.done - sample.start for sample in ok if sample.kind == kind])
+    return result
+
+def format_report(result:dict) -> str:
+    def ms(value):
+        return '-' if value is None else f'{value * 1000:.0f}ms'
+    lines = [
+        f"messages: {result['messages']}  errors: {result['errors']}  "
+        f"elapsed: {result['elapsed']:.2f}s  throughput: {result['messages_per_sec']:.2f} msg/s",
+    ]
+    for name in ('first_reply', 'done'):
+        summary = result[name]
+        lines.append(
+            f"{name:>12}: p50 {ms(summary['p50'])}  p95 {ms(summary['p95'])}  "
+            f"p99 {ms(summary['p99'])}  max {ms(summary['max'])}")
+    for kind, summary in result['by_kind'].items():
+        lines.append(
+            f"{kind:>12}: n={summary['count']}  p50 {ms(summary['p50'])}  p95 {ms(summary['p95'])}  "
+            f"p99 {ms(summary['p99'])}")
+    for stage, summary in result.get('stages', {}).items():
+        lines.append(f"{'stage ' + stage:>20}: n={summary['count']}  mean {ms(summary['mean'])}")
+    for name, stats in result.get('components', {}).items():
+        lines.append(f'{name}: {stats}')
+    return '\n'.join(lines)
+
+def parse_mix(text:str) -> dict[str, float]:
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in WORKLOADS:
+            raise ValueError(f'unknown workload: {kind}')
+        mix[kind] = float(weight or 1)
+    return mix
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    ollama = FakeBackends.FakeOllamaServer(
+        first_token_latency=args.llm_latency,
+        token_interval=args.token_interval,
+        reply_tokens=args.reply_tokens,
+        prompt_eval_rate=args.prompt_eval_rate,
+        slots=args.kv_slots,
+    )
+    web = FakeBackends.StaticWebServer(latency=args.web_latency)
+    search = FakeBackends.FakeSearchBackend(latency=args.search_latency)
+    await ollama.start()
+    await web.start()
+    options = {}
+    if args.coalesce_window is not None:
+        # 省略時はボットの既定値で測る
+        options['coalesce_window'] = args.coalesce_window
+    with tempfile.TemporaryDirectory() as workdir:
+        bot, bot_user = make_bot(
+            ollama.url,
+            search,
+            workdir,
+            stream_reply=args.stream,
+            answer_cache=args.answer_cache,
+            max_per_guild=args.max_per_guild,
+            max_running=args.max_running,
+            max_llm_requests=args.max_llm,
+            **options,
+        )
+        guilds = [FakeBackends.FakeGuild() for _ in range(args.guilds)]
+        channels = []
+        for i in range(args.channels or args.concurrency):
+            channel = FakeBackends.FakeChannel(guilds[i % len(guilds)], bot_user)
+            # ボットの返信もDiscordと同じようにon_messageに流して会話履歴に入れる
+            channel.listener = bot.on_message
+            channels.append(channel)
+        mix = parse_mix(args.mix)
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        counter = itertools.count()
+        samples: list[Sample] = []
+
+        async def worker(index:int):
+            channel = channels[index % len(channels)]
+            user = FakeBackends.FakeUser(f'user{index}')
+            while next(counter) < args.messages:
+                kind = rng.choices(kinds, weights)[0]
+                text = rng.choice(WORKLOADS[kind]).format(url=f'{web.url}/page/{rng.randrange(args.pages)}')
+                message = channel.post(f'{bot_user.mention} {text}', user, mentions=[bot_user])
+                start = time.perf_counter()
+                await bot.on_message(message)
+                try:
+                    await asyncio.wait_for(message.done.wait(), args.timeout)
+                except asyncio.TimeoutError:
+                    message.error = 'timeout'
+                samples.append(Sample(kind, start, message.first_reply_at, message.done_at, message.error))
+                if args.think_time:
+                    await asyncio.sleep(rng.expovariate(1 / args.think_time))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        result = report(samples, elapsed)
+        result['stages'] = stage_summary()
+        result['components'] = {
+            'llm_server': ollama.stats,
+            'search_calls': {'calls': search.calls},
+            'web_requests': {'requests': web.requests},
+            'admission': bot.admission.stats,
+            'router': bot.router.stats,
+            'context_packer': bot.context_packer.stats,
+            'prompt_cache': bot.llm.lang_model.stats,
+        }
+        await bot.close()
+    await web.close()
+    await ollama.close()
+    return result
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='offline benchmark of LangchainBot.on_message')
+    parser.add_argument('--messages', type=int, default=100, help='number of mentions to send')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of users sending at the same time')
+    parser.add_argument('--channels', type=int, default=0, help='number of channels (default: one per user)')
+    parser.add_argument('--guilds', type=int, default=1)
+    parser.add_argument('--mix', type=str, default='chat=2,search=1,url=1', help='workload weights')
+    parser.add_argument('--pages', type=int, default=20, help='number of distinct URL pages')
+    parser.add_argument('--stream', action='store_true', help='stream replies by editing the message')
+    parser.add_argument('--answer-cache', action='store_true', help='enable the semantic answer cache')
+    parser.add_argument('--coalesce-window', type=float, default=None,
+                        help="seconds an idle channel waits for follow-up mentions (default: the bot's default)")
+    parser.add_argument('--max-per-guild', type=int, default=64)
+    parser.add_argument('--max-running', type=int, default=64)
+    parser.add_argument('--max-llm', type=int, default=16)
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='seconds to the first token')
+    parser.add_argument('--token-interval', type=float, default=0.02, help='seconds between tokens')
+    parser.add_argument('--reply-tokens', type=int, default=60)
+    parser.add_argument('--prompt-eval-rate', type=float, default=0.0,
+                        help='seconds to evaluate one prompt character that is not in the KV cache')
+    parser.add_argument('--kv-slots', type=int, default=4,
+                        help='number of KV caches of the LLM server (0 for a cold baseline)')
+    parser.add_argument('--search-latency', type=float, default=0.2)
+    parser.add_argument('--web-latency', type=float, default=0.05)
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean seconds between messages of a user')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', type=str, default=None, help='write the report to this file')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    result = asyncio.run(run(args))
+    print(format_report(result))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    # python bench.py --messages 200 --concurrency 16
+    main()
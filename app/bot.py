@@ -1,48 +1,112 @@
+import time
+# 起動時間の計測用 (importより前に記録する)
+STARTED_AT = time.monotonic()
 import discord #type:ignore
 import os
 import Client
-import pathlib
-from langchain_groq import ChatGroq #type:ignore
-from langchain_openai import ChatOpenAI #type:ignore
+import PromptAssets
+import LLMRouter
+import Metrics
 
-def get_prompt(path: str) -> str:
-    path = pathlib.Path(path)
-    if path.exists():
-        with open(path, 'r') as f:
-            return f.read()
-    else:
-        prompts = [
-            'あなたは知識豊富なアシスタントです。会話を良く理解し、適切な返答を行います。基本的に日本語で答えてください。'
-        ]
-        prompt = '\n'.join(prompts)
-        return prompt
-    
-    
-def get_system_prompt(path: str) -> str:
-    return get_prompt(path)
+def build_backend(name:str):
+    # 使うバックエンドのライブラリだけを読み込む
+    if name == 'openai':
+        from langchain_openai import ChatOpenAI #type:ignore
+        return ChatOpenAI(model=os.environ.get('OPENAI_MODEL', "gpt-4o-mini"), temperature=0.7)
+    if name == 'groq':
+        from langchain_groq import ChatGroq #type:ignore
+        return ChatGroq(model=os.environ.get('GROQ_MODEL', "gemma2-9b-it"), temperature=0.7)
+    if name == 'ollama':
+        import LangModel
+        import OllamaLangModel
+        options = {'temperature': 0.7}
+        if os.environ.get('OLLAMA_NUM_CTX'):
+            options['num_ctx'] = int(os.environ['OLLAMA_NUM_CTX'])
+        return OllamaLangModel.OllamaAPIChatModel(
+            lang_model=LangModel.LangModel(
+                api_key=os.environ['OLLAMA_API_KEY'],
+                api_url=os.environ['OLLAMA_URL'],
+                model_name=os.environ.get('OLLAMA_MODEL', "gemma2:9b"),
+                options=options,
+                keep_alive=os.environ.get('OLLAMA_KEEP_ALIVE', '30m'),
+            )
+        )
+    raise ValueError(f'unknown LLM backend: {name}')
+
+def ollama_models(llm) -> list:
+    """起動時に読み込んでおくOllamaのモデル"""
+    models = [backend.model for backend in llm.backends] if isinstance(llm, LLMRouter.LLMRouter) else [llm]
+    return [model.lang_model for model in models if getattr(model, 'lang_model', None) is not None]
+
+def parse_hours(text:str|None) -> tuple[int, int]|None:
+    """'8-2' -> (8, 2)"""
+    if not text:
+        return None
+    start, end = text.split('-')
+    return int(start), int(end)
+
+def shard_options() -> dict:
+    """
+    SHARD_COUNTを指定するとAutoShardedClientで動かし、SHARD_IDS (例: 0,1) でこのプロセスが受け持つシャードを決める。
+    supervisor.pyがワーカー毎に設定する
+    """
+    if not os.environ.get('SHARD_COUNT'):
+        return {}
+    options = {'shard_count': int(os.environ['SHARD_COUNT'])}
+    if os.environ.get('SHARD_IDS'):
+        options['shard_ids'] = [int(shard_id) for shard_id in os.environ['SHARD_IDS'].split(',')]
+    return options
+
+def build_llm():
+    """
+    LLM_BACKENDS (例: openai,groq,ollama) に複数指定すると、速くて正常なものに振り分けるルーターを使う
+    """
+    names = [name.strip() for name in os.environ.get('LLM_BACKENDS', 'openai').split(',') if name.strip()]
+    if len(names) == 1:
+        return build_backend(names[0])
+    timeout = float(os.environ.get('LLM_FIRST_TOKEN_TIMEOUT', '30'))
+    return LLMRouter.LLMRouter(
+        backends=[
+            LLMRouter.Backend(name, build_backend(name), first_token_timeout=timeout)
+            for name in names],
+        # 最初のトークンがp95を過ぎても来なければ次のバックエンドにも投げる
+        hedge=os.environ.get('LLM_HEDGE', '0') == '1',
+    )
 
 if __name__ == '__main__':
+    Metrics.mark_startup('imports', STARTED_AT)
     intents = discord.Intents.default()
     intents.message_content = True
-    system_prompt_path = '/prompts/system_prompt.md'
-    system_prompt = get_prompt(system_prompt_path)
+    # /prompts 以下のファイルは一度だけ読み込み、変更があれば差し替える
+    prompt_assets = PromptAssets.PromptAssets(root='/prompts')
+    PromptAssets.set_default(prompt_assets)
     
-    # llm = OllamaLangModel.OllamaAPIChatModel(
-    #     lang_model=LangModel.LangModel(
-    #         api_key=os.environ['OLLAMA_API_KEY'],
-    #         api_url=os.environ['OLLAMA_URL'],
-    #         model_name="gemma2:9b",
-    #     )
-    # )
-    # llm = ChatGroq(
-    #     model="gemma2-9b-it",
-    #     temperature=0.7,
-    # )
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.7)
-    langchainbot = Client.LangchainBot(
+    # 1にするとステージ毎のスパンをJSONで出力する
+    Metrics.tracer.enabled = os.environ.get('TRACE', '0') == '1'
+    llm = build_llm()
+    sharding = shard_options()
+    bot_class = Client.ShardedLangchainBot if sharding else Client.LangchainBot
+    # ワーカープロセス間で検索結果と要約を共有する
+    shared_store = None
+    if os.environ.get('SHARED_STORE'):
+        import SharedStore
+        shared_store = SharedStore.open_store(os.environ['SHARED_STORE'])
+    langchainbot = bot_class(
         llm=llm,
         intents=intents,
-        system_prompt=system_prompt,
-        system_prompt_getter=lambda : get_system_prompt(system_prompt_path),
+        system_prompt=prompt_assets.system_prompt(),
+        prompt_assets=prompt_assets,
+        stream_reply=os.environ.get('STREAM_REPLY', '0') == '1',
+        summarize_pages=os.environ.get('SUMMARIZE_PAGES', '0') == '1',
+        web_cache_dir=os.environ.get('WEB_CACHE_DIR', '/tmp/discord-bot/web'),
+        max_reply_tokens=int(os.environ['MAX_REPLY_TOKENS']) if os.environ.get('MAX_REPLY_TOKENS') else None,
+        analysis_max_tokens=100,
+        warm_models=ollama_models(llm),
+        # 利用者のいる時間帯だけモデルを温めておく
+        keep_warm_hours=parse_hours(os.environ.get('OLLAMA_ACTIVE_HOURS')),
+        metrics_port=int(os.environ['METRICS_PORT']) if os.environ.get('METRICS_PORT') else None,
+        started_at=STARTED_AT,
+        shared_store=shared_store,
+        **sharding,
     )
     langchainbot.run(os.environ['DISCORD_API_KEY'])
\ No newline at end of file
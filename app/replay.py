@@ -0,0 +1,247 @@
+"""
+書き出したチャンネルの会話ログをLangchainBot.on_messageに流し直す負荷試験。
+LLM・検索・WebページはFakeBackendsの代役を使うので、同じログと同じ設定なら何度でも同じ条件で測れる。
+2回の結果を--compareで比べて、変更で遅くなっていないかを確認する。
+
+会話ログはJSONLで、1行に1メッセージ:
+    {"author": "alice", "content": "@bot 今日の天気は？", "mentions": ["bot"], "timestamp": "2024-10-18T12:00:00+09:00"}
+- channel / guild (省略可): チャンネルとギルドの識別子。省略時は1つのチャンネル
+- authorが--bot-nameのメッセージは再生せず、--recorded-repliesを付けるとLLMの応答として順番に使う
+- 会話ログ中のURLはローカルのWebサーバーのページに置き換える
+Usage:
+    python replay.py transcript.jsonl --speed 10 --json after.json --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+from datetime import datetime
+import IntentRouter
+import Metrics
+import FakeBackends
+import bench
+
+def parse_time(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+
+def load_transcript(path:str) -> list[dict]:
+    entries = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    # 同じ時刻のものは元の順番のまま
+    entries.sort(key=lambda entry: parse_time(entry.get('timestamp', 0)))
+    return entries
+
+def flatten(result:dict, prefix:str='') -> dict[str, float]:
+    values = {}
+    for key, value in result.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{name}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+# 比較表に出す値 (前方一致)
+COMPARE_KEYS = (
+    'messages_per_sec',
+    'first_reply.p50', 'first_reply.p95', 'first_reply.p99',
+    'done.p50', 'done.p95', 'done.p99',
+    'llm_calls', 'tokens', 'branches', 'search_calls', 'coalesced', 'errors',
+    'prompt_cache.prompt_eval_tokens', 'prompt_cache.prompt_eval_seconds',
+)
+
+def format_compare(before:dict, after:dict) -> str:
+    before_values = flatten(before)
+    after_values = flatten(after)
+    def show(value):
+        if value is None:
+            return '-'
+        return f'{value:.3f}' if isinstance(value, float) else str(value)
+    lines = [f"{'metric':<28}{'before':>12}{'after':>12}{'change':>10}"]
+    for key in sorted(set(before_values) | set(after_values)):
+        if not key.startswith(COMPARE_KEYS):
+            continue
+        old = before_values.get(key)
+        new = after_values.get(key)
+        change = ''
+        if old and new is not None:
+            change = f'{(new - old) / old * 100:+.1f}%'
+        lines.append(f'{key:<28}{show(old):>12}{show(new):>12}{change:>10}')
+    return '\n'.join(lines)
+
+async def run(args) -> dict:
+    entries = load_transcript(args.transcript)
+    if not entries:
+        raise ValueError('empty transcript')
+    recorded_replies = None
+    if args.recorded_replies:
+        recorded_replies = [entry['content'] for entry in entries if entry.get('author') == args.bot_name]
+    recorded_search = None
+    if args.search_recordings:
+        with open(args.search_recordings, 'r') as f:
+            recorded_search = json.load(f)
+    ollama = FakeBackends.FakeOllamaServer(
+        first_token_latency=args.llm_latency,
+        token_interval=args.token_interval,
+        replies=recorded_replies or None,
+        prompt_eval_rate=args.prompt_eval_rate,
+        slots=args.kv_slots,
+    )
+    web = FakeBackends.StaticWebServer(latency=args.web_latency)
+    search = FakeBackends.FakeSearchBackend(latency=args.search_latency, recorded=recorded_search)
+    await ollama.start()
+    await web.start()
+    options = {'stream_reply': args.stream, 'answer_cache': args.answer_cache}
+    if args.coalesce_window is not None:
+        options['coalesce_window'] = args.coalesce_window
+    with tempfile.TemporaryDirectory() as workdir:
+        bot, bot_user = bench.make_bot(ollama.url, search, workdir, **options)
+        users: dict[str, FakeBackends.FakeUser] = {args.bot_name: bot_user}
+        guilds: dict[object, FakeBackends.FakeGuild] = {}
+        channels: dict[object, FakeBackends.FakeChannel] = {}
+        urls: dict[str, str] = {}
+
+        def user_for(name:str, bot:bool=False) -> FakeBackends.FakeUser:
+            user = users.get(name)
+            if user is None:
+                user = FakeBackends.FakeUser(name, bot=bot)
+                users[name] = user
+            return user
+
+        def channel_for(entry:dict) -> FakeBackends.FakeChannel:
+            key = entry.get('channel', 'default')
+            channel = channels.get(key)
+            if channel is None:
+                guild_key = entry.get('guild', 'default')
+                guild = guilds.setdefault(guild_key, FakeBackends.FakeGuild())
+                channel = FakeBackends.FakeChannel(guild, bot_user)
+                channel.listener = bot.on_message
+                channels[key] = channel
+            return channel
+
+        def local_url(match) -> str:
+            url = match.group(0)
+            if url not in urls:
+                urls[url] = f'{web.url}/page/{len(urls)}'
+            return urls[url]
+
+        def content_for(entry:dict, mentions:list[FakeBackends.FakeUser]) -> str:
+            content = IntentRouter.URL_PATTERN.sub(local_url, entry.get('content', ''))
+            if args.bot_id:
+                content = content.replace(f'<@!{args.bot_id}>', bot_user.mention)
+                content = content.replace(f'<@{args.bot_id}>', bot_user.mention)
+            # 会話ログの表示名のメンションを実際のメンションに置き換える
+            for user in mentions:
+                if user.mention not in content:
+                    if f'@{user.name}' in content:
+                        content = content.replace(f'@{user.name}', user.mention)
+                    else:
+                        content = f'{user.mention} {content}'
+            return content
+
+        samples: list[bench.Sample] = []
+        waiting: list[tuple[str, float, FakeBackends.FakeMessage]] = []
+        start = time.perf_counter()
+        first = parse_time(entries[0].get('timestamp', 0))
+        for entry in entries:
+            author = entry.get('author', 'unknown')
+            if author == args.bot_name:
+                # ボットの発言は再生中のボット自身が返す
+                continue
+            if args.speed > 0:
+                delay = (parse_time(entry.get('timestamp', 0)) - first) / args.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            user = user_for(author, bot=entry.get('bot', False))
+            mentions = [user_for(name) for name in entry.get('mentions', [])]
+            channel = channel_for(entry)
+            message = channel.post(content_for(entry, mentions), user, mentions)
+            sent_at = time.perf_counter()
+            await bot.on_message(message)
+            if bot_user in mentions and not user.bot:
+                prompt = bot.strip_mentions(message)
+                command = message.content.replace(bot_user.mention, '').strip()
+                waiting.append((bot.router.classify(prompt, command).kind, sent_at, message))
+
+        for kind, sent_at, message in waiting:
+            try:
+                await asyncio.wait_for(message.done.wait(), args.timeout)
+            except asyncio.TimeoutError:
+                message.error = 'timeout'
+            samples.append(bench.Sample(kind, sent_at, message.first_reply_at, message.done_at, message.error))
+        elapsed = time.perf_counter() - start
+
+        result = bench.report(samples, elapsed)
+        result['transcript_messages'] = len(entries)
+        result['llm_calls'] = ollama.stats['chat'] + ollama.stats['generate']
+        result['analysis_calls'] = ollama.stats['analysis']
+        tokens = {'prompt': 0, 'completion': 0}
+        for (_, kind), value in Metrics.LLM_TOKENS.items().items():
+            tokens[kind] = tokens.get(kind, 0) + value
+        result['tokens'] = tokens
+        # on_messageのどの分岐を通ったか
+        result['branches'] = {
+            kind: Metrics.REQUESTS.get(route=kind)
+            for kind in (IntentRouter.SCHEDULE, IntentRouter.URL, IntentRouter.SEARCH, IntentRouter.CHAT)
+        }
+        result['search_calls'] = search.calls
+        result['coalesced'] = bot.admission.stats['coalesced']
+        result['prompt_cache'] = bot.llm.lang_model.stats
+        result['stages'] = bench.stage_summary()
+        await bot.close()
+    await web.close()
+    await ollama.close()
+    return result
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='replay a channel transcript through LangchainBot.on_message')
+    parser.add_argument('transcript', type=str, help='JSONL of author, content, mentions, timestamp')
+    parser.add_argument('--bot-name', type=str, default='bot', help='author name of the bot in the transcript')
+    parser.add_argument('--bot-id', type=str, default=None, help='user id of the bot in raw <@id> mentions')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='1 replays at the original pace, 10 ten times faster, 0 as fast as possible')
+    parser.add_argument('--recorded-replies', action='store_true',
+                        help="use the bot's messages in the transcript as the LLM responses")
+    parser.add_argument('--search-recordings', type=str, default=None, help='JSON of query -> search results')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--answer-cache', action='store_true')
+    parser.add_argument('--coalesce-window', type=float, default=None,
+                        help="seconds an idle channel waits for follow-up mentions (default: the bot's default)")
+    parser.add_argument('--llm-latency', type=float, default=0.3)
+    parser.add_argument('--token-interval', type=float, default=0.02)
+    parser.add_argument('--prompt-eval-rate', type=float, default=0.0,
+                        help='seconds to evaluate one prompt character that is not in the KV cache')
+    parser.add_argument('--kv-slots', type=int, default=4,
+                        help='number of KV caches of the LLM server (0 for a cold baseline)')
+    parser.add_argument('--search-latency', type=float, default=0.2)
+    parser.add_argument('--web-latency', type=float, default=0.05)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--json', type=str, default=None, help='write the report to this file')
+    parser.add_argument('--compare', type=str, default=None, help='report of an earlier run to compare with')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    result = asyncio.run(run(args))
+    print(bench.format_report(result))
+    print(f"llm calls: {result['llm_calls']} (analysis {result['analysis_calls']})  tokens: {result['tokens']}")
+    print(f"branches: {result['branches']}")
+    print(f"prompt cache: {result['prompt_cache']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            before = json.load(f)
+        print(format_compare(before, result))
+
+if __name__ == '__main__':
+    # python replay.py transcript.jsonl --speed 10 --json after.json --compare before.json
+    main()
@@ -0,0 +1,152 @@
+"""
+起動時間の計測。
+新しいプロセスで -X importtime を付けてbot.pyと同じモジュールを読み込み、LangchainBotを作ってsetup_hookを終えるまで
+(Discordへの接続の手前まで) の時間と、パッケージ毎のimport時間を表示する。--budgetを超えたら終了コード1で終わるので、起動が遅くなる変更をCIで検出できる。
+本番のon_readyまでの時間はメトリクスのdiscord_bot_startup_seconds{phase="ready"}に出る。
+Usage:
+    python startup.py --top 20
+    python startup.py --budget 3.0 --repeat 3
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+# -X importtime の出力: "import time:       123 |        456 |   package.module"
+IMPORTTIME_PATTERN = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def child() -> None:
+    """計測される側。import時間はstderrに、フェーズ毎の秒数はJSONでstdoutに出す"""
+    import asyncio
+    import tempfile
+    started = time.perf_counter()
+    import discord #type:ignore
+    import bot
+    import Client
+    imported = time.perf_counter()
+    # LLMのクライアントは作るだけで接続しないので、APIキーなどは仮の値でよい
+    os.environ.setdefault('OPENAI_API_KEY', 'startup')
+    os.environ.setdefault('GROQ_API_KEY', 'startup')
+    os.environ.setdefault('OLLAMA_API_KEY', 'startup')
+    os.environ.setdefault('OLLAMA_URL', 'http://127.0.0.1:9/api')
+
+    async def build(workdir:str) -> tuple[float, float]:
+        start = time.perf_counter()
+        langchainbot = Client.LangchainBot(
+            llm=bot.build_llm(),
+            intents=discord.Intents.default(),
+            system_prompt='',
+            schedule_db_path=os.path.join(workdir, 'schedule.sqlite3'),
+            memory_db_path=os.path.join(workdir, 'memory.sqlite3'),
+            # ブラウザと埋め込みモデルの読み込みはバックグラウンドで行われ、接続を待たせないので計測しない
+            # (埋め込みモデルのダウンロードが終わるまで終了できなくなる)
+            browser_prewarm=False,
+            answer_cache=False,
+        )
+        built = time.perf_counter()
+        # login()の中で接続の前に呼ばれる部分
+        await langchainbot.setup_hook()
+        setup = time.perf_counter()
+        await langchainbot.close()
+        return built - start, setup - built
+
+    with tempfile.TemporaryDirectory() as workdir:
+        built, setup = asyncio.run(build(workdir))
+    print(json.dumps({
+        'imports': imported - started,
+        'build': built,
+        'setup': setup,
+        'total': imported - started + built + setup,
+    }))
+
+def parse_importtime(text:str) -> list[tuple[str, int, int, int]]:
+    """Returns: (モジュール, 自身の時間[us], 累積の時間[us], ネストの深さ) のリスト"""
+    entries = []
+    for line in text.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            entries.append((module, int(self_us), int(cumulative_us), len(indent) // 2))
+    return entries
+
+def by_package(entries:list[tuple[str, int, int, int]]) -> dict[str, int]:
+    """トップレベルのパッケージ毎の自身の時間の合計 [us]"""
+    totals: dict[str, int] = {}
+    for module, self_us, _, _ in entries:
+        package = module.split('.')[0]
+        totals[package] = totals.get(package, 0) + self_us
+    return totals
+
+def measure() -> tuple[dict[str, float], list[tuple[str, int, int, int]]]:
+    script = os.path.abspath(__file__)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', script, '--child'],
+        cwd=os.path.dirname(script),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f'startup failed:\n{result.stderr[-4000:]}')
+    phases = json.loads(result.stdout.strip().splitlines()[-1])
+    return phases, parse_importtime(result.stderr)
+
+def format_report(phases:dict[str, float], entries:list[tuple[str, int, int, int]], top:int) -> str:
+    lines = [
+        f"imports: {phases['imports']:.3f}s  build: {phases['build']:.3f}s  "
+        f"setup_hook: {phases['setup']:.3f}s  total: {phases['total']:.3f}s"]
+    lines.append('')
+    lines.append('slowest packages (self time):')
+    packages = sorted(by_package(entries).items(), key=lambda item: item[1], reverse=True)
+    for package, self_us in packages[:top]:
+        lines.append(f'  {self_us / 1e6:8.3f}s  {package}')
+    lines.append('')
+    lines.append('slowest imports (cumulative):')
+    # 同じパッケージの中のモジュールは最も外側のものだけ出す
+    shown: set[str] = set()
+    for module, _, cumulative_us, _ in sorted(entries, key=lambda entry: entry[2], reverse=True):
+        package = module.split('.')[0]
+        if package in shown:
+            continue
+        shown.add(package)
+        lines.append(f'  {cumulative_us / 1e6:8.3f}s  {module}')
+        if len(shown) >= top:
+            break
+    return '\n'.join(lines)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='measure the import, construction and setup_hook time of the bot')
+    parser.add_argument('--top', type=int, default=15, help='number of packages and imports to show')
+    parser.add_argument('--repeat', type=int, default=1, help='measure this many times and use the fastest run')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='exit with status 1 if imports + build + setup_hook takes longer than this many seconds')
+    parser.add_argument('--json', type=str, default=None, help='write the phases and import times to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.child:
+        child()
+        return
+    runs = [measure() for _ in range(max(args.repeat, 1))]
+    phases, entries = min(runs, key=lambda run: run[0]['total'])
+    print(format_report(phases, entries, args.top))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'phases': phases,
+                'packages': by_package(entries),
+                'imports': [
+                    {'module': module, 'self_us': self_us, 'cumulative_us': cumulative_us, 'depth': depth}
+                    for module, self_us, cumulative_us, depth in entries],
+            }, f, ensure_ascii=False, indent=2)
+    if args.budget is not None and phases['total'] > args.budget:
+        print(f"startup took {phases['total']:.3f}s, over the budget of {args.budget:.3f}s")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    # python startup.py --budget 3.0
+    main()
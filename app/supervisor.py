@@ -0,0 +1,170 @@
+"""
+シャードを複数のワーカープロセスに分けてbot.pyを起動し、落ちたら起動し直すスーパーバイザー。
+1つのプロセスのイベントループが全ギルドのイベント・HTMLのパース・プロンプトの組み立てを処理すると、
+重い処理が他のギルドへの応答を止めてしまうので、シャードのグループ毎にプロセスを分ける。
+ワーカーには SHARD_COUNT / SHARD_IDS / WORKER_INDEX を渡し、METRICS_PORTはワーカー毎にずらす。
+検索結果と要約のキャッシュは SHARED_STORE (SQLiteのファイルかredis://) で共有する。
+Usage:
+    python supervisor.py --workers 4
+    python supervisor.py --workers 2 --shards 8 --shared-store data/shared.sqlite3
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+
+def shard_groups(shard_count:int, workers:int) -> list[list[int]]:
+    """シャードIDをworkers個のグループに順番に分ける (例: 5, 2 -> [[0, 1, 2], [3, 4]])"""
+    workers = max(min(workers, shard_count), 1)
+    size, extra = divmod(shard_count, workers)
+    groups = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(range(start, end)))
+        start = end
+    return groups
+
+async def recommended_shards(token:str) -> int:
+    """Discordの推奨するシャード数 (GET /gateway/bot)"""
+    import aiohttp #type:ignore
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+                'https://discord.com/api/v10/gateway/bot',
+                headers={'Authorization': f'Bot {token}'}) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return int(data['shards'])
+
+class Worker:
+    """1つのワーカープロセスと、その再起動の状態"""
+    def __init__(self, index:int, shard_ids:list[int]):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process: asyncio.subprocess.Process|None = None
+        self.started_at = 0.0
+        self.restarts = 0
+
+class Supervisor:
+    """
+    ワーカーを順番に起動し (IDENTIFYのレート制限のため間隔を空ける)、終了したら指数バックオフで起動し直す。
+    min_uptime秒以上動いていたワーカーはバックオフを最初からやり直す。
+    SIGTERM / SIGINTを受けたら全ワーカーに転送して終了を待つ。
+    """
+    def __init__(
+            self,
+            shard_count:int,
+            workers:int,
+            command:list[str],
+            env:dict[str, str]|None=None,
+            metrics_port:int|None=None, # ワーカーiはmetrics_port + i
+            stagger:float=5.0, # 前のワーカーのシャード1つあたりに空ける秒数
+            min_uptime:float=60.0,
+            max_backoff:float=300.0,
+        ):
+        self.shard_count = shard_count
+        self.command = command
+        self.env = dict(os.environ if env is None else env)
+        self.metrics_port = metrics_port
+        self.stagger = stagger
+        self.min_uptime = min_uptime
+        self.max_backoff = max_backoff
+        self.workers = [Worker(i, shard_ids) for i, shard_ids in enumerate(shard_groups(shard_count, workers))]
+        self._stopping = asyncio.Event()
+
+    def worker_env(self, worker:Worker) -> dict[str, str]:
+        env = dict(self.env)
+        env['SHARD_COUNT'] = str(self.shard_count)
+        env['SHARD_IDS'] = ','.join(str(shard_id) for shard_id in worker.shard_ids)
+        env['WORKER_INDEX'] = str(worker.index)
+        if self.metrics_port is not None:
+            env['METRICS_PORT'] = str(self.metrics_port + worker.index)
+        return env
+
+    async def _spawn(self, worker:Worker) -> None:
+        worker.process = await asyncio.create_subprocess_exec(*self.command, env=self.worker_env(worker))
+        worker.started_at = time.monotonic()
+        if self._stopping.is_set():
+            worker.process.terminate()
+        print(f'worker {worker.index} (shards {worker.shard_ids}) started as pid {worker.process.pid}')
+
+    async def _watch(self, worker:Worker, delay:float) -> None:
+        if delay > 0:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+                return
+            except asyncio.TimeoutError:
+                pass
+        backoff = 1.0
+        while not self._stopping.is_set():
+            await self._spawn(worker)
+            code = await worker.process.wait()
+            if self._stopping.is_set():
+                break
+            uptime = time.monotonic() - worker.started_at
+            if uptime >= self.min_uptime:
+                backoff = 1.0
+            worker.restarts += 1
+            print(f'worker {worker.index} exited with {code} after {uptime:.0f}s, restarting in {backoff:.0f}s')
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=backoff)
+            except asyncio.TimeoutError:
+                pass
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        for worker in self.workers:
+            if worker.process is not None and worker.process.returncode is None:
+                worker.process.terminate()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+        tasks = []
+        delay = 0.0
+        for worker in self.workers:
+            tasks.append(asyncio.create_task(self._watch(worker, delay)))
+            delay += self.stagger * len(worker.shard_ids)
+        await asyncio.gather(*tasks)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='run bot.py in several processes, each with a group of shards')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='total number of shards (default: recommended by Discord, at least --workers)')
+    parser.add_argument('--shared-store', type=str, default=None,
+                        help='SQLite file or redis:// URL for the caches shared by the workers')
+    parser.add_argument('--metrics-port', type=int, default=None, help='worker i serves metrics on this port + i')
+    parser.add_argument('--stagger', type=float, default=5.0, help='seconds to wait per shard before the next worker')
+    parser.add_argument('--script', type=str, default='bot.py')
+    return parser.parse_args()
+
+async def main():
+    args = parse_args()
+    shard_count = args.shards
+    if shard_count is None:
+        shard_count = max(await recommended_shards(os.environ['DISCORD_API_KEY']), args.workers)
+    env = dict(os.environ)
+    if args.shared_store:
+        env['SHARED_STORE'] = args.shared_store
+    metrics_port = args.metrics_port
+    if metrics_port is None and os.environ.get('METRICS_PORT'):
+        metrics_port = int(os.environ['METRICS_PORT'])
+    supervisor = Supervisor(
+        shard_count,
+        args.workers,
+        [sys.executable, args.script],
+        env=env,
+        metrics_port=metrics_port,
+        stagger=args.stagger,
+    )
+    print(f'{shard_count} shards in {len(supervisor.workers)} workers')
+    await supervisor.run()
+
+if __name__ == '__main__':
+    # python supervisor.py --workers 4
+    asyncio.run(main())